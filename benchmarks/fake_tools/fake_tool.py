@@ -0,0 +1,245 @@
+# Stand-ins for ffmpeg, ffprobe and yt-dlp, for measuring and testing the Python side of webm_for_4chan.py without real encodes.
+# Point the script at them with the WEBM_FOR_4CHAN_FFMPEG, WEBM_FOR_4CHAN_FFPROBE and WEBM_FOR_4CHAN_YTDLP environment variables.
+#
+# ffprobe answers from recorded `ffprobe -show_format -show_streams` JSON (recordings/<input name>.probe.json, or default.probe.json).
+# ffmpeg replays recorded stderr for the analysis filters the script parses (recordings/<input name>.<filter>.stderr, or default.<filter>.stderr),
+# reports progress with -progress, writes pass 1 logs, and writes outputs sized to the requested bit rate and duration. A pipe:0 input is read to the end,
+# and -f lavfi inputs are taken as generated.
+# yt-dlp prints the file name with -j and otherwise "downloads" a file of FAKE_YTDLP_SIZE bytes into the -P directory. It writes the info JSON
+# with --write-info-json and writes the file's path with --print-to-file after_move:%(filepath)s. With -o - the file goes to stdout instead
+# (the contents of FAKE_YTDLP_SOURCE if set, trickled at FAKE_YTDLP_RATE), and --print-to-file before_dl writes the metadata to a file
+# named with the given template, in which %(id)s, %(title)s and %(ext)s are expanded.
+#
+# Environment variables:
+#   FAKE_TOOLS_RECORDINGS    Directory of recordings (default: recordings next to this file)
+#   FAKE_FFMPEG_SIZE_FACTOR  Output size as a fraction of bit rate * duration (default: 0.97)
+#   FAKE_YTDLP_SIZE          Size of downloaded files in bytes (default: 1048576)
+#   FAKE_YTDLP_SOURCE        File that yt-dlp -o - streams, i.e. a real video for testing --stream with real ffmpeg (default: FAKE_YTDLP_SIZE zero bytes)
+#   FAKE_YTDLP_RATE          Bytes per second that yt-dlp -o - streams at (default: as fast as possible)
+
+import json
+import os
+import re
+import sys
+import time
+
+recordings_dir = os.environ.get('FAKE_TOOLS_RECORDINGS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings'))
+null_outputs = ['/dev/null', 'NUL', '-']
+# Stderr transcripts, keyed by a string that identifies the analysis in the filter graph. The first match wins.
+transcript_keys = [('ssim', 'ssim'), ('loudnorm=print_format', 'loudnorm'), ('an_frames', 'analysis'), ('blackframe', 'blackframe'), ('cropdetect', 'cropdetect'), ('silencedetect', 'silencedetect')]
+
+def get_recording(input_filename, suffix : str):
+    if input_filename is not None:
+        path = os.path.join(recordings_dir, os.path.splitext(os.path.basename(input_filename))[0] + suffix)
+        if os.path.isfile(path):
+            return path
+    path = os.path.join(recordings_dir, 'default' + suffix)
+    return path if os.path.isfile(path) else None
+
+def get_option(args : list, *names):
+    for idx, arg in enumerate(args[:-1]):
+        if arg in names:
+            return args[idx + 1]
+    return None
+
+def get_all_options(args : list, *names):
+    return [args[idx + 1] for idx, arg in enumerate(args[:-1]) if arg in names]
+
+# Seconds from an ffmpeg time value (5, 5.5, 0:05, 0:00:05.500000) or None
+def parse_seconds(value):
+    if value is None:
+        return None
+    seconds = 0.0
+    try:
+        for part in value.split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    return seconds
+
+# Bit rate in bits per second from an ffmpeg value (128k, 2M, 96000)
+def parse_bitrate(value):
+    if value is None:
+        return 0
+    multiplier = {'k': 1000, 'K': 1000, 'm': 1000000, 'M': 1000000}.get(value[-1], 1)
+    try:
+        return float(value.rstrip('kKmM')) * multiplier
+    except ValueError:
+        return 0
+
+def load_probe(input_filename):
+    path = get_recording(input_filename, '.probe.json')
+    if path is None:
+        return {'format': {'duration': '60.000000'}, 'streams': []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+# Streams matching an ffprobe -select_streams specifier (v, a, s, v:0, a:1)
+def select_streams(streams : list, specifier):
+    if specifier is None:
+        return streams
+    kind, _, index = specifier.partition(':')
+    codec_type = {'v': 'video', 'a': 'audio', 's': 'subtitle'}[kind]
+    selected = [x for x in streams if x.get('codec_type') == codec_type]
+    if index != '':
+        selected = selected[int(index):int(index) + 1]
+    return selected
+
+def ffprobe(args : list):
+    input_filename = args[-1]
+    if not os.path.isfile(input_filename):
+        print('{}: No such file or directory'.format(input_filename), file=sys.stderr)
+        return 1
+    probe = load_probe(input_filename)
+    streams = select_streams(probe.get('streams', []), get_option(args, '-select_streams'))
+    if '-show_streams' in args: # JSON output
+        print(json.dumps({'streams': streams}, indent=4))
+        return 0
+    entries = get_option(args, '-show_entries') or ''
+    output_format = get_option(args, '-of', '-print_format') or ''
+    section, _, keys = entries.partition('=')
+    if section == 'format':
+        rows = [[probe.get('format', {}).get(x, 'N/A') for x in keys.split(',')]]
+    else:
+        rows = []
+        fields, _, tags = keys.partition(':')
+        for stream in streams:
+            row = [str(stream.get(x, 'N/A')) for x in fields.split(',') if x != '']
+            for tag in tags.replace('stream_tags=', '').split(','):
+                if tag != '' and tag in stream.get('tags', {}):
+                    row.append(stream['tags'][tag])
+            rows.append(row)
+    for row in rows:
+        if output_format.startswith('csv'):
+            print(','.join(row))
+        else:
+            for value in row:
+                print(value)
+    return 0
+
+def write_progress(duration, frame_rate):
+    duration = duration or 0.0
+    for fraction, state in [(0.5, 'continue'), (1.0, 'end')]:
+        out_time = duration * fraction
+        sys.stdout.write('frame={}\nfps={:.2f}\nbitrate=1000.0kbits/s\ntotal_size=0\nout_time_us={}\nspeed=100x\nprogress={}\n'.format(
+            int(out_time * frame_rate), frame_rate * 100, int(out_time * 1000000), state))
+    sys.stdout.flush()
+
+def ffmpeg(args : list):
+    inputs = get_all_options(args, '-i')
+    if 'lavfi' in get_all_options(args, '-f'): # Generated inputs, i.e. testsrc2=size=1280x720
+        inputs = []
+    if 'pipe:0' in inputs:
+        while len(sys.stdin.buffer.read(65536)) > 0:
+            pass
+        inputs = [x for x in inputs if x != 'pipe:0']
+    for input_filename in inputs:
+        if not os.path.isfile(input_filename):
+            print('{}: No such file or directory'.format(input_filename), file=sys.stderr)
+            return 1
+    probe = load_probe(inputs[0] if len(inputs) > 0 else None)
+    duration = parse_seconds(get_option(args, '-t'))
+    if duration is None:
+        duration = max(float(probe.get('format', {}).get('duration', 0.0)) - (parse_seconds(get_option(args, '-ss')) or 0.0), 0.0)
+    video = select_streams(probe.get('streams', []), 'v:0')
+    frame_rate = 30.0
+    if len(video) > 0 and '/' in video[0].get('r_frame_rate', ''):
+        numerator, denominator = video[0]['r_frame_rate'].split('/')
+        frame_rate = float(numerator) / float(denominator) if float(denominator) > 0 else 30.0
+
+    # Replay the stderr of the analysis filter, if any
+    filters = ' '.join(get_all_options(args, '-vf', '-af', '-filter:a', '-filter:v', '-lavfi', '-filter_complex'))
+    for key, name in transcript_keys:
+        if key in filters:
+            path = get_recording(inputs[0] if len(inputs) > 0 else None, '.{}.stderr'.format(name))
+            if path is not None:
+                with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                    sys.stderr.write(f.read())
+            break
+
+    if get_option(args, '-pass') == '1':
+        passlog = get_option(args, '-passlogfile') or 'ffmpeg2pass'
+        with open(passlog + '-0.log', 'w') as f:
+            f.write('# fake pass 1 log\n')
+        if get_option(args, '-c:v') in ['libx264', 'h264_nvenc']:
+            with open(passlog + '-0.log.mbtree', 'wb') as f:
+                f.write(b'\0' * 1024)
+    if get_option(args, '-progress') is not None:
+        write_progress(duration, frame_rate)
+
+    output = args[-1]
+    if output in null_outputs or get_option(args, '-f') == 'null':
+        return 0
+    if output == 'pipe:1':
+        # Complexity probe trial encode. The byte count grows with the scaled resolution, so that the fit sees a plausible curve.
+        match = re.search(r"min\((\d+),iw\)", filters)
+        resolution = int(match.group(1)) if match else 1280
+        sys.stdout.buffer.write(b'\0' * int(resolution * resolution * 0.05 * duration))
+        return 0
+    bitrate = sum(parse_bitrate(x) for x in get_all_options(args, '-b:v', '-b:a'))
+    if bitrate > 0:
+        size = int(bitrate * duration / 8 * float(os.environ.get('FAKE_FFMPEG_SIZE_FACTOR', '0.97')))
+    else: # Stream copies and lossless intermediates
+        size = sum(os.path.getsize(x) for x in inputs) if len(inputs) > 0 else 65536
+    with open(output, 'wb') as f:
+        f.truncate(size)
+    return 0
+
+def ytdlp(args : list):
+    url = next((x for x in args if '://' in x), 'https://example.com/video')
+    filename = re.sub(r'[^A-Za-z0-9_.-]', '_', url.rstrip('/').split('/')[-1] or 'video') + '.webm'
+    if '-j' in args:
+        print(json.dumps({'filename': os.path.join(get_option(args, '-P', '--paths') or '', filename), 'title': filename}))
+        return 0
+    duration = float(load_probe(filename).get('format', {}).get('duration', 0.0))
+    if (get_all_options(args, '-o', '--output') or [None])[-1] == '-': # The last -o wins
+        return ytdlp_stream(args, url, filename, duration)
+    path = os.path.join(get_option(args, '-P', '--paths') or '.', filename)
+    print('[download] Destination: {}'.format(path))
+    with open(path, 'wb') as f:
+        f.truncate(int(os.environ.get('FAKE_YTDLP_SIZE', '1048576')))
+    print('[download] 100% of 1.00MiB')
+    if '--write-info-json' in args:
+        with open(os.path.splitext(path)[0] + '.info.json', 'w') as f:
+            json.dump({'id': os.path.splitext(filename)[0], 'title': filename, 'webpage_url': url, 'duration': duration}, f)
+    for idx, arg in enumerate(args[:-2]):
+        if arg == '--print-to-file' and args[idx + 1] == 'after_move:%(filepath)s':
+            with open(args[idx + 2], 'a') as f:
+                f.write(os.path.abspath(path) + '\n')
+    return 0
+
+# yt-dlp -o -: the metadata goes to the --print-to-file file, the video to stdout and the progress to stderr
+def ytdlp_stream(args : list, url : str, filename : str, duration : float):
+    source = os.environ.get('FAKE_YTDLP_SOURCE')
+    name, ext = os.path.splitext(os.path.basename(source) if source else filename)
+    info = {'id': name, 'title': name, 'ext': ext.lstrip('.'), 'duration': duration}
+    for idx, arg in enumerate(args[:-2]):
+        if arg == '--print-to-file' and args[idx + 1].startswith('before_dl:'):
+            path = re.sub(r'%\((\w+)\)s', lambda m: str(info.get(m.group(1), 'NA')).replace('/', '_'), args[idx + 2]).replace('%%', '%')
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'a') as f:
+                f.write(json.dumps(info) + '\n')
+    size = os.path.getsize(source) if source else int(os.environ.get('FAKE_YTDLP_SIZE', '1048576'))
+    rate = float(os.environ.get('FAKE_YTDLP_RATE', '0'))
+    chunk_size = max(int(rate / 10), 4096) if rate > 0 else 1048576
+    written = 0
+    with open(source or os.devnull, 'rb') as f:
+        while written < size:
+            chunk = f.read(chunk_size) if source else b'\0' * min(chunk_size, size - written)
+            if len(chunk) == 0:
+                break
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+            written += len(chunk)
+            print('[download] {:5.1f}% of {}'.format(written * 100.0 / size, size), file=sys.stderr)
+            if rate > 0:
+                time.sleep(len(chunk) / rate)
+    return 0
+
+def main(tool : str):
+    args = sys.argv[1:]
+    if tool == 'ffprobe':
+        return ffprobe(args)
+    if tool == 'ffmpeg':
+        return ffmpeg(args)
+    return ytdlp(args)
@@ -0,0 +1,64 @@
+# Record ffprobe output and analysis filter stderr from real inputs, for the fake tools to replay.
+#
+#   python benchmarks/fake_tools/record.py input.mkv                           # recordings/input.probe.json
+#   python benchmarks/fake_tools/record.py input.mkv --name default --transcripts
+#
+# Transcripts are recorded from the first --seconds of the input, with the same filters webm_for_4chan.py runs.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+fake_tools_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(fake_tools_dir)))
+import webm_for_4chan as w4c
+
+def get_transcript_commands(input_filename : str, seconds : float):
+    analysis_vf = w4c.get_frame_analysis_filter(True)
+    head = [w4c.ffmpeg_exe, '-hide_banner', '-t', str(seconds), '-i', input_filename]
+    null = ['-f', 'null', w4c.null_output, '-v', 'info']
+    return {
+        'analysis': head + ['-an', '-sn', '-vf', analysis_vf] + null,
+        'blackframe': head + ['-vf', 'blackframe=threshold=96:amount=92'] + null,
+        'cropdetect': head + ['-vf', 'cropdetect'] + null,
+        'silencedetect': head + ['-af', w4c.silence_filter] + null,
+        'loudnorm': head + ['-vn', '-filter:a', 'loudnorm=print_format=json'] + null,
+        'ssim': head + ['-t', str(seconds), '-i', input_filename, '-lavfi', '[0:v][1:v]ssim'] + null,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Record real ffprobe/ffmpeg output for the fake tools')
+    parser.add_argument('inputs', nargs='+', help='Input files to record')
+    parser.add_argument('--name', type=str, help='Recording name (default: the input file name without extension). Use "default" for the fallback recording.')
+    parser.add_argument('--transcripts', action='store_true', help='Also record the stderr of the analysis filters')
+    parser.add_argument('--seconds', type=float, default=2.0, help='Length of input used for transcripts (default: 2)')
+    parser.add_argument('--output_dir', type=str, default=os.path.join(fake_tools_dir, 'recordings'), help='Where to write the recordings')
+    args = parser.parse_args()
+    if args.name is not None and len(args.inputs) > 1:
+        parser.error('--name can only be used with a single input')
+    os.makedirs(args.output_dir, exist_ok=True)
+    for input_filename in args.inputs:
+        name = args.name or os.path.splitext(os.path.basename(input_filename))[0]
+        result = subprocess.run([w4c.ffprobe_exe, '-v', 'error', '-show_format', '-show_streams', '-print_format', 'json', input_filename], stdout=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            raise RuntimeError('ffprobe returned code {} for "{}"'.format(result.returncode, input_filename))
+        probe = json.loads(result.stdout)
+        probe['format'].pop('filename', None) # Recordings are looked up by name, the original path is just noise
+        with open(os.path.join(args.output_dir, name + '.probe.json'), 'w') as f:
+            json.dump(probe, f, indent=2)
+        print('Recorded {}.probe.json'.format(name))
+        if not args.transcripts:
+            continue
+        for key, cmd in get_transcript_commands(input_filename, args.seconds).items():
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
+            if result.returncode != 0:
+                print('Skipping {} transcript, ffmpeg returned code {}'.format(key, result.returncode))
+                continue
+            with open(os.path.join(args.output_dir, '{}.{}.stderr'.format(name, key)), 'w') as f:
+                f.write(result.stderr)
+            print('Recorded {}.{}.stderr'.format(name, key))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# Orchestration overhead microbenchmark for webm_for_4chan.py
+# Runs every mode against the stand-in tools in benchmarks/fake_tools, which answer instantly from recordings, so what is left
+# is the Python side: start-up, argument building, probing logic, segment math, output naming and cleanup, plus the cost of each spawn.
+# For every case it reports the median wall time, how many child processes were spawned (from --metrics), how many more than
+# a plain wsg conversion needs, and the time left after subtracting the wall time of the children.
+#
+#   python benchmarks/orchestration.py
+#   python benchmarks/orchestration.py --cases wsg,search,auto_crop --repeat 10
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import run_benchmarks
+from run_benchmarks import benchmark_dir
+
+fake_tools_dir = os.path.join(benchmark_dir, 'fake_tools')
+
+# The run_benchmarks cases, plus the features that add probes or analysis passes on top of a wsg conversion
+cases = dict(run_benchmarks.cases)
+feature_args = {
+    'search': ['--search'],
+    'complexity': ['--resize_mode', 'complexity'],
+    'scene_keyframes': ['--scene_keyframes'],
+    'no_audio': ['--no_audio'],
+    'trim_silence': ['--trim_silence', 'all'],
+    'auto_crop': ['--auto_crop'],
+    'blackframe': ['--blackframe'],
+    'normalize': ['--normalize'],
+    'stage': ['--stage'],
+    'race': ['--race'],
+    'resume': ['--resume'],
+    'resume_rerun': ['--resume', '--keep_temp_files'],
+}
+for name, extra in feature_args.items():
+    cases[name] = cases['wsg'] + extra
+cases['download'] = ['https://example.com/watch/fake_video', '--board', 'wsg']
+rerun_cases = ['resume_rerun'] # Measured on a second run, which picks up what the first one left in its --resume job directory
+
+def get_home_dir(work_dir : str):
+    return os.path.join(work_dir, 'home') # The script's caches and --resume job directories, so that every benchmark run starts fresh
+
+def get_environment(work_dir : str):
+    env = dict(os.environ)
+    env['HOME'] = get_home_dir(work_dir)
+    env['WEBM_FOR_4CHAN_FFMPEG'] = os.path.join(fake_tools_dir, 'ffmpeg')
+    env['WEBM_FOR_4CHAN_FFPROBE'] = os.path.join(fake_tools_dir, 'ffprobe')
+    env['WEBM_FOR_4CHAN_YTDLP'] = os.path.join(fake_tools_dir, 'yt-dlp')
+    return env
+
+# The fakes never read the inputs, they only need to exist. Names match the recordings in fake_tools/recordings.
+def create_inputs(work_dir : str):
+    paths = dict()
+    for name in run_benchmarks.inputs:
+        paths[name] = run_benchmarks.get_input_path(work_dir, name)
+        if not os.path.isfile(paths[name]):
+            with open(paths[name], 'wb') as f:
+                f.truncate(65536)
+    return paths
+
+def read_usage(metrics_file : str):
+    if not os.path.isfile(metrics_file):
+        return []
+    with open(metrics_file, 'r') as f:
+        return [json.loads(line) for line in f]
+
+def run_once(work_dir : str, name : str, case_args : list, env : dict):
+    metrics_file = os.path.join(work_dir, 'metrics_{}.jsonl'.format(name))
+    if os.path.isfile(metrics_file):
+        os.remove(metrics_file)
+    cmd = [sys.executable, run_benchmarks.script] + case_args + ['-o', 'out_{}'.format(name), '-y', '--no_analysis_cache', '--no_cache', '--metrics', metrics_file]
+    started = time.perf_counter()
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=work_dir, env=env)
+    wall = time.perf_counter() - started
+    if result.returncode != 0:
+        return {'error': 'Exit code {}'.format(result.returncode), 'log': result.stdout[-2000:]}
+    if 'Traceback (most recent call last)' in result.stdout: # The script prints the errors of a job and exits with 0
+        return {'error': 'Job failed', 'log': result.stdout[-2000:]}
+    usage = read_usage(metrics_file)
+    stages = dict()
+    for x in usage:
+        stages[x['stage']] = stages.get(x['stage'], 0) + 1
+    return {'wall': wall, 'spawns': len(usage), 'child_wall': sum(x['wall'] or 0.0 for x in usage), 'stages': stages}
+
+def run_case(work_dir : str, name : str, case_args : list, env : dict, repeat : int):
+    runs = []
+    if name in rerun_cases:
+        run = run_once(work_dir, name, case_args, env)
+        if 'error' in run:
+            return {'name': name, 'error': run['error'], 'log': run['log']}
+    for _ in range(repeat):
+        run = run_once(work_dir, name, case_args, env)
+        if 'error' in run:
+            return {'name': name, 'error': run['error'], 'log': run['log']}
+        runs.append(run)
+    wall = statistics.median(x['wall'] for x in runs)
+    child_wall = statistics.median(x['child_wall'] for x in runs)
+    return {
+        'name': name,
+        'wall': round(wall, 4),
+        'spawns': runs[-1]['spawns'],
+        'child_wall': round(child_wall, 4),
+        'overhead': round(wall - child_wall, 4),
+        'stages': runs[-1]['stages'],
+    }
+
+# Interpreter start-up and module import, the floor under every job
+def run_startup(repeat : int):
+    walls = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, run_benchmarks.script, '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        walls.append(time.perf_counter() - started)
+    wall = statistics.median(walls)
+    return {'name': 'startup (--help)', 'wall': round(wall, 4), 'spawns': 0, 'child_wall': 0.0, 'overhead': round(wall, 4), 'stages': {}}
+
+def print_results(results : list):
+    base_spawns = next((x['spawns'] for x in results if x['name'] == 'wsg' and 'error' not in x), None)
+    print('{:<18}{:>10}{:>8}{:>8}{:>12}{:>12}'.format('case', 'wall ms', 'spawns', '+wsg', 'child ms', 'python ms'))
+    for result in results:
+        if 'error' in result:
+            print('{:<18}{}'.format(result['name'], result['error']))
+            continue
+        extra = '-' if base_spawns is None or result['name'].startswith('startup') else '{:+d}'.format(result['spawns'] - base_spawns)
+        print('{:<18}{:>10.1f}{:>8}{:>8}{:>12.1f}{:>12.1f}'.format(result['name'], result['wall'] * 1000, result['spawns'], extra, result['child_wall'] * 1000, result['overhead'] * 1000))
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the orchestration overhead and process spawns of webm_for_4chan.py with fake ffmpeg/ffprobe/yt-dlp')
+    parser.add_argument('--cases', type=str, help='Comma separated list of cases to run (default: all). Available: {}'.format(', '.join(cases)))
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case, the median is reported (default: 5)')
+    parser.add_argument('--work_dir', type=str, default=os.path.join(run_benchmarks.default_work_dir, 'orchestration'), help='Directory for the placeholder inputs and outputs')
+    parser.add_argument('--results', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    selected = args.cases.split(',') if args.cases else list(cases)
+    unknown = [x for x in selected if x not in cases]
+    if len(unknown) > 0:
+        parser.error('Unknown case(s): {}'.format(', '.join(unknown)))
+    if os.name != 'posix':
+        print('The fake tools are Python scripts with a shebang line and only run on POSIX systems.')
+        return 1
+    os.makedirs(args.work_dir, exist_ok=True)
+    paths = create_inputs(args.work_dir)
+    shutil.rmtree(get_home_dir(args.work_dir), ignore_errors=True)
+    env = get_environment(args.work_dir)
+    results = [run_startup(max(1, args.repeat))]
+    for name in selected:
+        case_args = [x.format(**{k : v for k, v in paths.items() if '{' + k + '}' in x}) for x in cases[name]]
+        print('Running {} x{}'.format(name, args.repeat))
+        results.append(run_case(args.work_dir, name, case_args, env, max(1, args.repeat)))
+
+    print_results(results)
+    for result in results:
+        if 'error' in result:
+            print('\n{} failed:\n{}'.format(result['name'], result['log']))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump({x['name'] : x for x in results}, f, indent=2)
+    return 1 if any('error' in x for x in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# Offline benchmark suite for webm_for_4chan.py
+# Generates deterministic inputs with ffmpeg's lavfi sources, converts them in each mode, and records the wall time,
+# the time per stage (from --trace), the CPU time of the child processes (from --metrics), and how much of the size limit the output uses.
+# Results can be compared against a stored baseline, so that speed and size accuracy regressions show up before a release.
+#
+#   python benchmarks/run_benchmarks.py                    # Run everything and compare against benchmarks/baseline.json if it exists
+#   python benchmarks/run_benchmarks.py --update_baseline  # Store this run as the new baseline
+#   python benchmarks/run_benchmarks.py --cases concat,cut --extra_args="--fast"
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmark_dir))
+import webm_for_4chan as w4c
+
+script = os.path.join(os.path.dirname(benchmark_dir), 'webm_for_4chan.py')
+default_work_dir = os.path.join(benchmark_dir, 'work') # Generated inputs are kept here between runs, outputs are overwritten
+default_baseline = os.path.join(benchmark_dir, 'baseline.json')
+
+# Synthetic inputs. Each is generated once with a fixed lavfi graph, so every machine benchmarks identical content.
+# video/audio are lavfi source descriptions, layout is the audio channel layout. Audio is stored as flac, which keeps the channel layout.
+inputs = {
+    'testsrc2_1080p24_stereo_30s': {'video': 'testsrc2=size=1920x1080:rate=24', 'audio': 'sine=frequency=440:sample_rate=48000', 'layout': 'stereo', 'duration': 30, 'extension': '.mkv'},
+    'testsrc2_720p30_stereo_60s': {'video': 'testsrc2=size=1280x720:rate=30', 'audio': 'sine=frequency=330:sample_rate=48000', 'layout': 'stereo', 'duration': 60, 'extension': '.mkv'},
+    'mandelbrot_360p60_mono_20s': {'video': 'mandelbrot=size=640x360:rate=60', 'audio': 'anoisesrc=color=pink:sample_rate=48000:seed=1', 'layout': 'mono', 'duration': 20, 'extension': '.mkv'},
+    'testsrc2_720p30_51side_15s': {'video': 'testsrc2=size=1280x720:rate=30', 'audio': 'anoisesrc=color=white:sample_rate=48000:seed=2', 'layout': '5.1(side)', 'duration': 15, 'extension': '.mkv'},
+    'testsrc2_480p30_silent_20s': {'video': 'testsrc2=size=854x480:rate=30', 'audio': None, 'layout': None, 'duration': 20, 'extension': '.mp4'}, # Audio replace only takes mp4 or webm
+    'sine_stereo_30s': {'video': None, 'audio': 'sine=frequency=220:sample_rate=44100', 'layout': 'stereo', 'duration': 30, 'extension': '.flac'},
+    'testsrc2_still': {'video': 'testsrc2=size=1280x720:rate=1', 'audio': None, 'layout': None, 'duration': 1, 'extension': '.png'},
+    'noise_360p30_stereo_400s': {'video': 'testsrc2=size=640x360:rate=30,noise=alls=12:allf=t', 'audio': 'anoisesrc=color=pink:sample_rate=48000:seed=3', 'layout': 'stereo', 'duration': 400, 'extension': '.mkv'}, # Long enough for every board's max duration (size_accuracy.py)
+}
+
+# Benchmark cases. args are passed to webm_for_4chan.py, {name} is replaced with the path of the generated input.
+cases = {
+    'wsg': ['{testsrc2_1080p24_stereo_30s}', '--board', 'wsg'],
+    'gif': ['{mandelbrot_360p60_mono_20s}', '--board', 'gif'],
+    'other': ['{testsrc2_720p30_stereo_60s}', '-s', '0:10', '-e', '0:40', '--board', 'other'],
+    'surround': ['{testsrc2_720p30_51side_15s}', '--board', 'wsg'],
+    'concat': ['{testsrc2_720p30_stereo_60s}', '-c', '0:05-0:15;0:30-0:40'],
+    'cut': ['{testsrc2_720p30_stereo_60s}', '-x', '0:10-0:40'],
+    'static_image': ['{testsrc2_still}', '{sine_stereo_30s}'],
+    'audio_replace': ['--audio_replace', '{testsrc2_480p30_silent_20s}', '{sine_stereo_30s}'],
+}
+
+def get_input_path(work_dir : str, name : str):
+    return os.path.join(work_dir, name + inputs[name]['extension'])
+
+# Render a synthetic input unless it already exists
+def generate_input(work_dir : str, name : str):
+    path = get_input_path(work_dir, name)
+    if os.path.isfile(path):
+        return path
+    spec = inputs[name]
+    cmd = [w4c.ffmpeg_exe, '-hide_banner', '-v', 'error', '-y']
+    if spec['video'] is not None:
+        cmd.extend(['-f', 'lavfi', '-i', spec['video']])
+    if spec['audio'] is not None:
+        cmd.extend(['-f', 'lavfi', '-i', spec['audio']])
+    cmd.extend(['-t', str(spec['duration'])])
+    if path.endswith('.png'):
+        cmd.extend(['-frames:v', '1'])
+    elif spec['video'] is not None:
+        cmd.extend(['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '18', '-pix_fmt', 'yuv420p', '-threads', '1'])
+    if spec['audio'] is not None:
+        cmd.extend(['-af', 'aformat=channel_layouts={}'.format(spec['layout']), '-c:a', 'flac'])
+    cmd.extend(['-fflags', '+bitexact', path])
+    print('Generating {}'.format(os.path.basename(path)))
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        raise RuntimeError('ffmpeg returned code {} while generating {}'.format(result.returncode, name))
+    return path
+
+# Sum the time spent in each traced stage. Stages nest (process_video contains everything else), so the times are inclusive.
+def get_stage_times(trace_file : str):
+    with open(trace_file, 'r') as f:
+        events = json.load(f)['traceEvents']
+    stages = dict()
+    for event in events:
+        if event.get('ph') == 'X' and event.get('cat') == 'stage':
+            stages[event['name']] = stages.get(event['name'], 0.0) + event['dur'] / 1000000
+    return {k : round(v, 3) for k, v in stages.items()}
+
+def get_child_cpu_time(metrics_file : str):
+    total = 0.0
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            usage = json.loads(line)
+            total += (usage['user'] or 0.0) + (usage['sys'] or 0.0)
+    return round(total, 3)
+
+def run_case(work_dir : str, name : str, extra_args : list):
+    case_args = [x.format(**{k : generate_input(work_dir, k) for k in inputs if '{' + k + '}' in x}) for x in cases[name]]
+    case_args.extend(extra_args)
+    parsed_args, unknown_args = w4c.build_argument_parser().parse_known_args(case_args)
+    output = os.path.join(work_dir, 'out_{}'.format(name))
+    trace_file = os.path.join(work_dir, 'trace_{}.json'.format(name))
+    metrics_file = os.path.join(work_dir, 'metrics_{}.jsonl'.format(name))
+    for filename in [trace_file, metrics_file]:
+        if os.path.isfile(filename):
+            os.remove(filename)
+    cmd = [sys.executable, script] + case_args + ['-o', output, '-y', '--no_cache', '--trace', trace_file, '--metrics', metrics_file]
+    print('Running {}: {}'.format(name, ' '.join(cmd[1:])))
+    started = time.perf_counter()
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=work_dir)
+    wall = time.perf_counter() - started
+    output_file = None
+    for line in result.stdout.splitlines():
+        if line.startswith('output file: "'):
+            output_file = os.path.join(work_dir, line[len('output file: "'):-1])
+    if result.returncode != 0 or output_file is None or not os.path.isfile(output_file):
+        print(result.stdout)
+        return {'name': name, 'error': 'Conversion failed (exit code {})'.format(result.returncode)}
+    size = os.path.getsize(output_file)
+    limit = w4c.get_size_limit(parsed_args)
+    return {
+        'name': name,
+        'wall': round(wall, 3),
+        'child_cpu': get_child_cpu_time(metrics_file),
+        'stages': get_stage_times(trace_file),
+        'size': size,
+        'limit': limit,
+        'size_ratio': round(size / limit, 4),
+    }
+
+# Compare results against the baseline. Returns a list of regression messages.
+def compare(results : list, baseline : dict, time_tolerance : float, size_tolerance : float):
+    regressions = []
+    for result in results:
+        name = result['name']
+        if 'error' in result:
+            regressions.append('{}: {}'.format(name, result['error']))
+            continue
+        if result['size_ratio'] > 1.0:
+            regressions.append('{}: output is {:.1%} of the size limit'.format(name, result['size_ratio']))
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        if result['wall'] > base['wall'] * (1 + time_tolerance):
+            regressions.append('{}: wall time {:.1f}s vs {:.1f}s in the baseline'.format(name, result['wall'], base['wall']))
+        if abs(result['size_ratio'] - base['size_ratio']) > size_tolerance:
+            regressions.append('{}: size ratio {:.1%} vs {:.1%} in the baseline'.format(name, result['size_ratio'], base['size_ratio']))
+    return regressions
+
+def print_results(results : list, baseline : dict):
+    print('{:<16}{:>9}{:>9}{:>10}{:>12}'.format('case', 'wall s', 'base s', 'cpu s', 'size/limit'))
+    for result in results:
+        if 'error' in result:
+            print('{:<16}{}'.format(result['name'], result['error']))
+            continue
+        base = baseline.get('results', {}).get(result['name'])
+        print('{:<16}{:>9.1f}{:>9}{:>10.1f}{:>12.1%}'.format(result['name'], result['wall'], '{:.1f}'.format(base['wall']) if base else '-', result['child_cpu'], result['size_ratio']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark webm_for_4chan.py on synthetic inputs')
+    parser.add_argument('--cases', type=str, help='Comma separated list of cases to run (default: all). Available: {}'.format(', '.join(cases)))
+    parser.add_argument('--work_dir', type=str, default=default_work_dir, help='Directory for generated inputs and outputs')
+    parser.add_argument('--baseline', type=str, default=default_baseline, help='Baseline results to compare against')
+    parser.add_argument('--update_baseline', action='store_true', help='Store the results of this run as the baseline')
+    parser.add_argument('--results', type=str, help='Also write the results of this run to this file')
+    parser.add_argument('--time_tolerance', type=float, default=0.25, help='Allowed wall time increase over the baseline, as a fraction (default: 0.25)')
+    parser.add_argument('--size_tolerance', type=float, default=0.03, help='Allowed change of the size/limit ratio from the baseline (default: 0.03)')
+    parser.add_argument('--extra_args', type=str, default='', help='Extra arguments for every conversion, i.e. --extra_args="--fast"')
+    args = parser.parse_args()
+
+    selected = args.cases.split(',') if args.cases else list(cases)
+    unknown = [x for x in selected if x not in cases]
+    if len(unknown) > 0:
+        parser.error('Unknown case(s): {}'.format(', '.join(unknown)))
+    os.makedirs(args.work_dir, exist_ok=True)
+    baseline = dict()
+    if os.path.isfile(args.baseline) and not args.update_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    results = [run_case(args.work_dir, name, args.extra_args.split()) for name in selected]
+
+    print_results(results, baseline)
+    run_info = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'extra_args': args.extra_args, 'results': {x['name'] : x for x in results}}
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump(run_info, f, indent=2)
+    if args.update_baseline:
+        if any('error' in x for x in results):
+            print('Not updating the baseline, some cases failed.')
+            return 1
+        with open(args.baseline, 'w') as f:
+            json.dump(run_info, f, indent=2)
+        print('Baseline written to "{}"'.format(args.baseline))
+        return 0
+    if baseline.get('extra_args', args.extra_args) != args.extra_args:
+        print('Warning: The baseline was recorded with --extra_args="{}"'.format(baseline['extra_args']))
+    regressions = compare(results, baseline, args.time_tolerance, args.size_tolerance)
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+# Size accuracy matrix for the bit-rate calculation
+# Converts clips of a synthetic input over a sweep of durations (1 second up to the board's max_duration) for every combination of
+# board, codec, --music_mode, --mixdown and --normalize, and checks that each output lands under the size limit and uses
+# at least --min_ratio of it (or of what max_bitrate allows, for short clips). The worst overshoot and undershoot of every combination is reported, which shows where
+# bitrate_compensation_map, the audio maps and max_bitrate need tuning.
+#
+#   python benchmarks/size_accuracy.py --boards wsg --codecs libvpx-vp9 --durations 5,60,300 --jobs 4
+#   python benchmarks/size_accuracy.py --results size_accuracy.json   # The full matrix, this takes a long time
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import run_benchmarks
+from run_benchmarks import w4c
+
+source = 'noise_360p30_stereo_400s'
+default_durations = [1, 5, 15, 30, 60, 120, 180, 240, 300, 400] # Clipped to each board's max_duration
+mixdown_modes = ['auto', 'stereo', 'mono', 'same_as_source']
+
+# Every combination of the swept options. Boards without sound only get one audio configuration.
+def get_cells(boards : list, codecs : list, music_modes : list, mixdowns : list, normalize : list):
+    cells = []
+    for board, codec in itertools.product(boards, codecs):
+        if board == 'other':
+            cells.append({'board': board, 'codec': codec, 'music_mode': False, 'mixdown': 'auto', 'normalize': False})
+            continue
+        for music_mode, mixdown, norm in itertools.product(music_modes, mixdowns, normalize):
+            cells.append({'board': board, 'codec': codec, 'music_mode': music_mode, 'mixdown': mixdown, 'normalize': norm})
+    return cells
+
+def get_cell_name(cell : dict):
+    name = '{} {} mixdown={}'.format(cell['board'], cell['codec'], cell['mixdown'])
+    if cell['music_mode']:
+        name += ' music_mode'
+    if cell['normalize']:
+        name += ' normalize'
+    return name
+
+def get_durations(board : str, durations : list):
+    max_board_duration = w4c.max_duration[['wsg', 'gif', 'other'].index(board)]
+    return sorted(set(min(x, max_board_duration) for x in durations))
+
+def convert(work_dir : str, input_path : str, cell : dict, duration : float, extra_args : list):
+    case_args = [input_path, '-d', str(duration), '--board', cell['board'], '--codec', cell['codec'], '--mixdown', cell['mixdown']]
+    if cell['music_mode']:
+        case_args.append('--music_mode')
+    if cell['normalize']:
+        case_args.append('--normalize')
+    case_args.extend(extra_args)
+    parsed_args, unknown_args = w4c.build_argument_parser().parse_known_args(case_args)
+    output = os.path.join(work_dir, 'size_{}_{}_{}_{}_{}_{:g}s'.format(cell['board'], cell['codec'], int(cell['music_mode']), cell['mixdown'], int(cell['normalize']), duration))
+    # Each conversion gets its own directory, so that parallel runs don't share temp files
+    run_dir = output + '.run'
+    os.makedirs(run_dir, exist_ok=True)
+    cmd = [sys.executable, run_benchmarks.script] + case_args + ['-o', output, '-y', '--no_cache']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=run_dir)
+    shutil.rmtree(run_dir, ignore_errors=True)
+    output_file = None
+    for line in result.stdout.splitlines():
+        if line.startswith('output file: "'):
+            output_file = line[len('output file: "'):-1]
+    if result.returncode != 0 or output_file is None or not os.path.isfile(output_file):
+        return {'duration': duration, 'error': 'Conversion failed (exit code {})'.format(result.returncode), 'log': result.stdout[-2000:]}
+    size = os.path.getsize(output_file)
+    limit = w4c.get_size_limit(parsed_args)
+    os.remove(output_file)
+    # Short clips are held back by max_bitrate on purpose, this is the most they can use of the limit (audio aside)
+    capped_ratio = w4c.max_bitrate * 1000 / 8 * duration / limit
+    return {'duration': duration, 'size': size, 'limit': limit, 'ratio': round(size / limit, 4), 'capped_ratio': round(capped_ratio, 4)}
+
+# Whether a measurement is outside the band. Undershooting only counts if max_bitrate would have allowed a bigger file.
+def is_fail(measurement : dict, min_ratio : float, max_ratio : float):
+    if 'error' in measurement:
+        return True
+    if measurement['ratio'] > max_ratio:
+        return True
+    return measurement['ratio'] < min(min_ratio, measurement['capped_ratio'] * min_ratio)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check how close webm_for_4chan.py gets to the size limit over a matrix of settings')
+    parser.add_argument('--boards', type=str, default='wsg,gif,other', help='Comma separated boards (default: wsg,gif,other)')
+    parser.add_argument('--codecs', type=str, default='libvpx-vp9,libx264', help='Comma separated codecs (default: libvpx-vp9,libx264)')
+    parser.add_argument('--music_mode', type=str, default='both', choices=['on', 'off', 'both'], help='Sweep --music_mode (default: both)')
+    parser.add_argument('--mixdown', type=str, default=','.join(mixdown_modes), help='Comma separated mixdown modes (default: all)')
+    parser.add_argument('--normalize', type=str, default='both', choices=['on', 'off', 'both'], help='Sweep --normalize (default: both)')
+    parser.add_argument('--durations', type=str, default=','.join(str(x) for x in default_durations), help='Comma separated clip durations in seconds, clipped to the max duration of each board')
+    parser.add_argument('--min_ratio', type=float, default=0.92, help='Lowest acceptable output size, as a fraction of the size limit (default: 0.92)')
+    parser.add_argument('--max_ratio', type=float, default=1.0, help='Highest acceptable output size, as a fraction of the size limit (default: 1.0)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of conversions to run at the same time')
+    parser.add_argument('--work_dir', type=str, default=run_benchmarks.default_work_dir, help='Directory for generated inputs and outputs')
+    parser.add_argument('--results', type=str, help='Write every measurement to this JSON file')
+    parser.add_argument('--extra_args', type=str, default='', help='Extra arguments for every conversion, i.e. --extra_args="--fast"')
+    args = parser.parse_args()
+
+    on_off = {'on': [True], 'off': [False], 'both': [False, True]}
+    cells = get_cells(args.boards.split(','), args.codecs.split(','), on_off[args.music_mode], args.mixdown.split(','), on_off[args.normalize])
+    os.makedirs(args.work_dir, exist_ok=True)
+    input_path = run_benchmarks.generate_input(args.work_dir, source)
+    durations = [float(x) for x in args.durations.split(',')]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        futures = {(get_cell_name(cell), duration) : executor.submit(convert, args.work_dir, input_path, cell, duration, args.extra_args.split()) for cell in cells for duration in get_durations(cell['board'], durations)}
+        measurements = {get_cell_name(cell) : [] for cell in cells}
+        for (name, duration), future in futures.items():
+            measurement = future.result()
+            measurements[name].append(measurement)
+            if 'error' in measurement:
+                print('{} {:g}s: {}'.format(name, duration, measurement['error']))
+            else:
+                print('{} {:g}s: {:.1%}{}'.format(name, duration, measurement['ratio'], ' (max_bitrate allows {:.1%})'.format(measurement['capped_ratio']) if measurement['capped_ratio'] < 1.0 else ''))
+
+    print('')
+    print('{:<52}{:>8}{:>14}{:>15}{:>8}'.format('cell', 'runs', 'worst over', 'worst under', 'fails'))
+    total_fails = 0
+    for name, cell_measurements in measurements.items():
+        ok = [x for x in cell_measurements if 'error' not in x]
+        fails = len([x for x in cell_measurements if is_fail(x, args.min_ratio, args.max_ratio)])
+        total_fails += fails
+        worst_over = max(ok, key=lambda x: x['ratio'], default=None)
+        worst_under = min(ok, key=lambda x: x['ratio'], default=None)
+        def describe(x):
+            return '{:.1%} @{:g}s'.format(x['ratio'], x['duration']) if x is not None else '-'
+        print('{:<52}{:>8}{:>14}{:>15}{:>8}'.format(name, len(cell_measurements), describe(worst_over), describe(worst_under), fails))
+    if args.results is not None:
+        with open(args.results, 'w') as f:
+            json.dump({'min_ratio': args.min_ratio, 'max_ratio': args.max_ratio, 'extra_args': args.extra_args, 'measurements': measurements}, f, indent=2)
+    print('{} of {} conversions outside {:.0%}-{:.0%} of the size limit'.format(total_fails, sum(len(x) for x in measurements.values()), args.min_ratio, args.max_ratio))
+    return 1 if total_fails > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
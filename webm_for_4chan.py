@@ -7,18 +7,34 @@
 
 import argparse
 import bisect
+import concurrent.futures
+import contextlib
+import copy
 import datetime
 from enum import Enum
+import functools
+import hashlib
+import http.server
 import json
 import math
 import mimetypes
 import os
 import platform
+import queue
 import re
+import shlex
 import shutil
+import secrets
 import signal
+import socketserver
+import stat
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import traceback
+import urllib.parse
 from sys import exit
 
 ffmpeg_path = None # Edit this if you want to specify a custom path to ffmpeg
@@ -27,6 +43,10 @@ ffmpeg_exe = os.path.join(ffmpeg_path, 'ffmpeg') if ffmpeg_path else 'ffmpeg'
 ffprobe_exe = os.path.join(ffprobe_path, 'ffprobe') if ffprobe_path else 'ffprobe'
 ytdlp_path = None # Edit this if you want to specify a custom path to yt-dlp
 ytdlp_exe = os.path.join(ytdlp_path, 'yt-dlp') if ytdlp_path else 'yt-dlp'
+# The executables can also be swapped out through the environment, i.e. for the stand-ins in benchmarks/fake_tools
+ffmpeg_exe = os.environ.get('WEBM_FOR_4CHAN_FFMPEG', ffmpeg_exe)
+ffprobe_exe = os.environ.get('WEBM_FOR_4CHAN_FFPROBE', ffprobe_exe)
+ytdlp_exe = os.environ.get('WEBM_FOR_4CHAN_YTDLP', ytdlp_exe)
 max_bitrate = 2800 # (kbps) Cap bitrate in case the clip is really short. This is already an absurdly high rate.
 max_size = [6144 * 1024, 4096 * 1024] # 4chan size limits, in bytes [wsg, all other boards]
 max_duration = [399.92, 300, 120] # Maximum clip durations, in seconds [wsg, gif, all other boards]
@@ -45,11 +65,53 @@ resolution_fallback_map = { # This time-based lookup is used if smart resolution
     330.0: 576,
     400.0: 480
 }
+complexity_windows = 3 # Number of sampled windows trial encoded by the complexity probe (--resize_mode complexity)
+complexity_window_length = 2.0 # Length of each trial encoded window, in seconds
+complexity_resolutions = [640, 1280] # The complexity probe trial encodes at these resolutions and extrapolates to the rest of the resolution table
+complexity_crf = {'libvpx-vp9' : 36, 'libx264' : 27} # Trial encode quality, roughly the quality a well sized final encode should reach
+search_windows = 2 # Number of sampled windows encoded for each --search candidate
+search_window_length = 3.0 # Length of each --search sample, in seconds
+search_resolution_steps = 1 # --search tries this many resolution table steps above and below the calculated resolution
+search_fps_steps = 1 # --search tries this many fps candidates below the calculated fps
+search_workers = max(1, (os.cpu_count() or 2) // 2) # Number of --search sample encodes to run at the same time
+video_codecs = ['libvpx-vp9', 'libx264', 'vp9_vaapi', 'h264_nvenc'] # --codec choices
+hdr_filter = 'zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p' # --hdr tonemapping to the standard colorspace
+encode_workers = max(1, (os.cpu_count() or 2) // 4) # Number of --split parts or --boards/--codecs targets encoded at the same time, unless --workers is given
+race_candidates = { # --race encoders, as option overrides. vp9 is --deadline good at libvpx's default -cpu-used, higher -cpu-used is faster and rougher.
+    'vp9': {'codec': 'libvpx-vp9', 'deadline': 'good', 'cpu_used': None},
+    'vp9-cpu2': {'codec': 'libvpx-vp9', 'deadline': 'good', 'cpu_used': 2},
+    'vp9-cpu4': {'codec': 'libvpx-vp9', 'deadline': 'good', 'cpu_used': 4},
+    'vp9-best': {'codec': 'libvpx-vp9', 'deadline': 'best', 'cpu_used': None},
+    'x264': {'codec': 'libx264'},
+}
+race_default = ['vp9', 'vp9-cpu2', 'vp9-cpu4', 'x264'] # Encoders --race runs when it isn't given a list
+race_motion_classes = [(0.002, 'still'), (0.01, 'calm')] # --race content types: clips with a motion score below a limit get its name, anything else is 'busy'
+race_history_file = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'race.json') # --race remembers which encoder won on which kind of content here
+race_history_length = 5 # --race remembers this many winners per content type
+race_history_streak = 3 # Once one encoder won this many races in a row on a kind of content, --race skips straight to it
+vp9_min_tile_width = 256 # libvpx-vp9 tile columns are at least this many pixels wide, so narrow outputs can't use as many of them
+thread_profile_file = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'threads.json') # --calibrate stores the fastest thread and tile settings of each machine here
+calibration_heights = [360, 720, 1080] # --calibrate measures 16:9 clips of these heights...
+calibration_seconds = 2.0 # ...this many seconds long, at 30 fps
+stage_padding = 5.0 # (seconds) --stage copies this much more than the clip on either side, so that seeking into the copy finds a keyframe and the audio has its pre-roll
+split_snap_window = 15.0 # (seconds) --split moves a part boundary up to this far to put it on a scene cut or in a silence
+pipeline_cpu_slots = os.cpu_count() or 2 # Pipeline stages that run at the same time (analysis passes, probes, carbon copy next to the encode) share this many CPU slots
+progress_render_interval = 0.5 # Minimum number of seconds between progress line updates in the terminal
+stream_analysis_wait = 5.0 # --stream gives the analysis of the download this many seconds to catch up once the download is done, before it's stopped and the file is analyzed as usual
+serve_rejected_options = ['calibrate', 'metrics', 'output', 'progress_json', 'serve', 'stage_dir', 'trace', 'watch', 'ytdlp_args'] # Options that --serve jobs can't use: they write files where the client says, or run commands (yt-dlp --exec)
+serve_token = os.environ.get('WEBM_FOR_4CHAN_SERVE_TOKEN') # Token that --serve clients on HOST:PORT must send. A random one is made at startup if this isn't set.
+watch_poll_interval = 2.0 # --watch lists the directory this often, in seconds
+watch_settle_time = 5.0 # --watch converts a file once its size and modification time haven't changed for this many seconds, so files still being copied are left alone
+watch_extensions = ['.avi', '.flv', '.m4v', '.mkv', '.mov', '.mp4', '.mpeg', '.mpg', '.ts', '.webm', '.wmv'] # File types --watch converts
+watch_index_dir = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'watch') # --watch remembers which files it converted here, one index per watched directory
 fps_map = { # Map of clip duration to fps. Clip must be below the duration to fit into the fps cap
     150.0: 60.0,
     200.0: 30.0,
     400.0: 24.0
 }
+fps_candidates = [60.0, 30.0, 24.0] # Frame rate caps considered by motion-aware fps selection, highest first. The source frame rate is always considered.
+fps_min_bpp = 0.004 # Motion-aware fps selection: minimum bits per pixel per frame a static clip needs before the frame rate is reduced
+fps_motion_bpp = 0.25 # Motion-aware fps selection: additional bits per pixel needed per unit of motion score
 audio_map = { # Map of clip duration to audio bitrate. Very long clips benefit from audio bitrate reduction, but not ideal for music oriented webms. Use --music_mode to bypass.
     15.0: 128,
     30.0: 120,
@@ -85,11 +147,74 @@ bitrate_compensation_map = { # Automatic bitrate compensation, in kbps. This val
     380.0: 4,
     400.0: 6
 }
+decimate_threshold = 0.3 # Automatically drop duplicate frames (mpdecimate) if at least this fraction of sampled frames are duplicates
+analysis_windows = 5 # Number of evenly spaced windows sampled by the frame analysis pass
+analysis_window_length = 2.0 # Length of each sampled window, in seconds
+analysis_height = 180 # Frame analysis decodes at this height (or less) to save time
+silence_filter = 'silencedetect=n=-50dB:d=1.4' # --trim_silence looks for at least 1.4 seconds below -50 dB
+scene_threshold = 10.0 # scdet threshold (0-100) for --scene_keyframes. Lower values detect more scene cuts.
+min_keyframe_spacing = 1.0 # --scene_keyframes ignores scene cuts closer than this many seconds to the previous one (flashes, strobing)
+max_keyframe_interval = 10.0 # --scene_keyframes stretches the keyframe interval up to this many seconds when there are no scene cuts
+analysis_cache_file = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'analysis.json') # Analysis results are cached here so re-running the same clip skips the analysis
+max_analysis_cache_entries = 1000 # Only the most recent analysis results are kept
+max_memo_entries = 1000 # The in-memory probe results, audio renders and directory listings keep this many entries, so that --serve doesn't grow without bound
+analysis_cache = None # Loaded on first use
+analysis_cache_lock = threading.RLock() # --serve jobs share the analysis cache
+resume_jobs_dir = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'jobs') # --resume keeps the stage artifacts and manifests of unfinished jobs here, one directory per job
+result_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'results') # Finished outputs are kept here, so an identical job returns a copy instead of encoding again
+result_cache_quota = 1024 # (MiB) The result cache is trimmed to this size, least recently used results first. --cache_quota overrides this.
+content_hash_edge_size = 1024 * 1024 # The result cache hashes this many bytes at the start and at the end of the input...
+content_hash_samples = 16 # ...plus this many evenly spaced blocks in between...
+content_hash_block_size = 64 * 1024 # ...of this many bytes each. Smaller files are hashed whole.
+result_cache_ignored_options = ['boards', 'cache_quota', 'codecs', 'dry_run', 'input', 'keep_temp_files', 'metrics', 'mono', 'mp4', 'no_analysis_cache', 'no_cache', 'no_mixdown', 'output',
+                                'progress_json', 'race', 'race_budget', 'race_encoders', 'resume', 'serve', 'stage', 'stage_dir', 'stereo', 'stream', 'trace', 'workers', 'yes'] # Options that don't change the output, or that are folded into other options by resolve_option_aliases
+result_cache_lock = threading.Lock() # --serve jobs share the result cache
+download_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'webm-for-4chan', 'downloads') # yt-dlp downloads are kept here, one directory per URL, section and yt-dlp options
+download_cache_quota = 4096 # (MiB) The download cache is trimmed to this size, least recently used downloads first
+download_cache_lock = threading.Lock() # --serve jobs share the download cache
+stream_chunk_size = 1024 * 1024 # --stream reads the download in chunks of this many bytes
+ytdlp_default_output = '%(title)s [%(id)s].%(ext)s' # yt-dlp's output template when none is given, which names --stream downloads too
+download_url_ignored_params = ['feature', 'fbclid', 'gclid', 'si'] # Query parameters that don't change what a URL downloads (utm_* parameters are dropped too)
+resume_ignored_options = ['boards', 'codecs', 'dry_run', 'input', 'keep_temp_files', 'metrics', 'no_analysis_cache', 'output', 'progress_json', 'race', 'race_budget', 'race_encoders', 'resume', 'stage', 'stage_dir', 'stream', 'trace', 'yes'] # Options that don't change what a job renders, so they don't change its --resume job directory
 mixdown_stereo_threshold = 96 # Automatically mixdown to stereo if audio bitrate <= this value
 mixdown_mono_threshold = 64 # Automatically mixdown to mono if audio bitrate <= this value
 null_output = 'NUL' if platform.system() == 'Windows' else '/dev/null' # For pass 1 and certain preprocessing steps, need to output to appropriate null depending on system
 
-files_to_clean = [] # List of temp files to be cleaned up at the end
+# Per-job state. In --serve mode each job runs on its own thread, so anything a job changes lives here instead of in module globals.
+class JobState(threading.local):
+    def __init__(self):
+        self.reset()
+
+    # Restore the defaults before a worker thread starts its next job
+    def reset(self):
+        self.files_to_clean = [] # List of temp files to be cleaned up at the end
+        self.do_cleanup = True # Disabled with --keep_temp_files
+        self.use_analysis_cache = True # Disabled with --no_analysis_cache
+        self.interactive = True # Jobs submitted to --serve can't answer prompts
+        self.output = None # Where the job's printed output goes in --serve mode
+        self.progress_json = None # --progress_json destination, '-' for stdout
+        self.progress_listener = None # Receives progress events in --serve mode
+        self.trace = None # TraceRecorder if --trace is given
+        self.stages = [] # Stack of the pipeline stages (@traced functions) currently running
+        self.process_usage = [] # Resource usage of every child process, see wait_process
+        self.reserved_outputs = [] # Empty placeholders reserving output file names, see reserve_output
+        self.job_dir = None # --resume job directory, see get_job_dir
+        self.cancel = None # threading.Event that stops the job's ffmpeg encodes when set, see race_video
+        self.concurrent_encodes = 1 # Number of encodes sharing the CPU cores with this job's, see get_thread_args
+job_state = JobState()
+reserved_temp_filenames = set() # Temp file names handed out by get_temp_filename, so that concurrent jobs don't pick the same one
+temp_filename_lock = threading.Lock()
+output_name_index = dict() # Directory -> (mtime, file names), so that automatic output naming doesn't stat every _N_ candidate
+probe_cache = dict() # ffprobe results, keyed by function, input fingerprint and arguments
+probe_cache_lock = threading.Lock()
+audio_renders = dict() # calculate_audio_size results, so that --boards/--codecs targets (and --serve jobs) with the same audio render it once
+audio_renders_lock = threading.Lock()
+race_history_lock = threading.Lock()
+running_job_states = dict() # Thread id -> job_state.__dict__ of each --serve and --watch job, so that an interrupt can clean up after the jobs of every worker thread
+running_job_states_lock = threading.Lock()
+installed_stdout_router = None # The StdoutRouter that routed_stdout installed for the running pipelines
+stdout_router_users = 0 # Pipelines running with it
+stdout_router_lock = threading.Lock()
 
 # Determine size limit in bytes
 def get_size_limit(args):
@@ -104,22 +229,221 @@ def get_temp_filename(extension : str):
     basename = 'temp'
     filename = '{}.{}'.format(basename,extension)
     x = 0
-    while os.path.isfile(filename):
-        x += 1
-        filename = '{}.{}.{}'.format(basename,x,extension)
+    with temp_filename_lock:
+        while os.path.isfile(filename) or filename in reserved_temp_filenames:
+            x += 1
+            filename = '{}.{}.{}'.format(basename,x,extension)
+        reserved_temp_filenames.add(filename)
     return filename
 
+# Store a result in one of the in-memory memos, dropping the oldest entries past max_memo_entries. Call it with the memo's lock held.
+def store_memo(memo : dict, key, value):
+    memo.pop(key, None)
+    memo[key] = value
+    while len(memo) > max_memo_entries:
+        del memo[next(iter(memo))]
+
+# Memoize an ffprobe helper whose first argument is the input file name.
+# Results are keyed by the input's fingerprint, so they stay valid as long as the file doesn't change.
+# This mostly pays off in --serve mode, where the cache stays warm across jobs.
+def cached_probe(func):
+    def wrapper(input_filename, *args):
+        key = (func.__name__, get_input_fingerprint(input_filename), args)
+        with probe_cache_lock:
+            if key in probe_cache:
+                return probe_cache[key]
+        result = func(input_filename, *args)
+        with probe_cache_lock:
+            store_memo(probe_cache, key, result)
+        return result
+    return wrapper
+
+# Wrap func so that it runs with the calling thread's job state (output routing, trace, cache flags). Needed for anything handed to another thread.
+def bind_job_state(func):
+    state = job_state.__dict__.copy()
+    state['stages'] = list(job_state.stages) # The stage stack is per thread, the rest is shared with the job
+    def wrapper(*args, **kwargs):
+        job_state.__dict__.update(state)
+        return func(*args, **kwargs)
+    return wrapper
+
+# Collects spans for --trace and writes them in Chrome trace event format, which opens in Perfetto or chrome://tracing
+class TraceRecorder:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.thread_names = dict() # Thread names are recorded as spans come in, pool threads are gone by the time the trace is written
+
+    def add(self, name : str, category : str, start : float, end : float, args : dict):
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': round((start - self.origin) * 1000000), 'dur': round((end - start) * 1000000),
+                 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+        with self.lock:
+            self.events.append(event)
+            self.thread_names[event['tid']] = threading.current_thread().name
+
+    def write(self, filename : str):
+        with self.lock:
+            events = list(self.events)
+            # Name the thread tracks, so that parallel trial encodes are easy to tell apart from the main pipeline
+            for tid, name in self.thread_names.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+class TraceSpan:
+    def __init__(self, recorder : TraceRecorder, name : str, category : str, args : dict):
+        self.recorder = recorder
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is not None:
+            self.args['error'] = '{}: {}'.format(exc_type.__name__, exc_value)
+        self.recorder.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+no_trace_span = contextlib.nullcontext() # Shared do-nothing span for when --trace is off
+
+# Record a span for the enclosed block if --trace is on. The span's args can be extended inside the block (if tracing is on).
+def trace_span(name : str, category = 'stage', **args):
+    if job_state.trace is None:
+        return no_trace_span
+    return TraceSpan(job_state.trace, name, category, args)
+
+# Decorator for pipeline stages. Child processes started inside are accounted to the stage (named after the function),
+# and a span is recorded for every call if --trace is on.
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job_state.stages.append(func.__name__)
+        try:
+            if job_state.trace is None:
+                return func(*args, **kwargs)
+            with TraceSpan(job_state.trace, func.__name__, 'stage', dict()):
+                return func(*args, **kwargs)
+        finally:
+            job_state.stages.pop()
+    return wrapper
+
+# Read the I/O counters of a process that has exited but hasn't been reaped yet (Linux only).
+# rchar and wchar count everything read and written, including pipes and cached files.
+def read_process_io(pid : int):
+    counters = dict()
+    with open('/proc/{}/io'.format(pid), 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            counters[key.strip()] = int(value)
+    return counters.get('rchar'), counters.get('wchar')
+
+# Wait for a child process and record its resource usage in job_state.process_usage: wall time, CPU time (user and sys), peak RSS,
+# and bytes read and written. CPU and memory come from os.wait4, so they're only available on Unix. Returns the exit code.
+def wait_process(pope : subprocess.Popen, cmd : list, started : float):
+    usage = {'stage': job_state.stages[-1] if len(job_state.stages) > 0 else 'main', 'command': os.path.basename(cmd[0]),
+             'wall': None, 'user': None, 'sys': None, 'max_rss_kb': None, 'read_bytes': None, 'write_bytes': None, 'exit_code': None}
+    if hasattr(os, 'wait4'):
+        if hasattr(os, 'waitid') and os.path.isfile('/proc/{}/io'.format(pope.pid)):
+            try:
+                os.waitid(os.P_PID, pope.pid, os.WEXITED | os.WNOWAIT) # Wait for the exit without reaping, so that /proc/<pid>/io is still there
+                usage['read_bytes'], usage['write_bytes'] = read_process_io(pope.pid)
+            except (OSError, ValueError):
+                pass
+        _, status, rusage = os.wait4(pope.pid, 0)
+        pope.returncode = os.waitstatus_to_exitcode(status)
+        usage['user'] = rusage.ru_utime
+        usage['sys'] = rusage.ru_stime
+        usage['max_rss_kb'] = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss # macOS reports bytes, Linux reports KiB
+    else:
+        pope.wait()
+    usage['wall'] = time.perf_counter() - started
+    usage['exit_code'] = pope.returncode
+    job_state.process_usage.append(usage)
+    return pope.returncode
+
+# Stand-in for subprocess.run that goes through wait_process, so that every child's resource usage is recorded
+def run_child(cmd : list, **kwargs):
+    started = time.perf_counter()
+    pope = subprocess.Popen(cmd, **kwargs)
+    output = {'stdout': None, 'stderr': None}
+    def read_pipe(name, pipe):
+        output[name] = pipe.read()
+        pipe.close()
+    # Read stderr on a separate thread so that neither pipe can fill up and stall the child
+    stderr_thread = threading.Thread(target=read_pipe, args=('stderr', pope.stderr), daemon=True) if pope.stderr is not None else None
+    if stderr_thread is not None:
+        stderr_thread.start()
+    if pope.stdout is not None:
+        read_pipe('stdout', pope.stdout)
+    if stderr_thread is not None:
+        stderr_thread.join()
+    wait_process(pope, cmd, started)
+    return subprocess.CompletedProcess(cmd, pope.returncode, output['stdout'], output['stderr'])
+
+# subprocess.run, with resource accounting and a span for the command and its exit code if --trace is on
+def run_subprocess(cmd : list, **kwargs):
+    if job_state.trace is None:
+        return run_child(cmd, **kwargs)
+    with TraceSpan(job_state.trace, os.path.basename(cmd[0]), 'subprocess', {'command': ' '.join(str(x) for x in cmd)}) as span:
+        result = run_child(cmd, **kwargs)
+        span.args['exit_code'] = result.returncode
+    return result
+
+# Print the child process resource usage per stage, and append one line per child process to the --metrics file if given
+def report_process_usage(usage : list, output, metrics_file):
+    if len(usage) == 0:
+        return
+    stages = dict()
+    for x in usage:
+        total = stages.setdefault(x['stage'], {'count': 0, 'wall': 0.0, 'user': None, 'sys': None, 'max_rss_kb': None, 'read_bytes': None, 'write_bytes': None})
+        total['count'] += 1
+        total['wall'] += x['wall']
+        for key in ['user', 'sys', 'read_bytes', 'write_bytes']:
+            if x[key] is not None:
+                total[key] = (total[key] or 0) + x[key]
+        if x['max_rss_kb'] is not None:
+            total['max_rss_kb'] = max(total['max_rss_kb'] or 0, x['max_rss_kb'])
+    def column(value, scale = 1.0):
+        return '{:.1f}'.format(value / scale) if value is not None else '-'
+    print('Child process usage by stage:')
+    print('{:<32}{:>6}{:>9}{:>9}{:>9}{:>10}{:>10}{:>10}'.format('stage', 'procs', 'wall s', 'user s', 'sys s', 'peak MiB', 'read MiB', 'write MiB'))
+    for stage, total in stages.items():
+        print('{:<32}{:>6}{:>9}{:>9}{:>9}{:>10}{:>10}{:>10}'.format(stage, total['count'], column(total['wall']), column(total['user']), column(total['sys']),
+                                                                   column(total['max_rss_kb'], 1024), column(total['read_bytes'], 1048576), column(total['write_bytes'], 1048576)))
+    if metrics_file is not None:
+        try:
+            timestamp = datetime.datetime.now().isoformat(timespec='seconds')
+            with open(metrics_file, 'a') as f:
+                for x in usage:
+                    f.write(json.dumps(dict(x, time=timestamp, output=output)) + '\n')
+        except OSError as e:
+            print('Warning: Could not write metrics: {}'.format(e))
+
 
 # This is only called if you don't specify a duration or end time. Uses ffprobe to find out how long the input is.
+@cached_probe
 def get_video_duration(input_filename, start_time : float):
     mime, subtype = mimetypes.guess_type(input_filename)[0].split('/')
     if mime != 'video' and mime != 'audio':
         raise RuntimeError(f"Unsupported mime type '{mime}/{subtype}' for input file '{input_filename}'")
     # https://superuser.com/questions/650291/how-to-get-video-duration-in-seconds
-    result = subprocess.run([ffprobe_exe,"-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", input_filename], stdout=subprocess.PIPE, text=True)
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", input_filename], stdout=subprocess.PIPE, text=True)
     duration_seconds = float(result.stdout)
     return datetime.timedelta(seconds=duration_seconds - start_time)
 
+# The container start time of a file in seconds, which input -ss counts from. 0.0 if ffprobe doesn't know it.
+@cached_probe
+def get_start_time(input_filename):
+    result = run_subprocess([ffprobe_exe, "-v", "error", "-show_entries", "format=start_time", "-of", "default=noprint_wrappers=1:nokey=1", input_filename], stdout=subprocess.PIPE, text=True)
+    try:
+        return float(result.stdout)
+    except ValueError:
+        return 0.0
+
 # Format a timedelta into hh:mm:ss.ms
 def format_timedelta(ts : datetime.timedelta):
     hours, rm_hr = divmod(ts.total_seconds(), 3600)
@@ -138,21 +462,314 @@ def format_timedelta(ts : datetime.timedelta):
 def is_url(arg : str) -> bool:
     return re.match(r'^(?:https?://)?(?:www\.)?[-A-Za-z0-9@:%._\+~#=]{1,256}\.[A-Za-z]{2,63}\b(?:[-A-Za-z0-9@:%_\+.~#?&//=]*)$', arg) is not None
 
-def download_video(url : str, args) -> str:
+# Returns the downloaded file name (None on failure) and a copy of args, with the clip window and segments adjusted to the downloaded section
+@traced
+def download_video(url : str, args):
+    args = copy.copy(args)
     print(f'Attempting to download {url}')
-    ytdl_cmd = [ytdlp_exe, url]
+    ytdl_options = []
     if args.auto_subs: # This should result in embedding subs into the video, so --auto_subs will pick up and use the first sub track
-        ytdl_cmd.extend(['--embed-subs', '--write-automatic-subs'])
+        ytdl_options.extend(['--embed-subs', '--write-automatic-subs'])
     if args.ytdlp_args is not None: # Add custom command-line args
-        ytdl_cmd.extend(args.ytdlp_args.split())
+        ytdl_options.extend(args.ytdlp_args.split())
     # Need to know whether or not to download only segments
     start = parsetime(args.start)
     seg_end = None
     if (not args.download_full) and (args.concat is not None or args.cut is not None):
-        # cut and concat segments potentially need to be modified to match 
         segments = parse_segments(start, args.concat if args.concat is not None else args.cut, do_print=False)
         if args.concat is not None and len(segments) == 1:
             start, seg_end = segments[0]
+    end = seg_end.total_seconds() if seg_end is not None else parsetime(args.end).total_seconds() if args.end is not None else (start + parsetime(args.duration)).total_seconds() if args.duration is not None else 'inf'
+    section = None
+    if (not args.download_full) and (start.total_seconds() > 0.0 or (end != 'inf')):
+        section = [start.total_seconds(), end]
+
+    # A cached download of the whole video covers any clip of it, and the clip is then cut from it like with --download_full
+    if not args.no_cache:
+        cached = get_cached_download(url, None, ytdl_options)
+        if cached is not None and (section is None or cached['duration'] is None or section[1] == 'inf' or section[1] <= cached['duration']):
+            print('Using the cached download of the full video')
+            return link_download(cached['filepath'], os.path.basename(cached['filepath'])), args
+        if section is not None:
+            cached = get_cached_download(url, section, ytdl_options)
+            if cached is not None:
+                print('Using the cached download of this section')
+                return link_download(cached['filepath'], get_section_filename(cached['filepath'], section)), get_section_args(args, start)
+
+    ytdl_cmd = [ytdlp_exe, url] + ytdl_options
+    if section is not None:
+        ytdl_cmd.extend(['--force-keyframes-at-cuts', '--download-sections', f'*{section[0]}-{section[1]}'])
+        if section[0] == 0.0: # Optimization for clips that start at the beginning of the video.
+            ytdl_cmd.extend(['--downloader-args', 'ffmpeg:-c:v copy -c:a copy'])
+        else:
+            ytdl_cmd.extend(['--downloader-args', 'ffmpeg:-crf 20 -b:a 256k']) # Note: most youtube audio is 128k and can be up to 256k
+    entry_dir = None
+    if not args.no_cache:
+        entry_dir = get_download_cache_dir(url, section, ytdl_options)
+        os.makedirs(entry_dir, exist_ok=True)
+    job_args = get_section_args(args, start) if section is not None else args
+    analysis = None
+    if args.stream and args.auto_subs:
+        print('Subtitles can only be embedded after the download, so it is not streamed')
+    if args.stream and not args.auto_subs:
+        result_filename, analysis = stream_download(ytdl_cmd, entry_dir, job_args)
+        if result_filename is None:
+            return None, args
+    else:
+        if entry_dir is not None:
+            ytdl_cmd.extend(['-P', entry_dir, '--write-info-json'])
+        # One run that downloads and then writes where the file ended up, which is not always the name the extractor first comes up with
+        # (yt-dlp can fall back to another container). It goes to a file of its own, where no other output (i.e. from --exec) can get mixed in.
+        fd, filepath_file = tempfile.mkstemp(prefix='webm-for-4chan-', suffix='.filepath')
+        os.close(fd)
+        download_cmd = ytdl_cmd + ['--print-to-file', 'after_move:%(filepath)s', filepath_file, '--newline']
+        print(' '.join(download_cmd))
+        try:
+            with trace_span('yt-dlp', 'subprocess', command=' '.join(download_cmd)):
+                started = time.perf_counter()
+                pope = subprocess.Popen(download_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, encoding='utf-8', errors='ignore')
+                for line in iter(pope.stdout.readline, ""):
+                    if '[download]' in line and '%' in line:
+                        print('\r' + line.strip(), end='')
+                    else:
+                        print(line, end='')
+                pope.stdout.close()
+                wait_process(pope, download_cmd, started)
+            with open(filepath_file, 'r', encoding='utf-8') as f:
+                filepaths = [x.rstrip('\r\n') for x in f if x.strip() != '']
+        finally:
+            os.remove(filepath_file)
+        print('')
+        if pope.returncode != 0:
+            print('yt-dlp returned error code {}'.format(pope.returncode))
+            return None, args
+        result_filename = filepaths[-1] if len(filepaths) > 0 else find_downloaded_file(ytdl_cmd, args)
+        if result_filename is None or not os.path.isfile(result_filename):
+            print("yt-dlp didn't report the file it downloaded")
+            return None, args
+    print(f'Downloaded "{result_filename}"')
+    if entry_dir is not None and os.path.samefile(os.path.dirname(os.path.abspath(result_filename)), entry_dir):
+        store_cached_download(entry_dir, url, section, result_filename)
+        result_filename = link_download(result_filename, os.path.basename(result_filename) if section is None else get_section_filename(result_filename, section))
+    else: # Not cached, the file stays where yt-dlp put it, named like a cached download would be
+        if section is not None:
+            section_filename = os.path.join(os.path.dirname(result_filename), get_section_filename(result_filename, section))
+            os.replace(result_filename, section_filename)
+            result_filename = section_filename
+        if os.path.samefile(os.path.dirname(os.path.abspath(result_filename)), os.getcwd()):
+            result_filename = os.path.basename(result_filename)
+    if analysis is not None:
+        analysis.store(result_filename) # The cache keys are made from the file the job is going to read
+    return result_filename, job_args
+
+# Find a finished download that yt-dlp didn't report (i.e. a yt-dlp too old for --print-to-file) under the name it predicts with -j.
+# yt-dlp can fall back to another container than the one it predicted, and a file with the same name and another extension is only taken with --use_fallback.
+def find_downloaded_file(ytdl_cmd : list, args):
+    result = run_subprocess(ytdl_cmd + ['-j'], stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(result.stdout)
+        return None
+    result_filename = json.loads(result.stdout.splitlines()[-1])['filename']
+    if os.path.isfile(result_filename):
+        return result_filename
+    video_exts = ['.mp4', '.mkv', '.mov', '.avi', '.wmv', '.flv', '.webm', '.mpeg', '.mpg', '.m4v']
+    directory = os.path.dirname(result_filename) or os.getcwd()
+    base, _ = os.path.splitext(os.path.basename(result_filename))
+    found = None
+    for fname in os.listdir(directory):
+        fbase, fext = os.path.splitext(fname)
+        if fbase == base and fext.lower() in video_exts:
+            found = os.path.join(directory, fname)
+            break
+    if found is None:
+        return None
+    if not args.use_fallback:
+        raise FileNotFoundError(f'File "{result_filename}" not found, but similar file with extension "{os.path.splitext(found)[-1]}" exists.'\
+                                '\nThis is likely due to yt-dlp falling back to an alternate video type from the initial query.'\
+                                '\nIf this persists, consider adjusting your yt-dlp settings, as you may be failing JS challenges or getting denied the highest available quality options.'\
+                                '\nThe file has already been downloaded, so you may rerun webm-for-4chan by specifying the local file name instead of the url.'\
+                                "\nIf you wish to avoid this error in the future and proceed with the similar file name automatically, specify the '--use_fallback' option.")
+    return found
+
+# The output template in yt-dlp options, or yt-dlp's default. Templates for other kinds of files (-o "thumbnail:...") are skipped.
+def get_ytdlp_output_template(ytdl_cmd : list):
+    template = ytdlp_default_output if '--restrict-filenames' not in ytdl_cmd else ytdlp_default_output.replace(' ', '-')
+    for idx, arg in enumerate(ytdl_cmd):
+        value = None
+        if arg in ['-o', '--output'] and idx + 1 < len(ytdl_cmd):
+            value = ytdl_cmd[idx + 1]
+        elif arg.startswith('--output='):
+            value = arg[len('--output='):]
+        elif arg.startswith('-o') and not arg.startswith('--') and len(arg) > 2:
+            value = arg[2:]
+        if value is not None and re.match(r'[a-z_]{2,}:', value) is None:
+            template = value
+    return template
+
+# Download with yt-dlp writing to stdout (--stream), so that the analysis the job needs can read the file while it's still coming in.
+# The file is written to directory (the download cache entry, or the working directory without the cache) under a hidden name,
+# and gets the name yt-dlp would have given it when it's done. Returns the file name, or None if the download failed, and the StreamAnalysis if one ran.
+def stream_download(ytdl_cmd : list, directory, args):
+    directory = directory or '.'
+    tag = '{}-{}'.format(os.getpid(), threading.get_ident())
+    partial = os.path.join(directory, '.stream.{}.part'.format(tag))
+    job_state.files_to_clean.append(partial)
+    # With -o - yt-dlp prefers formats that don't need merging, which are often low resolution. Ask for what a normal download gets,
+    # yt-dlp merges the video and audio to stdout with ffmpeg.
+    if not any(x in ['-f', '--format'] or x.startswith('--format=') or (x.startswith('-f') and not x.startswith('--')) for x in ytdl_cmd[2:]):
+        ytdl_cmd = ytdl_cmd + ['-f', 'bv*+ba/b']
+    # Once it has picked the format, before the download starts, yt-dlp writes the metadata to a file named with the output template,
+    # which it expands and sanitizes like the name of a download. That file, in a directory of its own, is where the name comes from.
+    template = get_ytdlp_output_template(ytdl_cmd)
+    drive, template_path = os.path.splitdrive(template)
+    info_dir = tempfile.mkdtemp(prefix='webm-for-4chan-')
+    ytdl_cmd = ytdl_cmd + ['-o', '-', '--print-to-file', 'before_dl:%(.{id,title,ext,duration})j', info_dir.replace('%', '%%') + os.sep + template_path.lstrip('/' + os.sep)]
+    print(' '.join(ytdl_cmd))
+    with open(partial, 'wb'):
+        pass
+    analysis = start_stream_analysis(partial, args)
+    with trace_span('yt-dlp', 'subprocess', command=' '.join(ytdl_cmd)):
+        started = time.perf_counter()
+        pope = subprocess.Popen(ytdl_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        def print_progress():
+            for line in iter(pope.stderr.readline, b''):
+                line = line.decode('utf-8', errors='ignore')
+                if '[download]' in line and '%' in line:
+                    print('\r' + line.strip(), end='')
+                else:
+                    print(line, end='')
+            pope.stderr.close()
+        progress_thread = threading.Thread(target=print_progress, daemon=True)
+        progress_thread.start()
+        with open(partial, 'ab') as f:
+            for chunk in iter(lambda: pope.stdout.read1(stream_chunk_size), b''):
+                f.write(chunk)
+                f.flush() # Make it visible to the analysis
+        pope.stdout.close()
+        progress_thread.join()
+        wait_process(pope, ytdl_cmd, started)
+    print('')
+    if analysis is not None and not analysis.finish(pope.returncode == 0):
+        analysis = None
+    try:
+        info_files = [os.path.join(root, x) for root, _, names in os.walk(info_dir) for x in names]
+        if pope.returncode != 0 or len(info_files) == 0 or os.path.getsize(partial) == 0:
+            print('yt-dlp returned error code {}'.format(pope.returncode))
+            return None, None
+        # An absolute template ignores the download directory, like it does in yt-dlp
+        filename = os.path.normpath(os.path.join(drive + os.sep if os.path.isabs(template) else directory, os.path.relpath(info_files[0], info_dir)))
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True) # The template can have directories
+        os.replace(partial, filename)
+        shutil.move(info_files[0], os.path.splitext(filename)[0] + '.info.json')
+    finally:
+        shutil.rmtree(info_dir, ignore_errors=True)
+    return filename, analysis
+
+# Start a StreamAnalysis of a download if the job is going to run an analysis of the whole file that it can take over.
+# The frame analysis is only taken over if nothing moves the clip window or changes the input before it runs.
+def start_stream_analysis(filename : str, args):
+    if args.no_analysis_cache or parsetime(args.start).total_seconds() != 0.0 or args.end is not None or args.duration is not None:
+        return None
+    frames = args.scene_keyframes or args.decimate == DecimateMode.auto or (args.fps is None and args.fps_calc == FpsCalcMode.motion)
+    if args.cut is not None or args.concat is not None or args.first_second_every_minute or args.blackframe or args.trim_silence is not None:
+        frames = False
+    silence = args.trim_silence is not None
+    if not frames and not silence:
+        return None
+    return StreamAnalysis(filename, frames, silence)
+
+# The frame analysis (with scene detection) and silencedetect of a download, run by one ffmpeg that reads the file as it's being downloaded.
+# The results go into the analysis cache under the keys that analyze_frames and silencedetect look up for the whole file.
+class StreamAnalysis:
+    def __init__(self, filename : str, frames : bool, silence : bool):
+        self.filename = filename
+        self.frames = frames
+        self.silence = silence
+        self.done = threading.Event() # Set when the download is complete
+        self.output = ''
+        self.cmd = [ffmpeg_exe, '-hide_banner', '-i', 'pipe:0']
+        if frames:
+            self.cmd.extend(['-map', '0:v:0', '-vf', get_frame_analysis_filter(True), '-f', 'null', null_output])
+        if silence:
+            self.cmd.extend(['-map', '0:a:0', '-af', silence_filter, '-f', 'null', null_output])
+        self.cmd.extend(['-v', 'info'])
+        print('Analyzing the download as it comes in')
+        self.started = time.perf_counter()
+        self.pope = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.feeder.start()
+        self.reader.start()
+        self.analysis = None
+        self.silence_segments = None
+
+    # Follow the growing file into ffmpeg's stdin until the download is done and everything has been read
+    def feed(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                while True:
+                    finished = self.done.is_set()
+                    chunk = f.read(stream_chunk_size)
+                    if len(chunk) > 0:
+                        self.pope.stdin.write(chunk)
+                    elif finished:
+                        break
+                    else:
+                        time.sleep(0.1)
+        except (OSError, ValueError): # ffmpeg exited early or was stopped
+            pass
+        finally:
+            try:
+                self.pope.stdin.close()
+            except OSError:
+                pass
+
+    def read(self):
+        self.output = self.pope.stderr.read().decode(errors='ignore')
+        self.pope.stderr.close()
+
+    # The download is over. Give the analysis stream_analysis_wait seconds to catch up, then parse it. Returns False if there's nothing to use,
+    # in which case the job runs its own analysis.
+    def finish(self, downloaded : bool):
+        self.done.set()
+        if not downloaded:
+            self.pope.kill()
+        self.reader.join(stream_analysis_wait)
+        if self.reader.is_alive():
+            print('The analysis of the download is behind, the file will be analyzed after all')
+            self.pope.kill()
+            self.reader.join()
+        self.feeder.join()
+        if wait_process(self.pope, self.cmd, self.started) != 0 or not downloaded:
+            return False
+        if self.frames:
+            analysis = {'frames' : 0, 'kept' : 0, 'seconds' : 0.0, 'motion' : 0.0, 'cuts' : []}
+            scene_scores = []
+            parse_frame_analysis(self.output, analysis, scene_scores)
+            if analysis['frames'] > 0:
+                analysis['motion'] = sum(scene_scores) / len(scene_scores) if len(scene_scores) > 0 else 0.0
+                self.analysis = analysis
+        if self.silence:
+            self.silence_segments = self.output.splitlines()
+        return self.analysis is not None or self.silence_segments is not None
+
+    # Cache the results for filename, the finished download
+    def store(self, filename : str):
+        start = datetime.timedelta(0)
+        duration = get_video_duration(filename, 0.0)
+        if self.analysis is not None:
+            self.analysis['seconds'] = duration.total_seconds()
+            store_cached_analysis(get_analysis_cache_key('frames_full', filename, start, duration, analysis_height, scene_threshold), self.analysis)
+        if self.silence_segments is not None:
+            silence_segments = parse_silence(self.silence_segments, start, duration)
+            store_cached_analysis(get_analysis_cache_key('silence', filename, start, duration, silence_filter), [(x.total_seconds(), y.total_seconds()) for x, y in silence_segments])
+
+# The clip window and segments of a job whose input is a downloaded section, which starts at 0
+def get_section_args(args, start : datetime.timedelta):
+    args = copy.copy(args)
+    if args.concat is not None or args.cut is not None:
+        segments = parse_segments(start, args.concat if args.concat is not None else args.cut, do_print=False)
+        if args.concat is not None and len(segments) == 1:
             args.concat = None # Erase processed concat segment so that it doesn't mess up video conversion
         elif start.total_seconds() > 0.0:
             # The segment is passed in as an absolute timestamp, but downloading a chunk messes up
@@ -162,59 +779,76 @@ def download_video(url : str, args) -> str:
                 args.concat = new_segments
             elif args.cut is not None:
                 args.cut = new_segments
-    end = seg_end.total_seconds() if seg_end is not None else parsetime(args.end).total_seconds() if args.end is not None else (start + parsetime(args.duration)).total_seconds() if args.duration is not None else 'inf'
-    if (not args.download_full) and (start.total_seconds() > 0.0 or (end != 'inf')):
-        ytdl_cmd.extend(['--force-keyframes-at-cuts', '--download-sections', f'*{start.total_seconds()}-{end}'])
-        if start.total_seconds() == 0.0: # Optimization for clips that start at the beginning of the video.
-            ytdl_cmd.extend(['--downloader-args', 'ffmpeg:-c:v copy -c:a copy']) 
-        else:
-            ytdl_cmd.extend(['--downloader-args', 'ffmpeg:-crf 20 -b:a 256k']) # Note: most youtube audio is 128k and can be up to 256k
-        # Reset the passed-in start and duration arguments so that the full video is post-processed
-        args.start = '0.0'
-        args.end = None
-        args.duration = None
-    print(' '.join(ytdl_cmd))
-    ytdl_cmd1 = ytdl_cmd.copy()
-    ytdl_cmd1.extend([ '-j'])
-    # The first one is a simulated run just to get the prospective filename
-    result = subprocess.run(ytdl_cmd1, stdout=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(result.stdout)
-        print('yt-dlp returned error code {}'.format(result.returncode))
+    # Reset the passed-in start and duration arguments so that the full video is post-processed
+    args.start = '0.0'
+    args.end = None
+    args.duration = None
+    return args
+
+# Compare URLs the way they download: no fragment, no tracking parameters, sorted query, no www.
+def normalize_url(url : str):
+    parts = urllib.parse.urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[len('www.'):]
+    path = parts.path.rstrip('/')
+    query = [(key, value) for key, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if key not in download_url_ignored_params and not key.startswith('utm_')]
+    if host == 'youtu.be': # Short links
+        host, path, query = 'youtube.com', '/watch', [('v', path.lstrip('/'))] + query
+    return urllib.parse.urlunsplit((parts.scheme.lower(), host, path, urllib.parse.urlencode(sorted(query)), ''))
+
+# Download cache entry for a URL, section ([start, end] in seconds, None for the whole video) and the extra yt-dlp options, which include the format selection
+def get_download_cache_dir(url : str, section, ytdl_options : list):
+    return os.path.join(download_cache_dir, hash_json([normalize_url(url), section, ytdl_options])[:16])
+
+# A finished download from the cache as {'filepath', 'duration'}, or None. duration comes from yt-dlp's info JSON and may be None.
+# Marks the entry as recently used.
+def get_cached_download(url : str, section, ytdl_options : list):
+    entry_dir = get_download_cache_dir(url, section, ytdl_options)
+    try:
+        with open(os.path.join(entry_dir, 'entry.json'), 'r') as f:
+            entry = json.load(f)
+        filepath = os.path.join(entry_dir, entry['filename'])
+        if os.path.getsize(filepath) != entry['size']:
+            return None
+        os.utime(entry_dir) # The modification time is the last use, for LRU eviction
+    except (OSError, ValueError, KeyError):
         return None
-    # Outputs the frame rate as a precise fraction. Have to convert to decimal.
-    result_json = json.loads(result.stdout)
-    result_filename = result_json['filename']
-    print(f'Downloading to "{result_filename}"')
-    if os.path.isfile(result_filename):
-        print('File already found. Skipping download.')
-    else:
-        pope = subprocess.Popen(ytdl_cmd, stdout=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        for line in iter(pope.stdout.readline, ""):
-            if '[download]' in line and '%' in line:
-                print('\r' + line.strip(), end='')
-            else:
-                print(line, end='')
-        # Sometimes yt-dlp's actual download can mismatch the initial query
-        if not os.path.isfile(result_filename):
-            video_exts = ['.mp4', '.mkv', '.mov', '.avi', '.wmv', '.flv', '.webm', '.mpeg', '.mpg', '.m4v']
-            base, _ = os.path.splitext(os.path.basename(result_filename))
-            found = None
-            for fname in os.listdir(os.getcwd()):
-                fbase, fext = os.path.splitext(fname)
-                if fbase == base and fext.lower() in video_exts:
-                    found = os.path.join(os.getcwd(), fname)
-                    break
-            if found:
-                if args.use_fallback:
-                    result_filename = found
-                else:
-                    raise FileNotFoundError(f'File "{result_filename}" not found, but similar file with extension "{os.path.splitext(os.path.basename(found))[-1]}" exists.'\
-                                            '\nThis is likely due to yt-dlp falling back to an alternate video type from the initial query.'\
-                                            '\nIf this persists, consider adjusting your yt-dlp settings, as you may be failing JS challenges or getting denied the highest available quality options.'\
-                                            '\nThe file has already been downloaded, so you may rerun webm-for-4chan by specifying the local file name instead of the url.'\
-                                            "\nIf you wish to avoid this error in the future and proceed with the similar file name automatically, specify the '--use_fallback' option.")
-    return result_filename
+    return {'filepath': filepath, 'duration': entry.get('duration')}
+
+# Record a finished download, with the metadata yt-dlp wrote next to it, and trim the download cache
+def store_cached_download(entry_dir : str, url : str, section, filepath : str):
+    duration = None
+    info_file = os.path.splitext(filepath)[0] + '.info.json'
+    if os.path.isfile(info_file):
+        try:
+            with open(info_file, 'r', encoding='utf-8') as f:
+                duration = json.load(f).get('duration')
+        except (OSError, ValueError):
+            pass
+    entry = {'url': url, 'section': section, 'filename': os.path.basename(filepath), 'size': os.path.getsize(filepath), 'duration': duration}
+    with open(os.path.join(entry_dir, 'entry.json.tmp'), 'w') as f:
+        json.dump(entry, f)
+    os.replace(os.path.join(entry_dir, 'entry.json.tmp'), os.path.join(entry_dir, 'entry.json'))
+    with download_cache_lock:
+        trim_cache(download_cache_dir, download_cache_quota)
+
+# Name of a downloaded section in the working directory, so that different sections of a video don't share a name
+def get_section_filename(filepath : str, section):
+    base, ext = os.path.splitext(os.path.basename(filepath))
+    return '{} [{}-{}]{}'.format(base, section[0], section[1], ext)
+
+# Put a cached download into the working directory, where the job's output is written next to it. Hard linked if possible, so it costs no space.
+def link_download(cached : str, filename : str):
+    if os.path.isfile(filename) and os.path.samefile(cached, filename):
+        return filename
+    temp_file = '.{}.{}-{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    try:
+        os.link(cached, temp_file)
+    except OSError: # Other file system, or no hard link support
+        shutil.copyfile(cached, temp_file)
+    os.replace(temp_file, filename)
+    return filename
 
 # Determines if the argument is a parsable timestamp
 def is_timestamp(arg : str):
@@ -371,6 +1005,7 @@ class ResizeMode(Enum):
     cubic = 'cubic'
     logarithmic = 'logarithmic'
     table = 'table'
+    complexity = 'complexity'
     def __str__(self):
         return self.value
 
@@ -392,15 +1027,34 @@ class MixdownMode(Enum):
     def __str__(self):
         return self.value
 
+# Different fps calculation options
+class FpsCalcMode(Enum):
+    motion = 'motion'
+    table = 'table'
+    def __str__(self):
+        return self.value
+
+# Duplicate frame decimation options
+class DecimateMode(Enum):
+    auto = 'auto'
+    always = 'always'
+    never = 'never'
+    def __str__(self):
+        return self.value
+
+# Maximum clip duration for a board, in seconds
+def get_max_duration(board : BoardMode):
+    if board == BoardMode.gif:
+        return max_duration[1]
+    elif board == BoardMode.other: # all other boards
+        return max_duration[2]
+    return max_duration[0] # wsg
+
 # Perform duration check to make sure it still fits on the board
 def duration_check(duration : datetime.timedelta, board : BoardMode, no_duration_check : bool):
     if not no_duration_check:
         duration_sec = duration.total_seconds()
-        duration_limit = max_duration[0] # wsg
-        if board == BoardMode.gif:
-            duration_limit = max_duration[1] # gif
-        elif board == BoardMode.other: # all other boards
-            duration_limit = max_duration[2]
+        duration_limit = get_max_duration(board)
         if duration_sec > duration_limit:
             raise ValueError("Error: Specified duration {} seconds exceeds maximum {} seconds".format(duration_sec, duration_limit))
 
@@ -429,8 +1083,9 @@ def scale_to_even(original_width, original_height, scaled_width, scaled_height):
         #print("{}x{}".format(width, height))
     return int(max(height, width))
 
+@cached_probe
 def get_video_resolution(input_filename : str):
-    result = subprocess.run([ffprobe_exe,"-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
     if result.returncode == 0:
         width, height = [int(x) for x in result.stdout.strip().split(',')]
         return width, height
@@ -438,12 +1093,71 @@ def get_video_resolution(input_filename : str):
         print(result.stdout)
         raise RuntimeError(f'ffprobe returned error code {result.returncode}')
 
+# Encode one window at a fixed CRF and return the resulting bit rate in kbps
+def complexity_trial_encode(input_filename, window_start, window_duration, resolution : int, codec : str):
+    ffmpeg_cmd = [ffmpeg_exe, '-hide_banner', '-v', 'error', '-ss', str(window_start), '-t', str(window_duration), '-i', input_filename, '-an', '-sn', '-map', '0:v:0']
+    ffmpeg_cmd.extend(['-vf', "scale='min({},iw)':'min({},ih):force_original_aspect_ratio=decrease'".format(resolution, resolution)])
+    # Fastest settings the encoder offers. Trial encodes only need to rank content, not look good.
+    if codec == 'libvpx-vp9':
+        ffmpeg_cmd.extend(['-c:v', 'libvpx-vp9', '-crf', str(complexity_crf[codec]), '-b:v', '0', '-deadline', 'realtime', '-cpu-used', '8', '-row-mt', '1'])
+    else:
+        ffmpeg_cmd.extend(['-c:v', 'libx264', '-crf', str(complexity_crf[codec]), '-preset', 'veryfast'])
+    # Write to stdout instead of a temp file, the byte count is all that's needed
+    ffmpeg_cmd.extend(['-f', 'matroska', 'pipe:1'])
+    result = run_subprocess(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(result.stderr.decode(errors='ignore'))
+        raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+    return len(result.stdout) * 8 / 1000 / window_duration.total_seconds()
+
+# Content complexity probe. Trial encodes a few sampled windows at a couple of resolutions in parallel,
+# then fits the bit rate needed at constant quality as a power of the pixel count: kbps = a * pixels^b
+# Returns the (unsnapped) largest dimension whose predicted bit rate fits the target bit rate.
+@traced
+def estimate_complexity_resolution(input_filename, start, duration, target_bitrate, raw_width, raw_height, codec : str):
+    codec = 'libvpx-vp9' if 'vp9' in codec else 'libx264' # Hardware encoders are approximated by their software counterparts
+    raw_max_dimension = max(raw_width, raw_height)
+    resolutions = sorted(set([min(x, raw_max_dimension) for x in complexity_resolutions]))
+    if len(resolutions) < 2: # Source is smaller than the smallest probe resolution, probe at half size instead
+        resolutions = [raw_max_dimension // 2, raw_max_dimension]
+    windows = get_sample_windows(start, duration, complexity_windows, complexity_window_length)
+    # Trial encodes are cached per input, window and codec
+    trials = dict()
+    pending = []
+    for window_start, window_duration in windows:
+        for resolution in resolutions:
+            cache_key = get_analysis_cache_key('complexity', input_filename, window_start, window_duration, codec, complexity_crf[codec], resolution)
+            cached = get_cached_analysis(cache_key)
+            if cached is not None:
+                trials[(window_start, resolution)] = cached
+            else:
+                pending.append((cache_key, window_start, window_duration, resolution))
+    if len(pending) > 0:
+        print('Running complexity probe ({} trial encodes)'.format(len(pending)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 1)) as executor:
+            futures = {executor.submit(bind_job_state(complexity_trial_encode), input_filename, window_start, window_duration, resolution, codec) : (cache_key, window_start, resolution) for cache_key, window_start, window_duration, resolution in pending}
+            for future in concurrent.futures.as_completed(futures):
+                cache_key, window_start, resolution = futures[future]
+                trials[(window_start, resolution)] = future.result()
+                store_cached_analysis(cache_key, trials[(window_start, resolution)])
+    # Windows are the same length, so the mean of the window bit rates is the bit rate of the sampled content
+    low_res, high_res = resolutions[0], resolutions[-1]
+    low_kbps = sum([trials[(window_start, low_res)] for window_start, _ in windows]) / len(windows)
+    high_kbps = sum([trials[(window_start, high_res)] for window_start, _ in windows]) / len(windows)
+    if low_kbps <= 0 or high_kbps <= 0:
+        raise RuntimeError('Trial encodes produced no data.')
+    # Pixel count is proportional to the square of the largest dimension. Clamp the exponent to something sensible in case the trial encodes are noisy.
+    exponent = min(max(math.log(high_kbps / low_kbps) / math.log((high_res / low_res) ** 2), 0.3), 1.5)
+    calculated_resolution = high_res * math.pow(target_bitrate / high_kbps, 1 / (2 * exponent))
+    print('Complexity: {}kbps at {}, {}kbps at {} (exponent {:.2f}), '.format(int(low_kbps), low_res, int(high_kbps), high_res, exponent), end='')
+    return calculated_resolution
+
 # Use the lookup table to find the highest resolution under the pre-defined durations in the table
-def calculate_target_resolution(duration, input_filename, target_bitrate, resizing_mode : ResizeMode, bypass_resolution_table : bool):
+def calculate_target_resolution(duration, input_filename, target_bitrate, resizing_mode : ResizeMode, bypass_resolution_table : bool, start = datetime.timedelta(seconds=0), codec = 'libvpx-vp9'):
     if str(resizing_mode) != 'table':
         try:
             # ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=p=0 input.mp4
-            result = subprocess.run([ffprobe_exe,"-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
+            result = run_subprocess([ffprobe_exe,"-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
             if result.returncode == 0:
                 # Grab the largest dimension of the video's resolution
                 raw_width, raw_height = [int(x) for x in result.stdout.strip().split(',')]
@@ -474,6 +1188,9 @@ def calculate_target_resolution(duration, input_filename, target_bitrate, resizi
                 scaled_height = scaled_pixels / width
                 scaled_width = scaled_pixels / height
                 calculated_resolution = max(scaled_height, scaled_width)
+                if str(resizing_mode) == 'complexity':
+                    # Instead of a fixed curve, measure how many bits the content actually needs at each resolution
+                    calculated_resolution = estimate_complexity_resolution(input_filename, start, duration, target_bitrate, raw_width, raw_height, codec)
                 # Either use raw calculated resolution or nearest standard resolution 
                 if bypass_resolution_table: # Skip resolution table lookup and go to the nearest pixel
                     res = int(min(2048, calculated_resolution))
@@ -507,6 +1224,18 @@ def calculate_target_resolution(duration, input_filename, target_bitrate, resizi
             break
     return calculated_res
 
+# Returns the source frame rate, or None if it couldn't be determined
+@cached_probe
+def get_source_fps(input_filename):
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-select_streams", "v", "-of", "default=noprint_wrappers=1:nokey=1", "-show_entries", "stream=r_frame_rate", input_filename], stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(result.stdout)
+        print('ffprobe returned error code {}'.format(result.returncode))
+        return None
+    # Outputs the frame rate as a precise fraction. Have to convert to decimal.
+    source_fps_fractional = result.stdout.split('/')
+    return round(float(source_fps_fractional[0]) / float(source_fps_fractional[1]), 2)
+
 # Same idea as the resolution lookup table but for fps. Also takes into account the source fps.
 def calculate_target_fps(input_filename, duration):
     frame_rate = 60
@@ -517,15 +1246,10 @@ def calculate_target_fps(input_filename, duration):
             break
     # Get input frame rate
     try:
-        result = subprocess.run([ffprobe_exe,"-v", "error", "-select_streams", "v", "-of", "default=noprint_wrappers=1:nokey=1", "-show_entries", "stream=r_frame_rate", input_filename], stdout=subprocess.PIPE, text=True)
-        if result.returncode != 0:
-            print(result.stdout)
-            print('ffprobe returned error code {}'.format(result.returncode))
+        source_fps = get_source_fps(input_filename)
+        if source_fps is None:
             print('Error getting input fps. Using no input fps assumptions.')
             return frame_rate
-        # Outputs the frame rate as a precise fraction. Have to convert to decimal.
-        source_fps_fractional = result.stdout.split('/')
-        source_fps = round(float(source_fps_fractional[0]) / float(source_fps_fractional[1]), 2)
         # If source frame rate is already fine, return None to signal no fps filter necessary
         if source_fps <= frame_rate:
             return None
@@ -534,6 +1258,162 @@ def calculate_target_fps(input_filename, duration):
         print('Error reading source fps. Falling back to time-based table.')
     return frame_rate # Return calculated fps otherwise
 
+# Pick the highest frame rate that still leaves enough bits per pixel for the amount of motion in the clip.
+# Low motion clips keep their frame rate regardless of length, while high motion clips drop frames sooner.
+# The motion score comes from the frame analysis pass and the output dimensions are derived from the target resolution.
+# Returns a tuple of (fps, motion score, bits per pixel at the chosen fps), where fps is None if the source frame rate should be kept.
+# Falls back to the time-based table if the analysis isn't available.
+@traced
+def calculate_motion_fps(input_filename, start, duration, target_kbps, resolution, analysis):
+    cache_key = get_analysis_cache_key('fps', input_filename, start, duration, target_kbps, resolution, fps_candidates, fps_min_bpp, fps_motion_bpp)
+    cached = get_cached_analysis(cache_key)
+    if cached is not None:
+        return cached['fps'], cached['motion'], cached['bpp']
+    try:
+        source_fps = get_source_fps(input_filename)
+        if analysis is None or source_fps is None:
+            raise RuntimeError('Missing frame analysis or source fps.')
+        # Output dimensions, the target resolution is applied to the largest dimension
+        width, height = get_video_resolution(input_filename)
+        if resolution is not None and resolution < max(width, height):
+            scale_factor = resolution / max(width, height)
+            width, height = width * scale_factor, height * scale_factor
+        motion = analysis['motion']
+        required_bpp = fps_min_bpp + fps_motion_bpp * motion
+        candidates = [x for x in fps_candidates if x < source_fps]
+        if source_fps <= fps_candidates[0]:
+            candidates.insert(0, source_fps)
+        frame_rate = candidates[-1] # The lowest candidate is used if none of them have enough bits
+        for candidate in candidates:
+            if target_kbps * 1000 / (width * height * candidate) >= required_bpp:
+                frame_rate = candidate
+                break
+        bpp = target_kbps * 1000 / (width * height * frame_rate)
+        fps = None if frame_rate >= source_fps else frame_rate # None signals that no fps filter is necessary
+        store_cached_analysis(cache_key, {'fps' : fps, 'motion' : motion, 'bpp' : bpp})
+        return fps, motion, bpp
+    except Exception as e:
+        print(e)
+        print('Error calculating motion-aware fps. Falling back to time-based table.')
+    return calculate_target_fps(input_filename, duration), None, None
+
+# Output dimensions for a given maximum dimension, preserving aspect ratio and rounded to even numbers
+def get_scaled_dimensions(width, height, resolution):
+    scale_factor = min(1.0, resolution / max(width, height))
+    return int(round(width * scale_factor / 2) * 2), int(round(height * scale_factor / 2) * 2)
+
+# The filters of an encode's -vf chain that the source goes through to be compared with the output: all but scaling, frame rate and hardware upload
+def get_reference_filters(video_filters : list):
+    return [x for x in video_filters if not x.startswith(('scale=', 'fps=', 'mpdecimate', 'format=nv12', 'hwupload'))]
+
+# Input arguments that read a window of the input. Burnt-in subtitles are timed by the source timestamps, so those are kept with -copyts.
+def get_window_input_args(input_filename, start, duration, video_filters : list):
+    copyts = ['-copyts'] if any(x.startswith('subtitles=') for x in video_filters) else []
+    return ['-ss', str(start), '-t', str(duration)] + copyts + ['-i', input_filename]
+
+# Encode one --search sample with the job's filter chain and encoder settings at the real target bit rate (one pass),
+# and score it against the source with ffmpeg's ssim filter
+def search_trial(input_filename, window_start, window_duration, video_filters : list, video_codec : list, target_kbps, pix_fmt : str, compare_width, compare_height, sample_filename):
+    encode_cmd = [ffmpeg_exe, '-hide_banner', '-v', 'error', '-y'] + get_window_input_args(input_filename, window_start, window_duration, video_filters)
+    encode_cmd.extend(['-an', '-sn', '-map', '0:v:0', '-vf', ','.join(video_filters)] + video_codec + ['-b:v', '{}k'.format(target_kbps), '-fps_mode', 'vfr'])
+    if pix_fmt != 'same_as_source':
+        encode_cmd.extend(['-pix_fmt', pix_fmt])
+    encode_cmd.append(sample_filename)
+    result = run_subprocess(encode_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(result.stderr.decode(errors='ignore'))
+        raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+    try:
+        return measure_ssim(input_filename, window_start, window_duration, get_reference_filters(video_filters), sample_filename, compare_width, compare_height)
+    finally:
+        os.remove(sample_filename) # Samples are only needed for scoring
+
+# Score a rendered clip against the same window of the source with ffmpeg's ssim filter. The source goes through reference_filters first,
+# and both are scaled to width x height. Returns the SSIM (All).
+def measure_ssim(input_filename, start, duration, reference_filters : list, rendered_filename, width, height):
+    # The reference goes first so that every source frame is compared, reduced fps renders are held just like a player would
+    reference = ','.join(reference_filters + ['scale={}:{}'.format(width, height), 'settb=AVTB', 'setpts=PTS-STARTPTS'])
+    rendered = 'scale={}:{},settb=AVTB,setpts=PTS-STARTPTS'.format(width, height)
+    ssim_cmd = [ffmpeg_exe, '-hide_banner'] + get_window_input_args(input_filename, start, duration, reference_filters) + ['-i', rendered_filename,
+                '-lavfi', '[0:v]{}[ref];[1:v]{}[dist];[ref][dist]ssim'.format(reference, rendered), '-f', 'null', null_output]
+    result = run_subprocess(ssim_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(result.stderr.decode(errors='ignore'))
+        raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+    match = re.search(r'SSIM .*All:([0-9.]+)', result.stderr.decode(errors='ignore'))
+    if match is None:
+        raise RuntimeError('Could not find SSIM score.')
+    return float(match.group(1))
+
+# Encode short samples for each (resolution, fps) candidate near the calculated values and keep the one with the best SSIM.
+# resolution and fps are the calculated (or manually specified) values. None means same as source, just like everywhere else.
+# The samples go through the same filters as the encode (crop and decimate as planned, subtitles being the burn-in from export_subtitles)
+# and use the job's encoder settings. Returns a tuple of (resolution, fps, ssim).
+@traced
+def search_resolution_fps(input_filename, start, duration, target_kbps, resolution, fps, crop, decimate : bool, subtitles : str, args):
+    fixed_resolution = args.no_resize or args.resolution is not None
+    fixed_fps = args.fps is not None
+    raw_width, raw_height = get_video_resolution(input_filename)
+    raw_max_dimension = max(raw_width, raw_height)
+    source_fps = get_source_fps(input_filename)
+    # Resolution candidates are the neighbors of the calculated resolution in the resolution table, plus the source resolution
+    resolution_candidates = [resolution]
+    if not fixed_resolution:
+        table = [x for x in resolution_table if x < raw_max_dimension] + [raw_max_dimension]
+        current = resolution if resolution is not None else raw_max_dimension
+        index = max([idx for idx, x in enumerate(table) if x <= current] + [0])
+        resolution_candidates = table[max(0, index - search_resolution_steps):index + search_resolution_steps + 1]
+        resolution_candidates = [None if x >= raw_max_dimension else x for x in resolution_candidates]
+    # Fps candidates are the calculated fps and the next lower caps
+    fps_candidates_searched = [fps]
+    if not fixed_fps and source_fps is not None:
+        current = fps if fps is not None else source_fps
+        lower = [x for x in fps_candidates if x < current][:search_fps_steps]
+        fps_candidates_searched.extend(lower)
+        if fps is not None and source_fps <= fps_candidates[0]: # Also try keeping the source frame rate
+            fps_candidates_searched.insert(0, None)
+    candidates = [(r, f) for r in resolution_candidates for f in fps_candidates_searched]
+    trial_settings = dict()
+    with sharing_cores(search_workers):
+        for candidate_resolution, candidate_fps in candidates:
+            video_filters = get_video_filters(input_filename, crop, candidate_resolution, candidate_fps, decimate, args)
+            if subtitles != '':
+                video_filters.append('subtitles={}'.format(subtitles))
+            if args.codec == 'vp9_vaapi':
+                video_filters.extend(['format=nv12', 'hwupload'])
+            width, height = get_scaled_dimensions(raw_width, raw_height, candidate_resolution if candidate_resolution is not None else raw_max_dimension)
+            trial_settings[(candidate_resolution, candidate_fps)] = (video_filters, get_video_codec_args(args, width, height))
+    cache_key = get_analysis_cache_key('search', input_filename, start, duration, target_kbps, list(trial_settings.items()), args.pix_fmt, search_windows, search_window_length)
+    cached = get_cached_analysis(cache_key)
+    if cached is not None:
+        print('Using cached search result')
+        return cached['resolution'], cached['fps'], cached['ssim']
+    # Every candidate is scored at the size of the largest candidate so the scores are comparable
+    compare_width, compare_height = get_scaled_dimensions(raw_width, raw_height, max([x if x is not None else raw_max_dimension for x in resolution_candidates]))
+    windows = get_sample_windows(start, duration, search_windows, search_window_length)
+    print('Searching {} candidates ({} sample encodes, {} at a time)'.format(len(candidates), len(candidates) * len(windows), search_workers))
+    scores = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=search_workers) as executor:
+        futures = dict()
+        for candidate_resolution, candidate_fps in candidates:
+            for window_start, window_duration in windows:
+                sample_filename = get_temp_filename('search{}.mkv'.format(len(futures)))
+                job_state.files_to_clean.append(sample_filename)
+                video_filters, video_codec = trial_settings[(candidate_resolution, candidate_fps)]
+                future = executor.submit(bind_job_state(search_trial), input_filename, window_start, window_duration, video_filters, video_codec, target_kbps, args.pix_fmt,
+                                         compare_width, compare_height, sample_filename)
+                futures[future] = (candidate_resolution, candidate_fps)
+        for future in concurrent.futures.as_completed(futures):
+            scores.setdefault(futures[future], []).append(future.result())
+    best = None
+    for candidate in candidates:
+        ssim = sum(scores[candidate]) / len(scores[candidate])
+        print('  resolution {}, fps {}: SSIM {:.5f}'.format(candidate[0] if candidate[0] is not None else 'same as source', candidate[1] if candidate[1] is not None else 'same as source', ssim))
+        if best is None or ssim > best[2]:
+            best = (candidate[0], candidate[1], ssim)
+    store_cached_analysis(cache_key, {'resolution' : best[0], 'fps' : best[1], 'ssim' : best[2]})
+    return best
+
 # Use audio lookup table
 def calculate_target_audio_rate(duration, music_mode, mode : BoardMode):
     audiomap = None
@@ -566,9 +1446,10 @@ def find_json(output):
     return None
 
 # Return a tuple containing the stream layout and a flag that is True of no audio stream was detected
+@cached_probe
 def get_audio_layout(input_filename : str, track : int):
     ffprobe_cmd = [ffprobe_exe, '-v', 'error', '-hide_banner', '-of', 'default=noprint_wrappers=1:nokey=1', '-show_streams', '-select_streams', 'a:{}'.format(track), '-print_format', 'json', input_filename]
-    result = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    result = run_subprocess(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     if result.returncode != 0:
         print(result.stdout)
         raise RuntimeError('ffprobe returned error code {}'.format(result.returncode))
@@ -585,14 +1466,34 @@ def get_audio_layout(input_filename : str, track : int):
 # Simply renders the audio to file and gets its size.
 # This is the most precise way of knowing the final audio size and rendering this takes a fraction of the time it takes to render the video.
 # Returns a tuple containing the audio bit rate, audio filters if applicable, the surround workaround filter if applicable, and a special flag if no audio streams were found
+# With --resume the result of a previous run is reused.
+@traced
 def calculate_audio_size(input_filename, start, duration, audio_bitrate, track, mode : BoardMode, acodec : str, mixdown : MixdownMode, normalize : bool, no_dynaudnorm : bool):
+    params = [str(start), str(duration), audio_bitrate, track, str(mode), acodec, str(mixdown), normalize, no_dynaudnorm]
+    key = (get_input_fingerprint(input_filename), str(mode) == 'other') + tuple(params[:4] + params[5:]) # /wsg/ and /gif/ render the same audio
+    with audio_renders_lock:
+        if key in audio_renders:
+            print('Using an earlier render of the same audio')
+            return audio_renders[key]
+    checkpoint = load_checkpoint('audio', [input_filename], params)
+    if checkpoint is not None:
+        result = checkpoint['result']
+    else:
+        result = render_audio(input_filename, start, duration, audio_bitrate, track, mode, acodec, mixdown, normalize, no_dynaudnorm)
+        save_checkpoint('audio', [input_filename], params, [], result)
+    with audio_renders_lock:
+        store_memo(audio_renders, key, result)
+    return result
+
+# The render behind calculate_audio_size
+def render_audio(input_filename, start, duration, audio_bitrate, track, mode : BoardMode, acodec : str, mixdown : MixdownMode, normalize : bool, no_dynaudnorm : bool):
     if str(mode) == 'wsg' or str(mode) == 'gif':
         surround_workaround = False # For working around a known bug in libopus: https://trac.ffmpeg.org/ticket/5718
         surround_workaround_args = None
         additional_filter = None
         output_ext = 'opus' if acodec == 'libopus' else 'aac'
         output = get_temp_filename(output_ext)
-        files_to_clean.append(output)
+        job_state.files_to_clean.append(output)
         if os.path.isfile(output):
             os.remove(output)
         ffmpeg_cmd = [ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vn', '-acodec', acodec, '-b:a', audio_bitrate]
@@ -609,7 +1510,7 @@ def calculate_audio_size(input_filename, start, duration, audio_bitrate, track,
                 ffmpeg_cmd.extend(['-af', additional_filter])
         ffmpeg_cmd1 = ffmpeg_cmd.copy()
         ffmpeg_cmd1.append(output)
-        result = subprocess.run(ffmpeg_cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        result = run_subprocess(ffmpeg_cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         if result.returncode != 0 or not os.path.isfile(output):
             for line in result.stderr.splitlines():
                 # Try to rerun with surround sound workaround
@@ -647,7 +1548,7 @@ def calculate_audio_size(input_filename, start, duration, audio_bitrate, track,
                     ffmpeg_cmd2.append(output)
                     if os.path.isfile(output):
                         os.remove(output)
-                    result = subprocess.run(ffmpeg_cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                    result = run_subprocess(ffmpeg_cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
                     if result.returncode != 0 or not os.path.isfile(output):
                         print(' '.join(ffmpeg_cmd2))
                         print(result.stderr)
@@ -661,7 +1562,8 @@ def calculate_audio_size(input_filename, start, duration, audio_bitrate, track,
         if normalize:
             print('Normalizing audio (1st pass)')
             null_output = 'NUL' if platform.system() == 'Windows' else '/dev/null' # For pass 1, need to output to appropriate null depending on system
-            result = subprocess.run([ffmpeg_exe, '-i', output, '-filter:a', 'loudnorm=print_format=json', "-f", "null", null_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            with trace_span('loudnorm measure'):
+                result = run_subprocess([ffmpeg_exe, '-i', output, '-filter:a', 'loudnorm=print_format=json', "-f", "null", null_output], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
             # Search stdout and stderr for the loudnorm params
             params = None
             if result.returncode == 0:
@@ -672,7 +1574,7 @@ def calculate_audio_size(input_filename, start, duration, audio_bitrate, track,
                 print('Normalizing audio (2nd pass)')
                 output2_ext = 'normalized.opus' if acodec == 'libopus' else 'normalized.aac'
                 output2 = get_temp_filename(output2_ext)
-                files_to_clean.append(output2)
+                job_state.files_to_clean.append(output2)
                 if os.path.isfile(output2):
                     os.remove(output2)
                 # The size of the normalized audio is different from the initial one, so render to get the exact size
@@ -687,7 +1589,8 @@ def calculate_audio_size(input_filename, start, duration, audio_bitrate, track,
                     ffmpeg_cmd.append('-af')
                     ffmpeg_cmd.append(surround_workaround_args)
                 ffmpeg_cmd.append(output2)
-                result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                with trace_span('loudnorm render'):
+                    result = run_subprocess(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
                 if result.returncode == 0 and os.path.isfile(output2):
                     audio_filter = "loudnorm=linear=true:measured_I={}:measured_LRA={}:measured_tp={}:measured_thresh={}".format(params['input_i'], params['input_lra'], params['input_tp'], params['input_thresh'])
                     return [os.path.getsize(output2), audio_filter, surround_workaround_args, False]
@@ -718,9 +1621,10 @@ def calculate_bitrate_compensation(duration, manual_compensation):
     return 0 + manual_compensation
 
 # Return a dictionary of the available subtitles, with index as the key and language as the value
+@cached_probe
 def list_subtitles(input_filename):
     # ffprobe -loglevel error -select_streams s -show_entries stream=index:stream_tags=language -of csv=p=0
-    result = subprocess.run([ffprobe_exe,"-v", "error", "-select_streams", "s", "-of", "csv=p=0", "-show_entries", "stream=index:stream_tags=language", input_filename], stdout=subprocess.PIPE, text=True)
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-select_streams", "s", "-of", "csv=p=0", "-show_entries", "stream=index:stream_tags=language", input_filename], stdout=subprocess.PIPE, text=True)
     if result.returncode == 0:
         lines = result.stdout.splitlines()
         subs = dict()
@@ -735,9 +1639,10 @@ def list_subtitles(input_filename):
         raise RuntimeError('ffprobe returned code {}'.format(result.returncode))
 
 # Return a dictionary of the available audio tracks, with index as the key and language as the value
+@cached_probe
 def list_audio(input_filename):
     # ffprobe -show_entries stream=index:stream_tags=language -select_streams a -of compact=p=0:nk=1
-    result = subprocess.run([ffprobe_exe,"-v", "error", "-show_entries", "stream=index:stream_tags=language", "-select_streams", "a", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-show_entries", "stream=index:stream_tags=language", "-select_streams", "a", "-of", "csv=p=0", input_filename], stdout=subprocess.PIPE, text=True)
     if result.returncode == 0:
         lines = result.stdout.splitlines()
         tracks = dict()
@@ -843,6 +1748,7 @@ def build_cut_segments(start, duration, args):
         raise RuntimeError('Error parsing cut segments: {}'.format(e))
 
 # Concatenate or cut segments from the video and render to a temporary file. On success, the name of the temp file is returned.
+@traced
 def segment_video(input_filename : str, start, duration, full_video : bool, args):
 
     # Make sure no audio tracks beside the default are specified
@@ -876,24 +1782,27 @@ def segment_video(input_filename : str, start, duration, full_video : bool, args
     ffmpeg_args.extend(["-c:a", "libopus", "-b:a", "512k"])
     
     # Output file
-    output_filename = get_temp_filename('mkv')
-    files_to_clean.append(output_filename)
+    output_filename = get_stage_filename('segment', 'mkv')
     ffmpeg_args.append(output_filename)
+    if load_checkpoint('segment', [input_filename], ffmpeg_args) is not None:
+        return output_filename
     print('Rendering cut video...')
     print(' '.join(ffmpeg_args))
-    result = subprocess.run(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    result = run_subprocess(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
     if result.returncode != 0:
         print(result.stderr)
         raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
     if os.path.isfile(output_filename):
+        save_checkpoint('segment', [input_filename], ffmpeg_args, [output_filename])
         return output_filename
     else:
         raise RuntimeError("File '{}' not found".format(output_filename))
 
+@traced
 def blackframe(input_filename, start, duration):
     print('Running blackframe detection')
     try:
-        result = subprocess.run([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vf', 'blackframe=threshold=96:amount=92', '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = run_subprocess([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vf', 'blackframe=threshold=96:amount=92', '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if result.returncode != 0:
             print(result.stderr.decode())
             raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
@@ -932,9 +1841,10 @@ def blackframe(input_filename, start, duration):
         print('Error detecting blackframes. Skipping step.')
     return datetime.timedelta(seconds=0)
 
+@traced
 def cropdetect(input_filename, start, duration):
     print('Running cropdetect')
-    result = subprocess.run([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vf', 'cropdetect', '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = run_subprocess([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vf', 'cropdetect', '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0:
         print(result.stderr.decode())
         raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
@@ -950,13 +1860,23 @@ def cropdetect(input_filename, start, duration):
     else:
         return None
 
+@traced
 def silencedetect(input_filename, start, duration):
+    cache_key = get_analysis_cache_key('silence', input_filename, start, duration, silence_filter)
+    cached = get_cached_analysis(cache_key)
+    if cached is not None:
+        return [(datetime.timedelta(seconds=x), datetime.timedelta(seconds=y)) for x, y in cached]
     print('Running silencedetect')
-    result = subprocess.run([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-af', 'silencedetect=n=-50dB:d=1.4', '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    result = run_subprocess([ffmpeg_exe, '-ss', str(start), '-t', str(duration), '-i', input_filename, '-vn', '-sn', '-af', silence_filter, '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if result.returncode != 0:
         print(result.stderr.decode())
         raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
-    output = result.stderr.decode().splitlines()
+    silence_segments = parse_silence(result.stderr.decode().splitlines(), start, duration)
+    store_cached_analysis(cache_key, [(x.total_seconds(), y.total_seconds()) for x, y in silence_segments])
+    return silence_segments
+
+# The (start, end) silence segments in the silencedetect filter's log lines
+def parse_silence(output : list, start, duration):
     silence_start = None
     silence_end = None
     silence_segments = []
@@ -973,9 +1893,283 @@ def silencedetect(input_filename, start, duration):
     # I don't think this is a real scenario but I'm covering my bases.
     # This is just for the case where silencedetect prints a silence_start but not a silence_end.
     if silence_start is not None and silence_end is None:
-        silence_segments.append(silence_start,start+duration)
+        silence_segments.append((silence_start, start + duration))
     return silence_segments
 
+# Divide the clip into evenly spaced windows for sampled analysis. Returns a list of (start, duration) tuples.
+# Clips too short to sample are analyzed in one window.
+def get_sample_windows(start : datetime.timedelta, duration : datetime.timedelta, count = analysis_windows, length = analysis_window_length):
+    total_seconds = duration.total_seconds()
+    if count <= 1 or total_seconds <= count * length:
+        return [(start, duration)]
+    spacing = (total_seconds - length) / (count - 1)
+    window_duration = datetime.timedelta(seconds=length)
+    return [(start + datetime.timedelta(seconds=spacing * idx), window_duration) for idx in range(count)]
+
+# Identify an input file by path, size and modification time so that cached results are invalidated when the file changes
+def get_input_fingerprint(input_filename):
+    stat = os.stat(input_filename)
+    return '{}|{}|{}'.format(os.path.abspath(input_filename), stat.st_size, stat.st_mtime_ns)
+
+# Build an analysis cache key from the analyzer name, the input file, the analyzed window, and any extra parameters
+def get_analysis_cache_key(analyzer : str, input_filename, start, duration, *extra):
+    key = [analyzer, get_input_fingerprint(input_filename), str(start), str(duration)]
+    key.extend([str(x) for x in extra])
+    return '|'.join(key)
+
+def load_analysis_cache():
+    global analysis_cache
+    with analysis_cache_lock:
+        if analysis_cache is None:
+            analysis_cache = dict()
+            if job_state.use_analysis_cache and os.path.isfile(analysis_cache_file):
+                try:
+                    with open(analysis_cache_file, 'r') as f:
+                        analysis_cache = json.load(f)
+                except Exception as e:
+                    print('Warning: Could not read analysis cache: {}'.format(e))
+        return analysis_cache
+
+def get_cached_analysis(key : str):
+    if not job_state.use_analysis_cache:
+        return None
+    with analysis_cache_lock:
+        return load_analysis_cache().get(key)
+
+# Store an analysis result and write the cache back to disk. Only the most recent entries are kept.
+def store_cached_analysis(key : str, value):
+    if not job_state.use_analysis_cache:
+        return
+    with analysis_cache_lock: # Held while writing, so that no other job changes the cache mid-dump
+        cache = load_analysis_cache()
+        cache.pop(key, None) # Re-insert so that the entry counts as the most recent
+        cache[key] = value
+        while len(cache) > max_analysis_cache_entries:
+            cache.pop(next(iter(cache)))
+        try:
+            os.makedirs(os.path.dirname(analysis_cache_file), exist_ok=True)
+            temp_file = analysis_cache_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_file, analysis_cache_file)
+        except Exception as e:
+            print('Warning: Could not write analysis cache: {}'.format(e))
+
+# Identify a file by its content without reading all of it: the size, plus a hash of the head, the tail and evenly spaced blocks in between
+@cached_probe
+def get_content_hash(input_filename):
+    size = os.path.getsize(input_filename)
+    digest = hashlib.sha1(str(size).encode('utf-8'))
+    with open(input_filename, 'rb') as f:
+        if size <= content_hash_edge_size * 2 + content_hash_samples * content_hash_block_size:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        else:
+            spacing = (size - content_hash_edge_size * 2 - content_hash_block_size) / (content_hash_samples - 1) if content_hash_samples > 1 else 0
+            blocks = [(0, content_hash_edge_size)]
+            blocks.extend([(content_hash_edge_size + int(spacing * idx), content_hash_block_size) for idx in range(content_hash_samples)])
+            blocks.append((size - content_hash_edge_size, content_hash_edge_size))
+            for offset, length in blocks:
+                f.seek(offset)
+                digest.update(f.read(length))
+    return digest.hexdigest()
+
+# Result cache key of a job: the input, the clip window, and every option that changes the output.
+# The content hash only samples large inputs, so files of the same size that differ elsewhere would collide. The key also has the
+# input's path, size and modification time, which limits hits to the same unchanged file. Returns None if the job can't be cached (--no_cache, --dry_run, --cc).
+def get_result_cache_key(job):
+    args = job.options
+    if args.no_cache or args.dry_run or args.cc:
+        return None
+    options = {key : str(value) for key, value in sorted(vars(args).items()) if key not in result_cache_ignored_options}
+    if args.sub_file is not None and os.path.isfile(args.sub_file): # Burned-in subtitles are named by path, the content is what matters
+        options['sub_file'] = get_content_hash(args.sub_file)
+    return hash_json([get_content_hash(job.input_filename), get_input_fingerprint(job.input_filename), str(job.start), str(job.duration), job.full_video, options])
+
+def get_cached_result_filename(key : str, extension : str):
+    return os.path.join(result_cache_dir, key + extension)
+
+# The cached output for a key, or None. Marks the entry as recently used.
+def get_cached_result(key : str, extension : str):
+    filename = get_cached_result_filename(key, extension)
+    with result_cache_lock:
+        try:
+            os.utime(filename) # The modification time is the last use, for LRU eviction
+        except OSError:
+            return None
+    return filename
+
+# Copy a finished output into the result cache, then evict the least recently used results until the cache fits in the quota (MiB)
+def store_cached_result(key : str, output : str, quota):
+    extension = os.path.splitext(output)[1]
+    filename = get_cached_result_filename(key, extension)
+    temp_file = os.path.join(result_cache_dir, '.{}.{}-{}.tmp'.format(key, os.getpid(), threading.get_ident()))
+    try:
+        os.makedirs(result_cache_dir, exist_ok=True)
+        shutil.copyfile(output, temp_file)
+        os.replace(temp_file, filename)
+    except OSError as e:
+        print('Warning: Could not write result cache: {}'.format(e))
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+        return
+    with result_cache_lock:
+        trim_cache(result_cache_dir, quota)
+
+# Remove the least recently used entries (files or directories, by modification time) of a cache directory until it fits in the quota (MiB)
+def trim_cache(directory : str, quota):
+    entries = []
+    for name in os.listdir(directory):
+        if name.startswith('.'): # Copies in progress
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+            size = stat.st_size
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(root, x)) for root, dirs, files in os.walk(path) for x in files)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, size, path))
+    total_size = sum(x[1] for x in entries)
+    for mtime, size, path in sorted(entries):
+        if total_size <= quota * 1024 * 1024:
+            break
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+# --resume job directory. Named after the input, the clip window and the options that change the output, so a rerun with the same parameters finds it.
+def get_job_dir(input_filename, start, duration, full_video : bool, args):
+    options = {key : str(value) for key, value in sorted(vars(args).items()) if key not in resume_ignored_options}
+    key = json.dumps([get_input_fingerprint(input_filename), str(start), str(duration), full_video, options])
+    return os.path.join(resume_jobs_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+# File name for an artifact of a pipeline stage. With --resume it's kept in the job directory, otherwise it's a temp file cleaned up with the job.
+def get_stage_filename(stage : str, extension : str):
+    if job_state.job_dir is None:
+        filename = get_temp_filename(extension)
+        job_state.files_to_clean.append(filename)
+        return filename
+    os.makedirs(job_state.job_dir, exist_ok=True)
+    return os.path.join(job_state.job_dir, '{}.{}'.format(stage, extension))
+
+# The input files of an ffmpeg command
+def get_command_inputs(cmd : list):
+    return [cmd[idx + 1] for idx, arg in enumerate(cmd[:-1]) if arg == '-i']
+
+def hash_json(value):
+    return hashlib.sha1(json.dumps(value).encode('utf-8')).hexdigest()
+
+# The manifest a previous run wrote for a stage, or None if the stage has to run: no --resume, no manifest,
+# changed input files or parameters, or outputs that are gone or differ in size from when the stage finished.
+def load_checkpoint(stage : str, inputs : list, params):
+    if job_state.job_dir is None:
+        return None
+    try:
+        with open(os.path.join(job_state.job_dir, stage + '.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest['inputs'] != hash_json([get_input_fingerprint(x) for x in inputs]) or manifest['args'] != hash_json(params):
+            return None
+        for filename, size in manifest['outputs'].items():
+            if not os.path.isfile(filename) or os.path.getsize(filename) != size:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    print('Resuming: {} was finished by a previous run'.format(stage))
+    return manifest
+
+# Record that a stage finished, after its outputs are complete. result is anything JSON serializable the stage returns.
+def save_checkpoint(stage : str, inputs : list, params, outputs : list, result = None):
+    if job_state.job_dir is None:
+        return
+    manifest = {
+        'inputs': hash_json([get_input_fingerprint(x) for x in inputs]),
+        'args': hash_json(params),
+        'outputs': {x : os.path.getsize(x) for x in outputs},
+        'result': result,
+    }
+    os.makedirs(job_state.job_dir, exist_ok=True) # Stages with only a result (i.e. the audio size) can be the first to save
+    filename = os.path.join(job_state.job_dir, stage + '.json')
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(filename + '.tmp', filename)
+
+# Decode sampled windows at low resolution and measure the content.
+# Returns a dictionary containing the number of sampled frames, how many of them survive mpdecimate, the sampled duration in seconds,
+# and the motion score (the mean scene change score between consecutive frames, 0.0 = static, 1.0 = every frame is a new scene).
+# If scene_cuts is set, the whole clip is decoded instead of sampled windows and the scdet filter runs in the same pass.
+# The scene cut timestamps (in seconds, relative to start) are then returned as well.
+# Returns None if the analysis failed.
+@traced
+def analyze_frames(input_filename, start, duration, scene_cuts = False):
+    if scene_cuts:
+        cache_key = get_analysis_cache_key('frames_full', input_filename, start, duration, analysis_height, scene_threshold)
+    else:
+        cache_key = get_analysis_cache_key('frames', input_filename, start, duration, analysis_windows, analysis_window_length, analysis_height)
+    cached = get_cached_analysis(cache_key)
+    if cached is None and not scene_cuts: # An analysis of the whole clip (i.e. from --stream) is at least as good as sampled windows
+        cached = get_cached_analysis(get_analysis_cache_key('frames_full', input_filename, start, duration, analysis_height, scene_threshold))
+    if cached is not None:
+        return cached
+    print('Running frame analysis' + (' with scene detection' if scene_cuts else ''))
+    vf = get_frame_analysis_filter(scene_cuts)
+    analysis = {'frames' : 0, 'kept' : 0, 'seconds' : 0.0, 'motion' : 0.0}
+    if scene_cuts:
+        analysis['cuts'] = []
+    scene_scores = []
+    try:
+        for window_start, window_duration in ([(start, duration)] if scene_cuts else get_sample_windows(start, duration)):
+            result = run_subprocess([ffmpeg_exe, '-ss', str(window_start), '-t', str(window_duration), '-i', input_filename, '-an', '-sn', '-vf', vf, '-f', 'null', null_output, '-v', 'info'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if result.returncode != 0:
+                print(result.stderr.decode())
+                raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+            parse_frame_analysis(result.stderr.decode(errors='ignore'), analysis, scene_scores)
+            analysis['seconds'] += window_duration.total_seconds()
+    except Exception as e:
+        print(e)
+        print('Error analyzing frames. Skipping step.')
+        return None
+    if analysis['frames'] == 0:
+        print('Frame analysis found no video frames. Skipping step.')
+        return None
+    analysis['motion'] = sum(scene_scores) / len(scene_scores) if len(scene_scores) > 0 else 0.0
+    store_cached_analysis(cache_key, analysis)
+    return analysis
+
+# The select filter tags every frame with its scene score, which also gives the metadata filters something to print.
+# The named metadata filters before and after mpdecimate count the sampled frames and the frames that survive decimation.
+# scdet has to see every frame, so it goes before mpdecimate.
+def get_frame_analysis_filter(scene_cuts : bool):
+    scdet = f'scdet=threshold={scene_threshold},' if scene_cuts else ''
+    return f"scale=-2:'min({analysis_height},ih)',select='gte(scene,0)',metadata@an_frames=print:key=lavfi.scene_score,{scdet}mpdecimate,metadata@an_kept=print:key=lavfi.scene_score"
+
+# Add what the frame analysis filters logged for one window to analysis and scene_scores. Scene cuts are collected if analysis has a 'cuts' list.
+def parse_frame_analysis(output : str, analysis : dict, scene_scores : list):
+    # Depending on the ffmpeg version, the log prefix is either the instance name or the full filter name
+    analysis['frames'] += len(re.findall(r'\[(?:metadata@)?an_frames @ [^\]]*\] frame:', output))
+    analysis['kept'] += len(re.findall(r'\[(?:metadata@)?an_kept @ [^\]]*\] frame:', output))
+    # The first frame of each window has nothing to compare against, so its score is meaningless
+    scene_scores.extend([float(x) for x in re.findall(r'\[(?:metadata@)?an_frames @ [^\]]*\] lavfi\.scene_score=([0-9.]+)', output)][1:])
+    if 'cuts' in analysis:
+        analysis['cuts'].extend([float(x) for x in re.findall(r'lavfi\.scd\.time: ([0-9.]+)', output)])
+
+# Turn scene cuts into keyframe timestamps for -force_key_frames.
+# Cuts too close to the previous keyframe are skipped so that flashes and strobing don't waste keyframes.
+def get_scene_keyframes(cuts : list):
+    keyframes = []
+    last_keyframe = 0.0 # The first frame is always a keyframe
+    for cut in sorted(cuts):
+        if cut - last_keyframe >= min_keyframe_spacing:
+            keyframes.append(cut)
+            last_keyframe = cut
+    return keyframes
+
 def split_string_by_length(input_string : str, max_length : int):
     words = input_string.split()  # Split the string into words
     result = []
@@ -1046,11 +2240,14 @@ def caption(text : str, font : str, input_filename: str, resolution : int):
         y += height_per_line
     return ','.join(filters)
 
+def get_output_extension(codec : str):
+    return '.webm' if (codec == 'libvpx-vp9' or codec == 'vp9_vaapi') else '.mp4'
+
 # Convoluted method of determining the output file name. Avoid overwriting existing files, etc.
 def get_output_filename(input_filename, args, suffix = None):
     # Use manually specified output
     if suffix is None:
-        suffix = '.webm' if (args.codec == 'libvpx-vp9' or args.codec == 'vp9_vaapi') else '.mp4'
+        suffix = get_output_extension(args.codec)
     if args.output is not None:
         from pathlib import Path
         input_path = Path(input_filename)
@@ -1064,55 +2261,339 @@ def get_output_filename(input_filename, args, suffix = None):
         out = (out if out.suffix.lower() == suffix.lower() else out.with_suffix(suffix))
         output = os.fspath(out)
         
-        if os.path.isfile(output):
+        if output in job_state.reserved_outputs: # This job already reserved it (static image mode names the output up front)
+            return output
+        if not reserve_output(output):
             confirmation = ''
             if args.yes:
                 print(f"File '{output}' already exists, overwriting.")
                 confirmation = 'y'
+            elif not job_state.interactive:
+                raise RuntimeError("File '{}' already exists. Pass --yes to overwrite it.".format(output))
             while not (confirmation.lower() == 'y' or confirmation.lower() == 'n'):
                 confirmation = input("File '{}' already exists, overwrite? Y/N ".format(output))
-            if confirmation.lower() == 'y':
-                os.remove(output) # Remove existing file
-            else:
+            if confirmation.lower() != 'y': # The existing file is replaced once the new one is finished, see finish_output
                 print('Halting.')
                 exit(0)
         return output
     # Automatically determine file name based on input file
     else:
         output = os.path.splitext(input_filename)[0]
+        existing = get_directory_names(os.path.dirname(output))
         filename_count = 1
         while True:
             # Rename the output by prepending '_1_' to the start of the file name.
             # The dirname shenanigans are an attempt to differentiate a file in a subdirectory vs a filename unqualified in the current directory.
-            final_output = os.path.dirname(output) + (os.path.sep if os.path.dirname(output) != "" else "") + '_{}_'.format(filename_count) + os.path.basename(output) + suffix
-            if os.path.isfile(final_output):
-                filename_count += 1 # Try to deconflict the file name by finding a different file name
-            else:
+            name = '_{}_'.format(filename_count) + os.path.basename(output) + suffix
+            final_output = os.path.dirname(output) + (os.path.sep if os.path.dirname(output) != "" else "") + name
+            if name not in existing and reserve_output(final_output):
+                add_directory_name(os.path.dirname(output), name)
                 return final_output
+            filename_count += 1 # Try to deconflict the file name by finding a different file name
+
+# Reserve an output file name by creating it empty with O_EXCL, which fails if any other job or process got there first.
+# Returns False if the file already exists. Placeholders the job doesn't fill are removed by cleanup().
+def reserve_output(filename : str):
+    try:
+        os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    job_state.reserved_outputs.append(filename)
+    return True
+
+# File names in a directory, from a listing that is only refreshed when the directory's mtime changes.
+# This is just a hint for picking a free name, reserve_output has the final word.
+def get_directory_names(directory : str):
+    directory = directory if directory != '' else '.'
+    try:
+        mtime = os.stat(directory).st_mtime_ns
+    except OSError:
+        return set()
+    with temp_filename_lock:
+        cached = output_name_index.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    names = set(os.listdir(directory))
+    with temp_filename_lock:
+        store_memo(output_name_index, directory, (mtime, names))
+    return names
+
+# Add a name this job created to the directory listing, so that the listing stays current without being read again
+def add_directory_name(directory : str, name : str):
+    directory = directory if directory != '' else '.'
+    with temp_filename_lock:
+        cached = output_name_index.get(directory)
+        if cached is not None:
+            cached[1].add(name)
+            output_name_index[directory] = (os.stat(directory).st_mtime_ns, cached[1])
 
+# ffmpeg writes to a hidden temp name in the output's directory, and the finished file is moved into place with finish_output,
+# so nobody sees a half-written output. The name is unique per job, so jobs writing the same -o don't share it.
+def get_partial_filename(output : str):
+    directory, name = os.path.split(output)
+    stem, ext = os.path.splitext(name)
+    partial = os.path.join(directory, '.{}.{}-{}.partial{}'.format(stem, os.getpid(), threading.get_ident(), ext))
+    job_state.files_to_clean.append(partial)
+    return partial
+
+# Atomically replace the output with its finished partial file. Returns False if there is nothing to move (dry run).
+def finish_output(partial : str, output : str):
+    if not os.path.isfile(partial):
+        return False
+    os.replace(partial, output)
+    if output in job_state.reserved_outputs:
+        job_state.reserved_outputs.remove(output)
+    return True
+
+# Convert an ffmpeg -progress value to a number, or None if ffmpeg hasn't reported it yet ('N/A')
+def progress_number(value, suffix = ''):
+    if value is None:
+        return None
+    if suffix != '' and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+# Turn one key=value block written by ffmpeg -progress into a progress event.
+# out_time and eta are in seconds, bitrate is in kbit/s, and speed is a multiple of real time. percent and eta need the total duration.
+def make_progress_event(block : dict, stage : str, total_seconds):
+    out_time_us = progress_number(block.get('out_time_us'))
+    out_time = max(out_time_us / 1000000, 0.0) if out_time_us is not None else None
+    speed = progress_number(block.get('speed'), 'x')
+    finished = block.get('progress') == 'end'
+    event = {
+        'type': 'progress',
+        'stage': stage,
+        'frame': int(progress_number(block.get('frame')) or 0),
+        'fps': progress_number(block.get('fps')),
+        'out_time': out_time,
+        'speed': speed,
+        'bitrate': progress_number(block.get('bitrate'), 'kbits/s'),
+        'total_size': int(progress_number(block.get('total_size')) or 0),
+        'duration': total_seconds,
+        'percent': None,
+        'eta': None,
+        'finished': finished,
+    }
+    if finished:
+        event['percent'] = 100.0
+        event['eta'] = 0.0
+    elif total_seconds and out_time is not None:
+        event['percent'] = min(100.0, out_time / total_seconds * 100)
+        if speed:
+            event['eta'] = max(0.0, (total_seconds - out_time) / speed)
+    return event
+
+def format_progress_event(event : dict):
+    text = '{}: '.format(event['stage'])
+    if event['percent'] is not None:
+        text += '{:5.1f}% '.format(event['percent'])
+    if event['out_time'] is not None:
+        text += format_timedelta(datetime.timedelta(seconds=event['out_time'])) + ' '
+    text += 'frame={} '.format(event['frame'])
+    if event['fps'] is not None:
+        text += 'fps={:.1f} '.format(event['fps'])
+    if event['speed'] is not None:
+        text += 'speed={:.2f}x '.format(event['speed'])
+    if event['bitrate'] is not None:
+        text += 'bitrate={:.1f}kbits/s '.format(event['bitrate'])
+    if event['eta'] is not None:
+        text += 'ETA {}'.format(format_timedelta(datetime.timedelta(seconds=round(event['eta']))))
+    return text.strip()
+
+# Send a progress event to the current job's listener (--serve), the --progress_json stream, or the terminal.
+# The terminal line is redrawn at most every progress_render_interval seconds. render holds the time and length of the last drawn line,
+# whether the line is still open (not followed by a newline yet), and the lock that keeps stderr output from landing in the middle of it.
+def emit_progress(event : dict, render : dict):
+    if job_state.progress_listener is not None:
+        job_state.progress_listener(event)
+        return
+    if job_state.progress_json is not None:
+        line = json.dumps(event) + '\n'
+        if job_state.progress_json == '-':
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            with open(job_state.progress_json, 'a') as f:
+                f.write(line)
+        return
+    now = time.monotonic()
+    if event['finished'] or now - render['time'] >= progress_render_interval:
+        text = format_progress_event(event)
+        with render['lock']: # ffmpeg's stderr is printed from another thread
+            print('\r' + text.ljust(render['length'] if render['open'] else 0), end='', flush=True) # Pad to erase the end of a longer previous line
+            render.update({'time': now, 'length': len(text), 'open': True})
+
+# Run ffmpeg with machine-readable progress on stdout (-progress pipe:1) instead of scraping the stats line off stderr.
+# stderr is drained on a separate thread so that neither pipe can fill up and stall ffmpeg. It is echoed as it arrives,
+# or, with echo off, only printed if ffmpeg fails. duration is the expected output duration, used for percent and ETA.
+def run_ffmpeg(ffmpeg_args : list, stage : str, duration = None, echo = True):
+    ffmpeg_args = [ffmpeg_args[0], '-progress', 'pipe:1', '-nostats'] + ffmpeg_args[1:]
+    if isinstance(duration, datetime.timedelta):
+        total_seconds = duration.total_seconds()
+    else:
+        total_seconds = parsetime(str(duration)).total_seconds() if duration is not None else None
+    with trace_span(stage, 'subprocess', command=' '.join(ffmpeg_args)) as span:
+        returncode = run_ffmpeg_process(ffmpeg_args, stage, total_seconds, echo)
+        if span is not None:
+            span.args['exit_code'] = returncode
+    if returncode != 0:
+        raise RuntimeError('ffmpeg returned code {}'.format(returncode))
+
+# Run the ffmpeg command built by run_ffmpeg, reporting its progress. Returns the exit code.
+def run_ffmpeg_process(ffmpeg_args : list, stage : str, total_seconds, echo : bool):
+    started = time.perf_counter()
+    pope = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
+    stderr_lines = []
+    render = {'time': 0.0, 'length': 0, 'open': False, 'lock': threading.Lock()}
+    def drain_stderr():
+        for line in iter(pope.stderr.readline, ''):
+            stderr_lines.append(line)
+            if echo:
+                with render['lock']:
+                    if render['open']:
+                        print('') # Move off the progress line
+                        render['open'] = False
+                    print(line, end='')
+        pope.stderr.close()
+    stderr_thread = threading.Thread(target=bind_job_state(drain_stderr), daemon=True) # Print to the same place as the job that started ffmpeg
+    stderr_thread.start()
+    done = threading.Event()
+    cancel = job_state.cancel
+    def stop_on_cancel():
+        while not done.wait(0.2):
+            if cancel.is_set():
+                pope.kill() # Not reaped until wait_process, so the pid can't have been reused
+                return
+    if cancel is not None:
+        threading.Thread(target=stop_on_cancel, daemon=True).start()
+    block = dict()
+    for line in iter(pope.stdout.readline, ''):
+        key, _, value = line.strip().partition('=')
+        block[key] = value
+        if key == 'progress': # Each block ends with progress=continue or progress=end
+            emit_progress(make_progress_event(block, stage, total_seconds), render)
+            block = dict()
+    pope.stdout.close()
+    done.set()
+    stderr_thread.join()
+    wait_process(pope, ffmpeg_args, started)
+    if render['open']:
+        print('')
+    if pope.returncode != 0 and not echo:
+        print(''.join(stderr_lines))
+    return pope.returncode
+
+@traced
 def gif_caption(input_filename : str, args):
     output_filename = get_output_filename(input_filename, args, '.gif')
+    partial = get_partial_filename(output_filename)
     ffmpeg_args = [ffmpeg_exe, '-hide_banner', '-i', input_filename]
     ffmpeg_args.extend(['-vf', caption(args.caption, args.font, input_filename, None)])
-    ffmpeg_args.append(output_filename)
+    ffmpeg_args.append(partial)
     print(' '.join(ffmpeg_args))
     if not args.dry_run:
-        # Use popen so we can pend on completion
-        pope = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        for line in iter(pope.stderr.readline, ""):
-            if 'frame=' in line:
-                print('\r' + line.strip(), end='')
-            else:
-                print(line, end='')
-        print('')
-        pope.stderr.close()
-        pope.wait()
-        if pope.returncode != 0:
-            raise RuntimeError('ffmpeg returned code {}'.format(pope.returncode))
+        run_ffmpeg(ffmpeg_args, 'gif', get_video_duration(input_filename, 0.0))
+        finish_output(partial, output_filename)
     return output_filename  
 
-# The part where the webm is encoded
-def encode_video(input, output, start, duration, video_codec : list, video_filters : list, audio_codec : list, audio_filters : list, subtitles, track, full_video : bool, no_audio : bool, mixdown : MixdownMode, mode : BoardMode, bframes : int, group_of_pictures: float, pix_fmt: str, dry_run : bool):
+# A name for this machine in the thread profile, so that a home directory shared by several machines keeps a profile for each
+def get_machine_id():
+    return '{}-{}-{}'.format(platform.node(), platform.machine(), os.cpu_count())
+
+# The --calibrate results of this machine: codec -> output height -> {'threads', 'tile_columns', 'fps'}. Empty if it wasn't calibrated.
+def load_thread_profile():
+    if not os.path.isfile(thread_profile_file):
+        return dict()
+    try:
+        with open(thread_profile_file, 'r') as f:
+            return json.load(f).get(get_machine_id(), dict())
+    except Exception as e:
+        print('Warning: Could not read thread profile: {}'.format(e))
+        return dict()
+
+# The most tile columns (as log2, like -tile-columns) that libvpx-vp9 allows at this output width
+def get_max_tile_columns(width : int):
+    return max(0, int(math.log2(max(width, 1) / vp9_min_tile_width)))
+
+# Thread and tile arguments for an encode at width x height. The CPU cores are split evenly between the encodes running at the same time
+# (job_state.concurrent_encodes), since ffmpeg's defaults assume each encode has the machine to itself. Within its share, an encode uses
+# the fastest setting --calibrate measured at the nearest height, or otherwise two threads per tile column with as many tile columns as
+# the width allows (x264 gets all of its share, and picks its lookahead threads from that). Other codecs are left alone.
+def get_thread_args(codec : str, width : int, height : int, row_mt : bool):
+    if codec not in ['libvpx-vp9', 'libx264']:
+        return []
+    share = max(1, (os.cpu_count() or 2) // job_state.concurrent_encodes)
+    profile = load_thread_profile().get(codec, dict())
+    entry = profile[min(profile, key=lambda x: abs(int(x) - height))] if len(profile) > 0 else None
+    if codec == 'libx264':
+        threads = min(entry['threads'], share) if entry is not None else share
+        return ['-threads', str(threads)]
+    tile_columns = min(get_max_tile_columns(width), int(math.log2(share)))
+    if entry is not None:
+        tile_columns = min(tile_columns, entry['tile_columns'])
+        threads = min(entry['threads'], share)
+    else:
+        threads = min(share, 2 ** tile_columns * (2 if row_mt else 1)) # Without -row-mt, libvpx can't use more threads than tile columns
+    return ['-threads', str(threads), '-tile-columns', str(tile_columns)]
+
+# Plan encodes that run count at a time, so that each gets its share of the CPU cores (see get_thread_args)
+@contextlib.contextmanager
+def sharing_cores(count : int):
+    previous = job_state.concurrent_encodes
+    job_state.concurrent_encodes = previous * max(1, count)
+    try:
+        yield
+    finally:
+        job_state.concurrent_encodes = previous
+
+# The -vf chain of an encode at resolution and fps (None means same as source), crop being the cropdetect filter or None.
+# Subtitle burn-in is added by build_encode_commands, and vp9_vaapi's upload filters by plan_encode.
+def get_video_filters(input_filename, crop, resolution, fps, decimate : bool, args):
+    video_filters = []
+    if crop is not None:
+        video_filters.append(crop) # Crop should precede scale filter, since it's assumed that crop params correspond to the original input
+    if resolution is not None:
+        # Constrain to a maximum of the target resolution, horizontal or vertical, while preserving the original aspect ratio
+        video_filters.append("scale='min({},iw)':'min({},ih):force_original_aspect_ratio=decrease'".format(resolution,resolution))
+    if args.hdr:
+        video_filters.append(hdr_filter)
+    if fps is not None:
+        video_filters.append('fps={}'.format(fps))
+    if decimate:
+        video_filters.append('mpdecimate') # Must follow the fps filter, which would otherwise duplicate the dropped frames right back in. -fps_mode vfr keeps the output variable rate.
+    if args.video_filter is not None: # Arbitrary user-supplied filters
+        video_filters.append(args.video_filter)
+    if args.caption is not None:
+        video_filters.append(caption(args.caption, args.font, input_filename, resolution))
+    return video_filters
+
+# The video encoder arguments of a job (without the bit rate) for an output of width x height
+def get_video_codec_args(args, width : int, height : int):
+    if args.codec == 'libvpx-vp9':
+        video_codec = ["-c:v", "libvpx-vp9", "-deadline", 'good' if args.fast else args.deadline]
+        if args.fast:
+            video_codec.extend(["-cpu-used", "5"]) # By default, this is 0, 5 means worst quality but fastest
+        elif args.cpu_used is not None:
+            video_codec.extend(["-cpu-used", str(args.cpu_used)])
+        if not args.no_mt: # Enable multithreading
+            video_codec.extend(["-row-mt", "1"])
+        video_codec.extend(get_thread_args(args.codec, width, height, not args.no_mt))
+    elif args.codec == 'libx264':
+        video_codec = ["-c:v", "libx264", "-preset", 'fast' if args.fast else 'slower']
+        video_codec.extend(get_thread_args(args.codec, width, height, True))
+    elif args.codec == 'h264_nvenc':
+        video_codec = ["-c:v", "h264_nvenc", "-preset", 'p4' if args.fast else 'p7']
+    elif args.codec == 'vp9_vaapi':
+        video_codec = ["-vaapi_device", "/dev/dri/renderD128", "-c:v", "vp9_vaapi", "-bsf:v", "vp9_raw_reorder,vp9_superframe"]
+    else:
+        raise RuntimeError("Invalid codec option '{}'".format(args.codec))
+    return video_codec
+
+# Build the two pass encode commands. Returns (pass1, pass2).
+def build_encode_commands(input, output, start, duration, video_codec : list, video_filters : list, audio_codec : list, audio_filters : list, subtitles, track, full_video : bool, no_audio : bool, mixdown : MixdownMode, mode : BoardMode, bframes : int, group_of_pictures: float, pix_fmt: str, keyframes : list = None):
     ffmpeg_args = [ffmpeg_exe, '-hide_banner']
     slice_args = ['-ss', str(start), "-t", str(duration)] # The arguments needed for slicing a clip
     vf_args = '' # The video filter arguments
@@ -1147,6 +2628,9 @@ def encode_video(input, output, start, duration, video_codec : list, video_filte
     if group_of_pictures is not None:
         ffmpeg_args.extend(["-g", str(group_of_pictures)])
 
+    if keyframes is not None and len(keyframes) > 0: # Keyframes at scene cuts, in seconds relative to the start of the output
+        ffmpeg_args.extend(["-force_key_frames", ','.join(['{:.3f}'.format(x) for x in keyframes])])
+
     if bframes != 0: # Add B-frames argument (default is 0 so it can be skipped if 0)
         ffmpeg_args.extend(["-bf", str(bframes)])
     
@@ -1156,8 +2640,12 @@ def encode_video(input, output, start, duration, video_codec : list, video_filte
     # The constructed ffmpeg commands
     pass1 = ffmpeg_args
     pass2 = ffmpeg_args.copy() # Must make deep copy, or else arguments get jumbled
-    pass1.extend(["-pass", "1"])
-    pass2.extend(["-pass", "2"])
+    passlog = get_stage_filename('pass1', 'passlog') # Unique pass 1 log prefix, so that concurrent jobs in the same directory don't share ffmpeg2pass-0.log
+    if job_state.job_dir is None: # With --resume the log is kept for the next run
+        job_state.files_to_clean.append(passlog + '-0.log') # This is the pass 1 file for vp9
+        job_state.files_to_clean.append(passlog + '-0.log.mbtree') # This is the pass 1 file for h264
+    pass1.extend(["-pass", "1", "-passlogfile", passlog])
+    pass2.extend(["-pass", "2", "-passlogfile", passlog])
     pass1.extend(["-an", "-f", "null", null_output]) # Pass 1 doesn't output to file
 
     # Audio options. wsg/gif allow audio, else omit audio
@@ -1187,32 +2675,25 @@ def encode_video(input, output, start, duration, video_codec : list, video_filte
         pass2.extend(["-an"]) # No audio
         
     pass2.append(output) # Output filename
+    return pass1, pass2
 
+# The part where the webm is encoded
+@traced
+def encode_video(pass1 : list, pass2 : list, duration, dry_run : bool):
     # Pass 1
     print('Encoding video (1st pass)')
     print(' '.join(pass1))
-    if not dry_run:
-        result = subprocess.run(pass1, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            print(result.stderr.decode())
-            raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+    inputs = get_command_inputs(pass1)
+    if not dry_run and load_checkpoint('pass1', inputs, pass1) is None:
+        run_ffmpeg(pass1, 'pass 1', duration, echo = False)
+        passlog = pass1[pass1.index('-passlogfile') + 1]
+        save_checkpoint('pass1', inputs, pass1, [x for x in [passlog + '-0.log', passlog + '-0.log.mbtree'] if os.path.isfile(x)])
 
     # Pass 2 (this takes a long time)
     print('Encoding video (2nd pass)')
     print(' '.join(pass2))
     if not dry_run:
-        # Use popen so we can pend on completion
-        pope = subprocess.Popen(pass2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        for line in iter(pope.stderr.readline, ""):
-            if 'frame=' in line:
-                print('\r' + line.strip(), end='')
-            else:
-                print(line, end='')
-        print('')
-        pope.stderr.close()
-        pope.wait()
-        if pope.returncode != 0:
-            raise RuntimeError('ffmpeg returned code {}'.format(pope.returncode))
+        run_ffmpeg(pass2, 'pass 2', duration)
 
 # Take the first second from every minute within the specified start and duration.
 # Inspired by the youtube channel @FirstSecondEveryMinute
@@ -1224,7 +2705,7 @@ def first_second_every_minute(start : datetime.timedelta, duration : datetime.ti
         current_time += datetime.timedelta(minutes=1)
     return ';'.join(segments)
 
-def get_mixdown_mode(audio_kbps, audio_track, mixdown : MixdownMode):
+def get_mixdown_mode(input_filename, audio_kbps, audio_track, mixdown : MixdownMode):
     if mixdown == MixdownMode.auto:
         if audio_kbps <= mixdown_mono_threshold:
             mixdown = MixdownMode.mono
@@ -1250,10 +2731,269 @@ def get_mixdown_mode(audio_kbps, audio_track, mixdown : MixdownMode):
         print('Audio mixdown: {}'.format(mixdown))
     return mixdown
 
-def process_video(input_filename, start, duration, args, full_video):
-    output = get_output_filename(input_filename, args)
-    original_input_filename = input_filename # For carbon copy in the case that cut or concat overwrites the input passed to final video processing
+# Pipeline stages, run by run_pipeline(). func is called with the results of the stages named in inputs, as keyword arguments.
+# cpu is the number of CPU slots the stage keeps busy, out of pipeline_cpu_slots.
+class PipelineStage:
+    __slots__ = ('name', 'func', 'inputs', 'cpu')
+
+    def __init__(self, name : str, func, inputs = (), cpu = 1):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.cpu = cpu
+
+# Where a pipeline stage prints. Stages appear in the order they were declared, as if they ran one after another:
+# a stage prints straight through once every stage before it has finished, and is buffered until then.
+class StageOutput:
+    def __init__(self, target):
+        self.target = target
+        self.buffer = []
+        self.live = False
+        self.lock = threading.Lock()
+
+    def write(self, text : str):
+        with self.lock:
+            if self.live:
+                return self.target.write(text)
+            self.buffer.append(text)
+            return len(text)
+
+    def flush(self):
+        with self.lock:
+            if self.live:
+                self.target.flush()
+
+    def go_live(self):
+        with self.lock:
+            self.target.write(''.join(self.buffer))
+            self.buffer = []
+            self.live = True
+
+# Install a StdoutRouter while the block runs, unless one is already installed (--serve and --watch install their own).
+# Pipelines running on several threads share it, and the last one to finish puts the original sys.stdout back, so API callers get theirs back.
+@contextlib.contextmanager
+def routed_stdout():
+    global installed_stdout_router, stdout_router_users
+    with stdout_router_lock:
+        if stdout_router_users == 0 and not isinstance(sys.stdout, StdoutRouter):
+            installed_stdout_router = sys.stdout = StdoutRouter(sys.stdout)
+        stdout_router_users += 1
+    try:
+        yield
+    finally:
+        with stdout_router_lock:
+            stdout_router_users -= 1
+            if stdout_router_users == 0 and installed_stdout_router is not None:
+                if sys.stdout is installed_stdout_router:
+                    sys.stdout = installed_stdout_router.stdout
+                installed_stdout_router = None
+
+# Run a dependency graph of PipelineStages on a thread pool. A stage starts as soon as its inputs are done and there are enough free CPU slots
+# (a stage that needs more slots than there are runs alone), so the total time is the critical path instead of the sum of the stages.
+# Returns the results by stage name. If a stage fails, no new stages start, and the first error is raised once the running ones are done.
+def run_pipeline(stages : list, cpu_slots = None):
+    cpu_slots = cpu_slots if cpu_slots is not None else pipeline_cpu_slots
+    with routed_stdout(): # Routes prints from stage threads to their StageOutput, and passes everything else through
+        target = job_state.output if job_state.output is not None else sys.stdout.stdout
+        outputs = [StageOutput(target) for x in stages]
+        if len(outputs) > 0:
+            outputs[0].go_live()
+        def run_stage(idx : int, kwargs : dict):
+            job_state.output = outputs[idx]
+            try:
+                return stages[idx].func(**kwargs)
+            finally:
+                outputs[idx].flush()
+        results = dict()
+        pending = list(range(len(stages)))
+        running = dict() # Future to (stage index, CPU slots)
+        finished = set()
+        used = 0
+        head = 0 # First stage that hasn't finished, in declaration order
+        error = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+            while True:
+                for idx in list(pending):
+                    stage = stages[idx]
+                    cpu = min(stage.cpu, cpu_slots)
+                    if error is None and all(x in results for x in stage.inputs) and (used + cpu <= cpu_slots or len(running) == 0):
+                        pending.remove(idx)
+                        used += cpu
+                        running[executor.submit(bind_job_state(run_stage), idx, {x : results[x] for x in stage.inputs})] = (idx, cpu)
+                if len(running) == 0:
+                    break
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    idx, cpu = running.pop(future)
+                    used -= cpu
+                    finished.add(idx)
+                    try:
+                        results[stages[idx].name] = future.result()
+                    except Exception as e:
+                        if error is None:
+                            error = e
+                while head in finished:
+                    head += 1
+                    if head < len(outputs):
+                        outputs[head].go_live()
+        for output in outputs: # Whatever is still buffered after a failure
+            output.go_live()
+        if error is not None:
+            raise error
+        if len(pending) > 0:
+            raise RuntimeError('Pipeline stages with unknown inputs: {}'.format(', '.join(stages[x].name for x in pending)))
+        return results
+
+# Python API. An EncodeJob says what to convert, plan_encode() works out how (an EncodePlan), and execute_plan() runs the encode (an EncodeResult).
+# None of them change the options they are given, so a caller can import this module and convert any number of clips in-process.
+
+# One clip of one input file, and the options to convert it with (an argparse namespace from build_argument_parser)
+class EncodeJob:
+    __slots__ = ('input_filename', 'start', 'duration', 'full_video', 'options')
+
+    def __init__(self, input_filename : str, start : datetime.timedelta, duration : datetime.timedelta, full_video : bool, options : argparse.Namespace):
+        self.input_filename = input_filename
+        self.start = start
+        self.duration = duration
+        self.full_video = full_video # The clip is the whole file, so the encode can skip -ss/-t
+        self.options = copy.copy(options) # The caller's namespace is left alone
+
+    # Make a job from keyword options named like the command-line flags, i.e. EncodeJob.create('in.mkv', start='1:00', duration='0:30', board='gif', music_mode=True)
+    # Values are checked by the argument parser, invalid ones raise argparse.ArgumentError.
+    @classmethod
+    def create(cls, input_filename : str, start = '0.0', end = None, duration = None, **options):
+        parser = build_argument_parser(exit_on_error=False)
+        defaults = parser.parse_args([])
+        argv = []
+        for name, value in options.items():
+            if not hasattr(defaults, name):
+                raise TypeError("Unknown option '{}'".format(name))
+            if value is True:
+                argv.append('--{}'.format(name))
+            elif value is not None and value is not False:
+                argv.append('--{}={}'.format(name, value))
+        args = parser.parse_args(argv)
+        resolve_option_aliases(args)
+        start, duration, full_video = get_clip_window(input_filename, str(start), str(end) if end is not None else None, str(duration) if duration is not None else None)
+        return cls(input_filename, start, duration, full_video, args)
+
+# Everything plan_encode() resolved for a job. options is the job's options with what planning changed (--trim_silence cuts, the mixdown mode, ...),
+# and input_filename is the file the encode reads, which is a temp file after --cut/--concat.
+class EncodePlan:
+    __slots__ = ('job', 'options', 'input_filename', 'start', 'duration', 'full_video', 'output', 'size_limit', 'audio_track', 'audio_bitrate', 'audio_size',
+                 'video_bitrate', 'resolution', 'fps', 'video_filters', 'audio_filters', 'subtitles', 'keyframes', 'carbon_copy', 'carbon_copy_command', 'pass1', 'pass2', 'partial_output', 'carbon_copy_partial', 'cache_key', 'cached_result', 'plan_time')
 
+    def __init__(self, job : EncodeJob):
+        self.job = job
+        self.options = copy.copy(job.options)
+        self.input_filename = job.input_filename
+        self.start = job.start
+        self.duration = job.duration
+        self.full_video = job.full_video
+        self.output = None
+        self.size_limit = None # Bytes
+        self.audio_track = None # None for the default track
+        self.audio_bitrate = None # i.e. '96k', None without audio
+        self.audio_size = 0 # Bytes
+        self.video_bitrate = None # i.e. '1200k'
+        self.resolution = None # None for the source resolution
+        self.fps = None # None for the source frame rate
+        self.video_filters = []
+        self.audio_filters = []
+        self.subtitles = '' # Subtitle file for burn-in, quoted for the filter graph
+        self.keyframes = None # Forced keyframes with --scene_keyframes, in seconds
+        self.carbon_copy = None # --cc output file name
+        self.carbon_copy_command = None # None if the carbon copy is a plain copy of the cut/concat temp file
+        self.pass1 = None # ffmpeg commands
+        self.pass2 = None
+        self.partial_output = None # Where pass 2 writes, moved to output when it's done (see get_partial_filename)
+        self.carbon_copy_partial = None
+        self.cache_key = None # Result cache key, None if the job isn't cached
+        self.cached_result = None # Result cache file with the output of an identical job. Planning stops early and the encode copies this instead.
+        self.plan_time = 0.0 # Seconds
+
+# What execute_plan() produced
+class EncodeResult:
+    __slots__ = ('output', 'carbon_copy', 'size', 'size_limit', 'plan_time', 'encode_time', 'process_usage')
+
+    def __init__(self, plan : EncodePlan):
+        self.output = plan.output
+        self.carbon_copy = plan.carbon_copy
+        self.size = None # Bytes, None after a dry run
+        self.size_limit = plan.size_limit
+        self.plan_time = plan.plan_time # Seconds
+        self.encode_time = 0.0
+        self.process_usage = [] # Resource usage of every child process of the job, see wait_process
+
+# The audio track picked with --audio_index or --audio_lang, None for the default track
+def select_audio_track(input_filename, args):
+    audio_track = None
+    if args.audio_index is not None:
+        track_list = list_audio(input_filename)
+        if args.audio_index in track_list.keys():
+            print('Selected audio track: {}'.format(args.audio_index))
+            audio_track = args.audio_index
+        else:
+            print('Warning: Audio track {} not found, using default audio track.'.format(args.audio_index))
+    elif args.audio_lang is not None:
+        track_list = list_audio(input_filename)
+        for key, value in track_list.items():
+            if value == args.audio_lang:
+                audio_track = key
+                print('Selected audio track: {}'.format(key))
+                break
+        if audio_track is None:
+            print('Warning: Audio language {} not found, using default audio track.'.format(args.audio_lang))
+    return audio_track
+
+# Determine if we need to burn in subtitles. Embedded subtitles are exported to a temp file. Returns the file name quoted for the filter graph, or '' for none.
+def export_subtitles(input_filename, args):
+    subs = ''
+    if args.sub_file is not None:
+        if not os.path.exists(args.sub_file):
+            print("Warning: Subtitle file '{}' not found, skipping subtitle burn-in.".format(args.sub_file))
+        subs = "'{}'".format(args.sub_file.replace("'", "'\\\\\\''"))
+    elif args.auto_subs or args.sub_index is not None or args.sub_lang is not None:
+        sub_idx = None
+        # Use the first sub index, if any exist
+        if args.auto_subs:
+            sub_list = list_subtitles(input_filename)
+            for key in sub_list.keys():
+                print('Auto sub: {},{}'.format(key,sub_list[key]))
+                sub_idx = key
+                break
+            if sub_idx is None:
+                print('Auto sub: No subtitles detected.')
+        elif args.sub_index is not None:
+            sub_list = list_subtitles(input_filename)
+            if args.sub_index in sub_list.keys():
+                sub_idx = args.sub_index
+            else:
+                print("Warning: Subtitle index {} not found, skipping subtitle burn-in. Use --list_subs for info on this file.".format(args.sub_index))
+        elif args.sub_lang is not None:
+            sub_list = list_subtitles(input_filename)
+            for key, value in sub_list.items():
+                if value == args.sub_lang:
+                    sub_idx = key
+            if sub_idx is None:
+                print("Warning: Subtitle language '{}' not found, skipping subtitle burn-in. Use --list_subs for info on this file.".format(args.sub_lang))
+        # Export embedded subs to a temporary file.
+        # For some reason, using the subs embedded in the source file causes inconsistent results, but this approach seems to work reliably with clips.
+        if sub_idx is not None:
+            print("Exporting embedded subtitles to temp file")
+            output_subs = get_stage_filename('subtitles', 'ass')
+            if os.path.exists(output_subs):
+                os.remove(output_subs)
+            result = run_subprocess([ffmpeg_exe, '-i', input_filename, '-map', '0:s:{}'.format(sub_idx), output_subs], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if result.returncode != 0:
+                print(result.stderr)
+                raise RuntimeError("Error rendering subtitles. ffmpeg returned {}".format(result.returncode))
+            subs = "'{}'".format(output_subs)
+    return subs
+
+# Apply --trim_silence, --cut, --concat and --first_second_every_minute to a clip. Cuts are rendered to a temp file (see segment_video).
+# Changes args.cut and args.concat. Returns (input_filename, start, duration, full_video) of the trimmed clip.
+def trim_clip(input_filename, start, duration, full_video, args):
     if args.trim_silence is not None:
         silence_segments = silencedetect(input_filename, start, duration)
         if len(silence_segments) == 0:
@@ -1324,146 +3064,240 @@ def process_video(input_filename, start, duration, args, full_video):
         duration = get_video_duration(input_filename, start.total_seconds())
         print("Using cut file '{}', duration: {}".format(new_filename,duration))
         full_video = True
-    
+    return input_filename, start, duration, full_video
+
+# --stage: copy the clip, plus stage_padding seconds on either side, from the input to --stage_dir (local disk or tmpfs) in one sequential read,
+# so that the analysis passes, the audio render and both encode passes read the copy instead of each seeking into a slow or remote input.
+# The streams are copied as they are (-c copy) with their timestamps (-copyts), and the clip start is moved back by how much later the copy starts.
+# A clip that is the whole file is copied as is. --cut and --concat render a local file of their own, so they aren't staged.
+# Returns (input_filename, start, duration, full_video), with the input unchanged if the copy fails.
+@traced
+def stage_clip(input_filename, start, duration, full_video, args):
+    if args.cut is not None or args.concat is not None or args.first_second_every_minute:
+        return input_filename, start, duration, full_video
+    extension = os.path.splitext(input_filename)[1] if full_video else '.mkv'
+    if job_state.job_dir is not None: # --resume keeps the copy with the job
+        staged = get_stage_filename('stage', extension.lstrip('.'))
+    else:
+        handle, staged = tempfile.mkstemp(prefix='webm-for-4chan-', suffix=extension, dir=args.stage_dir)
+        os.close(handle)
+        job_state.files_to_clean.append(staged)
+    if full_video:
+        params = ['copy', staged]
+        if load_checkpoint('stage', [input_filename], params) is None:
+            print('Staging "{}" to "{}"'.format(input_filename, staged))
+            shutil.copyfile(input_filename, staged)
+            save_checkpoint('stage', [input_filename], params, [staged])
+        return staged, start, duration, full_video
+    window_start = max(start - datetime.timedelta(seconds=stage_padding), datetime.timedelta(0))
+    window_duration = start - window_start + duration + datetime.timedelta(seconds=stage_padding)
+    ffmpeg_args = [ffmpeg_exe, '-hide_banner', '-y', '-ss', str(window_start), '-t', str(window_duration), '-i', input_filename,
+                   '-map', '0', '-map', '-0:d', '-c', 'copy', '-copyts', staged] # Data streams usually can't go into mkv
+    checkpoint = load_checkpoint('stage', [input_filename], ffmpeg_args)
+    if checkpoint is not None:
+        offset = checkpoint['result']
+    else:
+        print('Staging the clip to "{}"'.format(staged))
+        print(' '.join(ffmpeg_args))
+        result = run_subprocess(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
+        if result.returncode != 0 or not os.path.isfile(staged) or os.path.getsize(staged) == 0:
+            print(result.stderr)
+            print('Error staging the clip (ffmpeg returned code {}). Reading the input directly.'.format(result.returncode))
+            return input_filename, start, duration, full_video
+        offset = get_start_time(staged) - get_start_time(input_filename) # Where the copy starts on the input's timeline
+        save_checkpoint('stage', [input_filename], ffmpeg_args, [staged], offset)
+    start = max(start - datetime.timedelta(seconds=offset), datetime.timedelta(0))
+    print('Staged clip starts at {} in the copy'.format(format_timedelta(start)))
+    return staged, start, duration, full_video
+
+# Move the start of a clip past black frames at its start (--blackframe). Returns (start, duration, full_video).
+def skip_black_frames(input_filename, start, duration, full_video):
+    frame_skip = blackframe(input_filename, start, duration)
+    if frame_skip.total_seconds() > 0:
+        start += frame_skip
+        duration -= frame_skip
+        full_video = False # If skipping frames, it can no longer be possible that full video is rendered
+    print('Advancing start time by {}'.format(frame_skip))
+    return start, duration, full_video
+
+# Work out how to convert a job. This runs everything up to the encode itself: silence and black frame trimming, the cut/concat render,
+# the audio render, subtitle export, and the resolution/fps analysis.
+def plan_encode(job : EncodeJob) -> EncodePlan:
+    started = time.perf_counter()
+    plan = EncodePlan(job)
+    args = plan.options
+    input_filename = job.input_filename
+    start = job.start
+    duration = job.duration
+    full_video = job.full_video
+    if args.resume:
+        job_state.job_dir = get_job_dir(input_filename, start, duration, full_video, args)
+        print('Job directory: {}'.format(job_state.job_dir))
+    output = get_output_filename(input_filename, args)
+
+    plan.cache_key = get_result_cache_key(job)
+    if plan.cache_key is not None:
+        plan.cached_result = get_cached_result(plan.cache_key, os.path.splitext(output)[1])
+        if plan.cached_result is not None:
+            print('Found the output of an identical job in the result cache')
+            plan.output = output
+            plan.partial_output = get_partial_filename(output)
+            plan.size_limit = get_size_limit(args)
+            plan.plan_time = time.perf_counter() - started
+            return plan
+
+    if args.stage:
+        input_filename, start, duration, full_video = stage_clip(input_filename, start, duration, full_video, args)
+    input_filename, start, duration, full_video = trim_clip(input_filename, start, duration, full_video, args)
+
     # Duration check to make sure it will fit for the target board
     duration_check(duration, args.board, args.no_duration_check)
 
     if args.blackframe:
-        frame_skip = blackframe(input_filename, start, duration)
-        if frame_skip.total_seconds() > 0:
-            start += frame_skip
-            duration -= frame_skip
-            full_video = False # If skipping frames, it can no longer be possible that full video is rendered
-        print('Advancing start time by {}'.format(frame_skip))
+        start, duration, full_video = skip_black_frames(input_filename, start, duration, full_video)
 
-    audio_track = None
-    if args.audio_index is not None:
-        track_list = list_audio(input_filename)
-        if args.audio_index in track_list.keys():
-            print('Selected audio track: {}'.format(args.audio_index))
-            audio_track = args.audio_index
-        else:
-            print('Warning: Audio track {} not found, using default audio track.'.format(args.audio_index))
-    elif args.audio_lang is not None:
-        track_list = list_audio(input_filename)
-        for key, value in track_list.items():
-            if value == args.audio_lang:
-                audio_track = key
-                print('Selected audio track: {}'.format(key))
-                break
-        if audio_track is None:
-            print('Warning: Audio language {} not found, using default audio track.'.format(args.audio_lang))
+    # From here on the clip is fixed, and the remaining analysis forms a dependency graph. Independent probes and passes run at the same time.
 
-    # Calculate video bitrate by first calculating the audio size and subtracting it
-    no_audio = False
-    audio_size = 0
-    surround_workaround = None
-    af = None
-    audio_bitrate = '96k'
-    if args.no_audio or str(args.board) == 'other':
-        no_audio = True
-    else:
+    # Render the audio to measure its size. Returns (audio_size, audio_bitrate, af, surround_workaround, no_audio)
+    def plan_audio(audio_track):
+        if args.no_audio or str(args.board) == 'other':
+            return 0, '96k', None, None, True
         print('Calculating audio bitrate: ', end='') # Do a lot of prints in case there is an error on one of the steps or it hangs
         audio_kbps = args.audio_rate if args.audio_rate is not None else calculate_target_audio_rate(duration, args.music_mode, args.board)
         audio_bitrate = '{}k'.format(audio_kbps)
         print(audio_bitrate)
-        args.mixdown = get_mixdown_mode(audio_kbps, audio_track, args.mixdown) # Determine mixdown, if any
+        args.mixdown = get_mixdown_mode(input_filename, audio_kbps, audio_track, args.mixdown) # Determine mixdown, if any
         print('Calculating audio size')
         # Calculate the audio file size and the volume normalization parameters if applicable. Always skip normalization in music mode.
         acodec = 'libopus' if (args.codec == 'libvpx-vp9' or args.codec == 'vp9_vaapi') else 'aac'
         audio_size, af, surround_workaround, no_audio = calculate_audio_size(input_filename, start, duration, audio_bitrate, audio_track, args.board, acodec, args.mixdown, args.normalize, args.no_dynaudnorm)
         print('Audio size: {}kB'.format(int(audio_size/1024)))
-    size_limit = get_size_limit(args)
-    adjusted_size_limit = size_limit - audio_size # File budget subtracting audio
-    size_kb = adjusted_size_limit / 1024 * 8 # File budget in kilobits
-    target_kbps = min((int)(size_kb / duration.total_seconds()), max_bitrate) # Bit rate in kilobits/sec, limit to max size so that small clips aren't unnecessarily large
-    compensated_kbps = target_kbps - calculate_bitrate_compensation(duration, args.bitrate_compensation) # Subtract the compensation factor if specified
-    video_bitrate = '{}k'.format(compensated_kbps)
+        return audio_size, audio_bitrate, af, surround_workaround, no_audio
 
-    # Determine if we need to burn in subtitles
-    subs = ''
-    if args.sub_file is not None:
-        if not os.path.exists(args.sub_file):
-            print("Warning: Subtitle file '{}' not found, skipping subtitle burn-in.".format(args.sub_file))
-        subs = "'{}'".format(args.sub_file.replace("'", "'\\\\\\''"))
-    elif args.auto_subs or args.sub_index is not None or args.sub_lang is not None:
-        sub_idx = None
-        # Use the first sub index, if any exist
-        if args.auto_subs:
-            sub_list = list_subtitles(input_filename)
-            for key in sub_list.keys():
-                print('Auto sub: {},{}'.format(key,sub_list[key]))
-                sub_idx = key
-                break
-            if sub_idx is None:
-                print('Auto sub: No subtitles detected.')
-        elif args.sub_index is not None:
-            sub_list = list_subtitles(input_filename)
-            if args.sub_index in sub_list.keys():
-                sub_idx = args.sub_index
+    def detect_crop():
+        if args.auto_crop:
+            return cropdetect(input_filename, start, duration)
+        elif args.crop:
+            return 'crop={}'.format(args.crop)
+        return None
+
+    # Sampled frame analysis, used for duplicate frame decimation and motion-aware fps selection
+    # With --scene_keyframes the whole clip is decoded once, and the other analyzers use that decode instead of sampling.
+    def sample_frames():
+        if args.scene_keyframes or args.decimate == DecimateMode.auto or (args.fps is None and args.fps_calc == FpsCalcMode.motion):
+            return analyze_frames(input_filename, start, duration, args.scene_keyframes)
+        return None
+
+    # Warm the probe cache for the resolution and fps calculations. Errors are left to the stage that needs the value.
+    def probe_source():
+        try:
+            if not args.no_resize and args.resolution is None:
+                get_video_resolution(input_filename)
+            if args.fps is None:
+                get_source_fps(input_filename)
+        except Exception:
+            pass
+
+    # Video bit rate from what is left after the audio. Returns (size_limit, compensated_kbps, effective_kbps, decimate)
+    def plan_bitrate(audio, analysis):
+        audio_size = audio[0]
+        size_limit = get_size_limit(args)
+        adjusted_size_limit = size_limit - audio_size # File budget subtracting audio
+        size_kb = adjusted_size_limit / 1024 * 8 # File budget in kilobits
+        target_kbps = min((int)(size_kb / duration.total_seconds()), max_bitrate) # Bit rate in kilobits/sec, limit to max size so that small clips aren't unnecessarily large
+        compensated_kbps = target_kbps - calculate_bitrate_compensation(duration, args.bitrate_compensation) # Subtract the compensation factor if specified
+
+        # Content with a lot of repeated frames (anime on 2s/3s, slideshows, screen recordings) doesn't need the duplicates encoded.
+        decimate = args.decimate == DecimateMode.always
+        effective_kbps = compensated_kbps # The bitrate the resolution calculation sees, adjusted for frames that won't be encoded
+        if args.decimate == DecimateMode.auto and analysis is not None:
+            total_frames = analysis['frames']
+            kept_frames = analysis['kept']
+            duplicate_ratio = 1.0 - kept_frames / total_frames
+            print('Duplicate frames: {:.1f}% ({} of {} sampled frames)'.format(duplicate_ratio * 100, total_frames - kept_frames, total_frames))
+            if duplicate_ratio >= decimate_threshold:
+                decimate = True
+                # Extrapolate the sampled frame counts to the whole clip
+                source_frames = int(duration.total_seconds() * total_frames / analysis['seconds'])
+                effective_frames = int(source_frames * kept_frames / total_frames)
+                print('Decimating duplicate frames. Effective frame count: {} of {}'.format(effective_frames, source_frames))
+                # The bit budget is spread over the frames that remain, so each real frame gets proportionally more bits
+                effective_kbps = min(int(compensated_kbps * total_frames / max(kept_frames, 1)), max_bitrate)
+        return size_limit, compensated_kbps, effective_kbps, decimate
+
+    def plan_resolution(bitrate, probe):
+        print('Calculating resolution: ', end='')
+        resolution = None
+        if not args.no_resize: # --no_resize argument skips the scale filter altogether
+            if args.resolution is not None: # Manual resolution override
+                resolution = args.resolution
+            else: # Use resolution lookup map
+                resolution = calculate_target_resolution(duration, input_filename, bitrate[2], args.resize_mode, args.bypass_resolution_table, start, args.codec) # Look up the appropriate resolution cap in the table
+        if resolution is None:
+            print('same as source')
+        else:
+            print(resolution)
+        return resolution
+
+    def plan_fps(bitrate, resolution, analysis, probe):
+        print('Calculating fps: ', end='')
+        fps = args.fps
+        motion = None
+        bpp = None
+        if fps is None:
+            if args.fps_calc == FpsCalcMode.motion:
+                fps, motion, bpp = calculate_motion_fps(input_filename, start, duration, bitrate[2], resolution, analysis) # Weigh the motion in the clip against the bits available per pixel
             else:
-                print("Warning: Subtitle index {} not found, skipping subtitle burn-in. Use --list_subs for info on this file.".format(args.sub_index))
-        elif args.sub_lang is not None:
-            sub_list = list_subtitles(input_filename)
-            for key, value in sub_list.items():
-                if value == args.sub_lang:
-                    sub_idx = key
-            if sub_idx is None:
-                print("Warning: Subtitle language '{}' not found, skipping subtitle burn-in. Use --list_subs for info on this file.".format(args.sub_lang))
-        # Export embedded subs to a temporary file.
-        # For some reason, using the subs embedded in the source file causes inconsistent results, but this approach seems to work reliably with clips.
-        if sub_idx is not None:
-            print("Exporting embedded subtitles to temp file")
-            output_subs = get_temp_filename('ass')
-            files_to_clean.append(output_subs)
-            if os.path.exists(output_subs):
-                os.remove(output_subs)
-            result = subprocess.run([ffmpeg_exe, '-i', input_filename, '-map', '0:s:{}'.format(sub_idx), output_subs], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if result.returncode != 0:
-                print(result.stderr)
-                raise RuntimeError("Error rendering subtitles. ffmpeg returned {}".format(result.returncode))
-            subs = "'{}'".format(output_subs)
-    
-    crop = None
-    if args.auto_crop:
-        crop = cropdetect(input_filename, start, duration)
-    elif args.crop:
-        crop = 'crop={}'.format(args.crop)
-
-    print('Calculating resolution: ', end='')
-    resolution = None
-    if not args.no_resize: # --no_resize argument skips the scale filter altogether
-        if args.resolution is not None: # Manual resolution override
-            resolution = args.resolution
-        else: # Use resolution lookup map
-            resolution = calculate_target_resolution(duration, input_filename, compensated_kbps, args.resize_mode, args.bypass_resolution_table) # Look up the appropriate resolution cap in the table
-    if resolution is None:
-        print('same as source')
-    else:
-        print(resolution)
-    
-    print('Calculating fps: ', end='')
-    fps = args.fps if args.fps is not None else calculate_target_fps(input_filename, duration) # Look up the target fps
-    if fps is not None:
-        print(fps)
-    else:
-        print('same as source')
+                fps = calculate_target_fps(input_filename, duration) # Look up the target fps
+        print(fps if fps is not None else 'same as source', end='')
+        if motion is not None:
+            print(' (motion score: {:.4f}, bits per pixel: {:.4f})'.format(motion, bpp), end='')
+        print('')
+        return fps
+
+    results = run_pipeline([
+        PipelineStage('audio_track', lambda: select_audio_track(input_filename, args)),
+        PipelineStage('audio', plan_audio, ['audio_track']),
+        PipelineStage('subtitles', lambda: export_subtitles(input_filename, args)),
+        PipelineStage('crop', detect_crop),
+        PipelineStage('analysis', sample_frames),
+        PipelineStage('probe', probe_source),
+        PipelineStage('bitrate', plan_bitrate, ['audio', 'analysis']),
+        PipelineStage('resolution', plan_resolution, ['bitrate', 'probe'], cpu = pipeline_cpu_slots if args.resize_mode == ResizeMode.complexity else 1), # The complexity probe runs its trial encodes in parallel
+        PipelineStage('fps', plan_fps, ['bitrate', 'resolution', 'analysis', 'probe']),
+    ])
+    audio_track = results['audio_track']
+    audio_size, audio_bitrate, af, surround_workaround, no_audio = results['audio']
+    subs = results['subtitles']
+    crop = results['crop']
+    analysis = results['analysis']
+    size_limit, compensated_kbps, effective_kbps, decimate = results['bitrate']
+    video_bitrate = '{}k'.format(compensated_kbps)
+    resolution = results['resolution']
+    fps = results['fps']
+
+    # Try the neighboring resolutions and frame rates on short samples and keep the best looking one
+    if args.search and not (args.no_resize and args.fps is not None):
+        try:
+            resolution, fps, ssim = search_resolution_fps(input_filename, start, duration, compensated_kbps, resolution, fps, crop, decimate, subs, args)
+            print('Search result: resolution {}, fps {} (SSIM {:.5f})'.format(resolution if resolution is not None else 'same as source', fps if fps is not None else 'same as source', ssim))
+        except Exception as e:
+            print(e)
+            print('Error searching resolution and fps candidates. Using calculated values.')
+
+    # Place keyframes at scene cuts and let the keyframe interval stretch everywhere else
+    keyframes = None
+    group_of_pictures = args.group_of_pictures
+    if args.scene_keyframes and analysis is not None:
+        keyframes = get_scene_keyframes(analysis['cuts'])
+        if group_of_pictures is None:
+            output_fps = fps if fps is not None else get_source_fps(input_filename)
+            if output_fps is not None:
+                group_of_pictures = int(max_keyframe_interval * output_fps)
+        print('Scene cuts: {}, forcing {} keyframes (maximum keyframe interval: {} frames)'.format(len(analysis['cuts']), len(keyframes), group_of_pictures))
 
     # Add video filter arguments
-    video_filters = []
-    if crop is not None:
-        video_filters.append(crop) # Crop should precede scale filter, since it's assumed that crop params correspond to the original input
-    if resolution is not None:
-        # Constrain to a maximum of the target resolution, horizontal or vertical, while preserving the original aspect ratio
-        video_filters.append("scale='min({},iw)':'min({},ih):force_original_aspect_ratio=decrease'".format(resolution,resolution))
-    if args.hdr:
-        video_filters.append("zscale=t=linear:npl=100,format=gbrpf32le,zscale=p=bt709,tonemap=tonemap=hable:desat=0,zscale=t=bt709:m=bt709:r=tv,format=yuv420p")
-    if fps is not None:
-        video_filters.append('fps={}'.format(fps))
-    if args.video_filter is not None: # Arbitrary user-supplied filters
-        video_filters.append(args.video_filter)
-    if args.caption is not None:
-        video_filters.append(caption(args.caption, args.font, input_filename, resolution))
+    video_filters = get_video_filters(input_filename, crop, resolution, fps, decimate, args)
     
     # Add audio filters
     audio_filters = []
@@ -1481,25 +3315,14 @@ def process_video(input_filename, start, duration, args, full_video):
     if args.audio_filter is not None:
         audio_filters.append(args.audio_filter)
     
-    video_codec = []
-    if args.codec == 'libvpx-vp9':
-        video_codec = ["-c:v", "libvpx-vp9", "-deadline", 'good' if args.fast else args.deadline]
-        files_to_clean.append('ffmpeg2pass-0.log') # This is the pass 1 file for vp9
-        if args.fast:
-            video_codec.extend(["-cpu-used", "5"]) # By default, this is 0, 5 means worst quality but fastest
-        if not args.no_mt: # Enable multithreading
-            video_codec.extend(["-row-mt", "1"])
-    elif args.codec == 'libx264':
-        video_codec = ["-c:v", "libx264", "-preset", 'fast' if args.fast else 'slower']
-        files_to_clean.append('ffmpeg2pass-0.log.mbtree') # This is the pass 1 file for h264
-    elif args.codec == 'h264_nvenc':
-        video_codec = ["-c:v", "h264_nvenc", "-preset", 'p4' if args.fast else 'p7']
-        files_to_clean.append('ffmpeg2pass-0.log.mbtree') # This is the pass 1 file for h264
-    elif args.codec == 'vp9_vaapi':
-        video_codec = ["-vaapi_device", "/dev/dri/renderD128", "-c:v", "vp9_vaapi", "-bsf:v", "vp9_raw_reorder,vp9_superframe"]
+    # Output dimensions, for the thread and tile settings
+    output_width, output_height = get_video_resolution(input_filename)
+    if resolution is not None:
+        output_width, output_height = get_scaled_dimensions(output_width, output_height, resolution)
+
+    video_codec = get_video_codec_args(args, output_width, output_height)
+    if args.codec == 'vp9_vaapi':
         video_filters.extend(['format=nv12','hwupload'])
-    else:
-        raise RuntimeError("Invalid codec option '{}'".format(args.codec))
     print('Target bitrate: {}'.format(video_bitrate))
     video_codec.extend(["-b:v", video_bitrate, "-async", "1", "-fps_mode", "vfr"])
     
@@ -1513,35 +3336,465 @@ def process_video(input_filename, start, duration, args, full_video):
 
     # Carbon Copy
     if args.cc:
-        print('Making Carbon Copy...')
-        carbon_copy_output = get_output_filename(original_input_filename, args, suffix='.mkv')
         # For efficiency, we can simply copy cut/concat temp files because it's exactly the format we're looking for
         if args.concat is not None or args.cut is not None:
-            shutil.copyfile(input_filename, carbon_copy_output)
+            plan.carbon_copy = get_output_filename(job.input_filename, args, suffix='.mkv') # Named after the original input, not the temp file
+            plan.carbon_copy_partial = get_partial_filename(plan.carbon_copy)
         else:
-            carbon_copy_output = get_output_filename(input_filename, args, suffix='.mkv')
+            plan.carbon_copy = get_output_filename(job.input_filename, args, suffix='.mkv') # Not named after the --stage copy
+            plan.carbon_copy_partial = get_partial_filename(plan.carbon_copy)
             carbon_copy_cmd = [ffmpeg_exe, '-hide_banner']
             if subs == '': # Burn-in subtitles
                 carbon_copy_cmd.extend(['-ss', str(start), "-t", str(duration), '-i', input_filename])
             else:
                 carbon_copy_cmd.extend(['-i', input_filename, '-ss', str(start), "-t", str(duration)])
                 carbon_copy_cmd.extend(['-vf', f'subtitles={subs}'])
-            carbon_copy_cmd.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-c:a', 'libopus', '-b:a', '512k', '-sn', carbon_copy_output])
-            result = subprocess.run(carbon_copy_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
-            if result.returncode != 0 or not os.path.isfile(carbon_copy_output):
-                print(' '.join(carbon_copy_cmd))
+            carbon_copy_cmd.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-c:a', 'libopus', '-b:a', '512k', '-sn', plan.carbon_copy_partial])
+            plan.carbon_copy_command = carbon_copy_cmd
+
+    plan.partial_output = get_partial_filename(output)
+    plan.pass1, plan.pass2 = build_encode_commands(input_filename, plan.partial_output, start, duration, video_codec, video_filters, audio_codec, audio_filters, subs, audio_track, full_video, no_audio, args.mixdown, args.board, args.bframes, group_of_pictures, args.pix_fmt, keyframes)
+    plan.input_filename = input_filename
+    plan.start = start
+    plan.duration = duration
+    plan.full_video = full_video
+    plan.output = output
+    plan.size_limit = size_limit
+    plan.audio_track = audio_track
+    plan.audio_bitrate = None if no_audio else audio_bitrate
+    plan.audio_size = audio_size
+    plan.video_bitrate = video_bitrate
+    plan.resolution = resolution
+    plan.fps = fps
+    plan.video_filters = video_filters
+    plan.audio_filters = audio_filters
+    plan.subtitles = subs
+    plan.keyframes = keyframes
+    plan.plan_time = time.perf_counter() - started
+    return plan
+
+# Run the encode of a plan (and the carbon copy, with --cc)
+def execute_plan(plan : EncodePlan) -> EncodeResult:
+    started = time.perf_counter()
+    def carbon_copy():
+        print('Making Carbon Copy...')
+        if plan.carbon_copy_command is None:
+            shutil.copyfile(plan.input_filename, plan.carbon_copy_partial)
+        else:
+            result = run_subprocess(plan.carbon_copy_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
+            if result.returncode != 0 or not os.path.isfile(plan.carbon_copy_partial):
+                print(' '.join(plan.carbon_copy_command))
                 print(result.stderr)
                 raise RuntimeError('Error rendering carbon copy. ffmpeg return code: {}'.format(result.returncode))
-        print(f'Carbon Copy: {carbon_copy_output}')
+        finish_output(plan.carbon_copy_partial, plan.carbon_copy)
+        print(f'Carbon Copy: {plan.carbon_copy}')
 
-    # The main part where the video is rendered
-    encode_video(input_filename, output, start, duration, video_codec, video_filters, audio_codec, audio_filters, subs, audio_track, full_video, no_audio, args.mixdown, args.board, args.bframes, args.group_of_pictures, args.pix_fmt, args.dry_run)
+    # The main part where the video is rendered. The carbon copy renders next to it and leaves the encode all but one CPU slot.
+    if plan.cached_result is not None:
+        stages = [PipelineStage('encode', lambda: shutil.copyfile(plan.cached_result, plan.partial_output))]
+    else:
+        stages = [PipelineStage('encode', lambda: encode_video(plan.pass1, plan.pass2, plan.duration, plan.options.dry_run), cpu = max(1, pipeline_cpu_slots - 1))]
+        if plan.carbon_copy is not None:
+            stages.append(PipelineStage('carbon_copy', carbon_copy))
+    run_pipeline(stages)
 
-    if os.path.isfile(output):
-        out_size = os.path.getsize(output)
-        print('output file size: {} KB'.format(int(out_size/1024)))
-        if out_size > size_limit:
-            print('WARNING: Output size exceeded target maximum {}. You should rerun with -b/--bitrate_compensation to reduce output size.'.format(int(size_limit/1024)))
+    result = EncodeResult(plan)
+    if finish_output(plan.partial_output, plan.output):
+        result.size = os.path.getsize(plan.output)
+        print('output file size: {} KB'.format(int(result.size/1024)))
+        if result.size > plan.size_limit:
+            print('WARNING: Output size exceeded target maximum {}. You should rerun with -b/--bitrate_compensation to reduce output size.'.format(int(plan.size_limit/1024)))
+        if job_state.job_dir is not None and job_state.do_cleanup: # The job is done, nothing left to resume
+            shutil.rmtree(job_state.job_dir, ignore_errors=True)
+        if plan.cache_key is not None and plan.cached_result is None:
+            store_cached_result(plan.cache_key, plan.output, plan.options.cache_quota if plan.options.cache_quota is not None else result_cache_quota)
+    result.encode_time = time.perf_counter() - started
+    result.process_usage = list(job_state.process_usage)
+    return result
+
+@traced
+def process_video(input_filename, start, duration, args, full_video):
+    result = execute_plan(plan_encode(EncodeJob(input_filename, start, duration, full_video, args)))
+    report_process_usage(result.process_usage, result.output, args.metrics)
+    return result.output
+
+# --split: convert a long clip into numbered parts (name.part01.webm, ...) that each fit the board, --workers (or encode_workers) at a time.
+# All parts get the same resolution and fps, the lowest that any part was planned with, so that they look alike back to back. Returns the output file names.
+@traced
+def split_video(input_filename, start, duration, args, full_video):
+    parts = split_job(EncodeJob(input_filename, start, duration, full_video, args))
+    if len(parts) == 1:
+        print('The clip fits the {} duration limit, no need to split it'.format(args.board))
+        return [process_video(input_filename, start, duration, args, full_video)]
+    print('Splitting into {} parts: {}'.format(len(parts), ', '.join('{}-{}'.format(format_timedelta(x.start), format_timedelta(x.start + x.duration)) for x in parts)))
+    # Name the parts up front, so that any overwrite prompts come before the work starts
+    extension = get_output_extension(args.codec)
+    base = get_output_filename(input_filename, args, suffix='.part01' + extension)[:-len('.part01' + extension)]
+    for idx, part in enumerate(parts):
+        part.options.output = '{}.part{:02}{}'.format(base, idx + 1, extension)
+        if idx > 0:
+            get_output_filename(input_filename, part.options)
+    workers = args.workers if args.workers is not None else encode_workers
+    with sharing_cores(min(workers, len(parts))):
+        plans = run_pipeline([PipelineStage('part{}'.format(idx + 1), functools.partial(plan_encode, part)) for idx, part in enumerate(parts)], cpu_slots=workers)
+    plans = [plans['part{}'.format(idx + 1)] for idx in range(len(parts))]
+
+    # Plans that came from the result cache were already made consistent when they were encoded
+    planned = [x for x in plans if x.cached_result is None]
+    resolutions = [x.resolution for x in planned if x.resolution is not None]
+    fps_values = [x.fps for x in planned if x.fps is not None]
+    resolution = min(resolutions) if len(resolutions) > 0 else None
+    fps = min(fps_values) if len(fps_values) > 0 else None
+    print('All parts use resolution {} and fps {}'.format(resolution if resolution is not None else 'same as source', fps if fps is not None else 'same as source'))
+    replan = []
+    for idx, plan in enumerate(plans):
+        if plan.cached_result is None and (plan.resolution != resolution or plan.fps != fps):
+            options = copy.copy(parts[idx].options)
+            options.resolution = resolution
+            options.fps = fps
+            options.search = False # Both are decided
+            replan.append(PipelineStage('part{}'.format(idx + 1), functools.partial(plan_encode, EncodeJob(parts[idx].input_filename, parts[idx].start, parts[idx].duration, False, options))))
+    if len(replan) > 0:
+        print('Planning {} part(s) again with the common resolution and fps'.format(len(replan)))
+        with sharing_cores(min(workers, len(parts))):
+            replanned = run_pipeline(replan, cpu_slots=workers)
+        for name, plan in replanned.items():
+            plans[int(name[len('part'):]) - 1] = plan
+
+    results = run_pipeline([PipelineStage('part{}'.format(idx + 1), functools.partial(execute_plan, plan)) for idx, plan in enumerate(plans)], cpu_slots=workers)
+    outputs = [results['part{}'.format(idx + 1)].output for idx in range(len(plans))]
+    report_process_usage(job_state.process_usage, outputs[0], args.metrics)
+    return outputs
+
+# Convert one job on the calling thread, with fresh job state, and clean up its temp files afterwards.
+# This is the entry point for Python callers, i.e. encode(EncodeJob.create('in.mkv', duration='0:30', board='gif')).output
+def encode(job : EncodeJob) -> EncodeResult:
+    job_state.reset()
+    job_state.interactive = False # Nobody to answer prompts, an existing output file needs yes=True
+    job_state.do_cleanup = not job.options.keep_temp_files
+    job_state.use_analysis_cache = not job.options.no_analysis_cache
+    try:
+        return execute_plan(plan_encode(job))
+    finally:
+        cleanup()
+
+# Split a job into consecutive parts that each fit the board's maximum duration. The parts are about equally long, and each boundary moves
+# up to split_snap_window seconds to the middle of a silence, or to a scene cut with --scene_keyframes, so that parts don't start mid-sentence or mid-shot.
+# The parts keep the job's options, including the output name. Returns [job] if it fits in one part.
+def split_job(job : EncodeJob) -> list:
+    args = job.options
+    if args.cut is not None or args.concat is not None or args.first_second_every_minute:
+        raise RuntimeError('--split cannot be combined with --cut, --concat or --first_second_every_minute')
+    limit = get_max_duration(args.board)
+    total = job.duration.total_seconds()
+    count = math.ceil(total / limit - 1e-9)
+    if count <= 1:
+        return [job]
+    # Analysis of the whole clip, shared by all boundaries. Both results are cached, so the parts' own analysis of their windows is all that's left.
+    candidates = []
+    if not args.no_audio and str(args.board) != 'other': # Boards without sound don't care about silence
+        try:
+            candidates.extend(((x + y) / 2).total_seconds() for x, y in silencedetect(job.input_filename, job.start, job.duration))
+        except Exception as e:
+            print(e)
+            print('Error detecting silence. Part boundaries will not be moved to silences.')
+    if args.scene_keyframes:
+        analysis = analyze_frames(job.input_filename, job.start, job.duration, True)
+        if analysis is not None:
+            candidates.extend(analysis['cuts'])
+    boundaries = [0.0]
+    for idx in range(1, count):
+        previous = boundaries[-1]
+        remaining = count - idx + 1 # Parts left, including this one
+        target = previous + (total - previous) / remaining
+        # Stay within the snap window, keep this part under the limit, and leave no more than the remaining parts can hold
+        low = max(target - split_snap_window, total - (remaining - 1) * limit)
+        high = min(target + split_snap_window, previous + limit)
+        snapped = [x for x in candidates if low <= x <= high]
+        boundaries.append(min(snapped, key=lambda x: abs(x - target)) if len(snapped) > 0 else target)
+    boundaries.append(total)
+    return [EncodeJob(job.input_filename, job.start + datetime.timedelta(seconds=x), datetime.timedelta(seconds=y - x), False, args) for x, y in zip(boundaries[:-1], boundaries[1:])]
+
+# The (board, codec) pairs that --boards and --codecs ask for, in command-line order. 'webm' and 'mp4' are accepted as codecs.
+def get_targets(args):
+    boards = [BoardMode(x.strip()) for x in args.boards.split(',')] if args.boards is not None else [args.board]
+    codecs = []
+    for codec in (args.codecs.split(',') if args.codecs is not None else [args.codec]):
+        codec = {'webm': 'libvpx-vp9', 'mp4': 'libx264'}.get(codec.strip(), codec.strip())
+        if codec not in video_codecs:
+            raise ValueError("Unknown codec '{}', choose from {}".format(codec, ', '.join(video_codecs)))
+        codecs.append(codec)
+    return [(board, codec) for board in boards for codec in codecs]
+
+# Render a clip with the filters that all --boards/--codecs targets share (crop, HDR tonemapping, subtitle burn-in) to a lossless file,
+# so that they run once instead of in both passes of every encode. Keeps only the selected audio track. Returns the file name.
+@traced
+def render_intermediate(input_filename, start, duration, full_video, video_filters : list, subtitles : str, audio_track):
+    output_filename = get_temp_filename('mkv')
+    job_state.files_to_clean.append(output_filename)
+    slice_args = [] if full_video else ['-ss', str(start), '-t', str(duration)]
+    ffmpeg_args = [ffmpeg_exe, '-hide_banner', '-y']
+    if subtitles != '': # The subtitles need the input's timestamps, see build_encode_commands
+        ffmpeg_args.extend(['-i', input_filename] + slice_args)
+        video_filters = video_filters + ['subtitles={}'.format(subtitles)]
+    else:
+        ffmpeg_args.extend(slice_args + ['-i', input_filename])
+    ffmpeg_args.extend(['-map', '0:v:0', '-map', '0:a:{}?'.format(audio_track if audio_track is not None else 0), '-sn'])
+    if len(video_filters) > 0:
+        ffmpeg_args.extend(['-vf', ','.join(video_filters)])
+    ffmpeg_args.extend(['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-c:a', 'flac', output_filename])
+    print('Rendering the shared intermediate...')
+    print(' '.join(ffmpeg_args))
+    result = run_subprocess(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
+    if result.returncode != 0 or not os.path.isfile(output_filename):
+        print(result.stderr)
+        raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+    return output_filename
+
+# --boards/--codecs: convert one clip for every board and codec combination in one run. Trimming, cuts and the shared filters run once
+# (see render_intermediate), probes and analysis are shared through their caches, each audio render happens once (see calculate_audio_size),
+# and the encodes run --workers (or encode_workers) at a time. Outputs are named after the board, i.e. _1_name.wsg.webm. Returns the output file names.
+@traced
+def encode_targets(input_filename, start, duration, args, full_video):
+    if args.split:
+        raise RuntimeError('--split cannot be combined with --boards or --codecs')
+    if args.cc:
+        raise RuntimeError('--cc cannot be combined with --boards or --codecs')
+    targets = get_targets(args)
+    # Name the outputs up front, so that any overwrite prompts come before the work starts
+    outputs = []
+    for board, codec in targets:
+        options = copy.copy(args)
+        options.board = board
+        options.codec = codec
+        outputs.append(get_output_filename(input_filename, options, suffix='.{}{}'.format(board, get_output_extension(codec))))
+    print('Targets: {}'.format(', '.join(outputs)))
+
+    shared = copy.copy(args)
+    source = input_filename
+    if shared.stage:
+        input_filename, start, duration, full_video = stage_clip(input_filename, start, duration, full_video, shared)
+    input_filename, start, duration, full_video = trim_clip(input_filename, start, duration, full_video, shared)
+    for board, codec in targets:
+        duration_check(duration, board, args.no_duration_check)
+    if shared.blackframe:
+        start, duration, full_video = skip_black_frames(input_filename, start, duration, full_video)
+    crop = cropdetect(input_filename, start, duration) if shared.auto_crop else 'crop={}'.format(shared.crop) if shared.crop else None
+    video_filters = ([crop] if crop is not None else []) + ([hdr_filter] if shared.hdr else [])
+    subtitles = export_subtitles(input_filename, shared)
+    intermediate = len(video_filters) > 0 or subtitles != ''
+    if intermediate:
+        audio_track = select_audio_track(input_filename, shared)
+        input_filename = render_intermediate(input_filename, start, duration, full_video, video_filters, subtitles, audio_track)
+        start = datetime.timedelta(0)
+        duration = get_video_duration(input_filename, 0.0)
+        full_video = True
+
+    jobs = []
+    for (board, codec), output in zip(targets, outputs):
+        options = copy.copy(args)
+        options.board = board
+        options.codec = codec
+        options.output = output
+        # Done once above
+        options.trim_silence = options.cut = options.concat = None
+        options.first_second_every_minute = options.blackframe = options.stage = False
+        if intermediate:
+            options.crop = None
+            options.auto_crop = options.hdr = options.auto_subs = False
+            options.sub_file = options.sub_index = options.sub_lang = None
+            options.audio_index = options.audio_lang = None
+        if input_filename != source:
+            options.no_cache = True # The result cache would be keyed by a temp file
+        jobs.append(EncodeJob(input_filename, start, duration, full_video, options))
+    # Planning one target after another lets every target after the first find the analysis and audio renders it needs already done
+    workers = args.workers if args.workers is not None else encode_workers
+    with sharing_cores(min(workers, len(jobs))):
+        plans = [plan_encode(job) for job in jobs]
+    results = run_pipeline([PipelineStage(plan.output, functools.partial(execute_plan, plan)) for plan in plans], cpu_slots=workers)
+    report_process_usage(job_state.process_usage, outputs[0], args.metrics)
+    return [results[x].output for x in outputs]
+
+# The encoders that --race runs, in --race_encoders order
+def get_race_candidates(args):
+    names = [x.strip() for x in args.race_encoders.split(',')] if args.race_encoders is not None else race_default
+    for name in names:
+        if name not in race_candidates:
+            raise ValueError("Unknown --race encoder '{}', choose from {}".format(name, ', '.join(race_candidates)))
+    return names
+
+# Options for one --race encoder. The clip was already staged and trimmed (see race_video), so those options are cleared.
+def get_race_options(args, name : str, trimmed : bool):
+    options = copy.copy(args)
+    options.fast = False
+    for key, value in race_candidates[name].items():
+        setattr(options, key, value)
+    options.trim_silence = options.cut = options.concat = None
+    options.first_second_every_minute = options.blackframe = options.stage = False
+    if trimmed:
+        options.no_cache = True # The result cache would be keyed by a temp file
+    return options
+
+# The kind of content that --race keeps its history for: the board (which sets the bit budget), how much motion there is, and whether
+# the clip is mostly duplicate frames (anime on 2s, slideshows), i.e. 'wsg/calm/animated'. Uses the (cached) frame analysis.
+def get_content_type(input_filename, start, duration, board):
+    analysis = analyze_frames(input_filename, start, duration)
+    if analysis is None or analysis['frames'] == 0:
+        return '{}/unknown'.format(board)
+    motion = next((name for limit, name in race_motion_classes if analysis['motion'] < limit), 'busy')
+    duplicate_ratio = 1.0 - analysis['kept'] / analysis['frames']
+    return '{}/{}/{}'.format(board, motion, 'animated' if duplicate_ratio >= decimate_threshold else 'live')
+
+# Content type -> the encoders that won the last race_history_length races on it, oldest first
+def load_race_history():
+    if not os.path.isfile(race_history_file):
+        return dict()
+    try:
+        with open(race_history_file, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print('Warning: Could not read race history: {}'.format(e))
+        return dict()
+
+# The encoder that won the last race_history_streak races on this kind of content, if it's one of the candidates. None means there has to be a race.
+def get_race_favorite(content_type : str, candidates : list):
+    if not job_state.use_analysis_cache:
+        return None
+    wins = load_race_history().get(content_type, [])[-race_history_streak:]
+    if len(wins) == race_history_streak and len(set(wins)) == 1 and wins[0] in candidates:
+        return wins[0]
+    return None
+
+def record_race_win(content_type : str, winner : str):
+    with race_history_lock: # Held while writing, so that no other job changes the history mid-dump
+        history = load_race_history()
+        history[content_type] = (history.get(content_type, []) + [winner])[-race_history_length:]
+        try:
+            os.makedirs(os.path.dirname(race_history_file), exist_ok=True)
+            with open(race_history_file + '.tmp', 'w') as f:
+                json.dump(history, f)
+            os.replace(race_history_file + '.tmp', race_history_file)
+        except Exception as e:
+            print('Warning: Could not write race history: {}'.format(e))
+
+# SSIM of a finished encode against its clip of the source with the filters the encode applied (crop, scale, tonemapping, captions).
+# Frame rate changes are left out of the reference, so that every source frame is compared.
+def score_output(plan : EncodePlan):
+    width, height = get_video_resolution(plan.output)
+    return measure_ssim(plan.input_filename, plan.start, plan.duration, get_reference_filters(plan.video_filters), plan.output, width, height)
+
+# --race: encode the clip with several encoders at once (see race_candidates), score every output against the source with SSIM,
+# and keep the best looking one that fits the size limit. With --race_budget, once that many seconds have passed and an output fits,
+# the encodes still running are stopped and the best output so far wins. The winners of full races are remembered per content type
+# (see get_content_type), and once one encoder won race_history_streak races in a row, clips of that type skip the race and use it. Returns the output file name.
+@traced
+def race_video(input_filename, start, duration, args, full_video):
+    if args.split or args.boards is not None or args.codecs is not None or args.cc:
+        raise RuntimeError('--race cannot be combined with --split, --boards, --codecs or --cc')
+    names = get_race_candidates(args)
+    source = input_filename
+    shared = copy.copy(args)
+    if shared.stage:
+        input_filename, start, duration, full_video = stage_clip(input_filename, start, duration, full_video, shared)
+    input_filename, start, duration, full_video = trim_clip(input_filename, start, duration, full_video, shared)
+    duration_check(duration, args.board, args.no_duration_check)
+    if shared.blackframe:
+        start, duration, full_video = skip_black_frames(input_filename, start, duration, full_video)
+    content_type = get_content_type(input_filename, start, duration, args.board)
+    favorite = get_race_favorite(content_type, names)
+    if favorite is not None:
+        print('{} won the last {} races on {} content, using it without a race'.format(favorite, race_history_streak, content_type))
+        options = get_race_options(args, favorite, input_filename != source)
+        options.output = get_output_filename(source, options)
+        return process_video(input_filename, start, duration, options, full_video)
+
+    # Name the output up front for every extension the encoders make, so that any overwrite prompts come before the work starts.
+    # The placeholders of the extensions that lose are removed by cleanup().
+    outputs = dict()
+    jobs = []
+    for name in names:
+        options = get_race_options(args, name, input_filename != source)
+        extension = get_output_extension(options.codec)
+        if extension not in outputs:
+            outputs[extension] = get_output_filename(source, options)
+        # Each encoder writes next to the final output, so that the winner is moved into place on the same file system
+        stem, ext = os.path.splitext(get_partial_filename(outputs[extension]))
+        options.output = '{}.{}{}'.format(stem, name, ext)
+        job_state.files_to_clean.append(options.output)
+        jobs.append(EncodeJob(input_filename, start, duration, full_video, options))
+    print('Racing {} on {} content'.format(', '.join(names), content_type))
+
+    # Every encoder gets the first one's resolution and fps, so that the race is between encoders and not between plans.
+    # Planning one after another lets every encoder after the first find the analysis and audio renders already done.
+    workers = args.workers if args.workers is not None else len(jobs)
+    with sharing_cores(min(workers, len(jobs))):
+        plans = [plan_encode(jobs[0])]
+        for job in jobs[1:]:
+            if plans[0].cached_result is None:
+                job.options.resolution = plans[0].resolution
+                job.options.no_resize = plans[0].resolution is None
+                job.options.fps = plans[0].fps
+                job.options.search = False # Both are decided
+            plans.append(plan_encode(job))
+
+    cancel = threading.Event()
+    lock = threading.Lock()
+    race = {'expired': False, 'finished': []} # finished holds (name, plan, ssim, size) of the outputs that fit, in the order they finished
+    started = time.perf_counter()
+    def run_encoder(name : str, plan : EncodePlan):
+        if cancel.is_set():
+            print('{}: not started, the race is over'.format(name))
+            return None
+        try:
+            result = execute_plan(plan)
+        except Exception as e:
+            if not cancel.is_set():
+                print(e)
+                print('{}: encode failed'.format(name))
+            else:
+                print('{}: stopped, the race is over'.format(name))
+            return None
+        if args.dry_run:
+            return None
+        if result.size is None or result.size > plan.size_limit:
+            print("{}: doesn't fit".format(name))
+            return None
+        ssim = score_output(plan)
+        print('{}: {} KB, SSIM {:.5f} after {:.1f} seconds'.format(name, int(result.size / 1024), ssim, time.perf_counter() - started))
+        with lock:
+            race['finished'].append((name, plan, ssim, result.size))
+            if race['expired']:
+                cancel.set()
+        return ssim
+    def budget_expired():
+        with lock:
+            race['expired'] = True
+            if len(race['finished']) > 0:
+                print('The --race_budget is up, stopping the encodes still running')
+                cancel.set()
+    timer = threading.Timer(args.race_budget, budget_expired) if args.race_budget is not None else None
+    previous_cancel = job_state.cancel
+    job_state.cancel = cancel # Handed to the encoder threads by run_pipeline
+    try:
+        if timer is not None:
+            timer.start()
+        run_pipeline([PipelineStage(name, functools.partial(run_encoder, name, plan)) for name, plan in zip(names, plans)], cpu_slots=workers)
+    finally:
+        job_state.cancel = previous_cancel
+        if timer is not None:
+            timer.cancel()
+    if args.dry_run:
+        return next(iter(outputs.values()))
+    if len(race['finished']) == 0:
+        raise RuntimeError('None of the --race encoders made an output that fits')
+
+    name, plan, ssim, size = max(race['finished'], key=lambda x: (x[2], -x[3], -names.index(x[0]))) # Ties go to the smaller output, then to the encoder listed first
+    output = outputs[get_output_extension(plan.options.codec)]
+    finish_output(plan.output, output)
+    print('{} wins with SSIM {:.5f}'.format(name, ssim))
+    if not cancel.is_set(): # A race cut short by --race_budget says which encoder is fastest, not which is best
+        record_race_win(content_type, name)
+    report_process_usage(job_state.process_usage, output, args.metrics)
     return output
 
 # Figures out which input is image and which is audio. Returns (image, audio), which may be None if image or audio couldn't be found.
@@ -1563,7 +3816,9 @@ def get_image_audio_inputs(args : list):
     return image, audio
 
 # Special mode for combining a static image (or animated gif) with an audio file
+@traced
 def image_audio_combine(input_image, input_audio, args):
+    args = copy.copy(args) # The board, codec and rates picked here are for this job only
     if args.duration is not None or args.start != '0.0' or args.end is not None:
         print('Warning: start, end, and duration are not used in image + audio mode. Parameters will be ignored.')
     if str(args.board) == 'other':
@@ -1598,7 +3853,7 @@ def image_audio_combine(input_image, input_audio, args):
         audio_kbps = args.audio_rate if args.audio_rate is not None else max([x for x in audio_bitrate_table if x <= max_audio_rate])
         audio_bitrate = '{}k'.format(audio_kbps)
         print(audio_bitrate)
-        args.mixdown = get_mixdown_mode(audio_kbps, None, args.mixdown) # Determine mixdown, if any
+        args.mixdown = get_mixdown_mode(input_audio, audio_kbps, None, args.mixdown) # Determine mixdown, if any
         print('Calculating audio size')
         audio_size = 0
         audio_copy = False
@@ -1700,43 +3955,35 @@ def image_audio_combine(input_image, input_audio, args):
     # Finalize with the output file itself
     # Need to specify the audio's duration in order to make the output length exactly match,
     # the -t method is more reliable than the -shortest flag, which tends to overshoot the length
-    ffmpeg_args.extend(['-t', str(duration), output]) 
+    partial = get_partial_filename(output)
+    ffmpeg_args.extend(['-t', str(duration), partial]) 
 
     print('Target bitrate: {}'.format(video_bitrate))
     print(' '.join(ffmpeg_args))
     if not args.dry_run:
-        # Use popen so we can pend on completion
-        pope = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        for line in iter(pope.stderr.readline, ""):
-            if 'frame=' in line:
-                print('\r' + line.strip(), end='')
-            else:
-                print(line, end='')
-        pope.stderr.close()
-        pope.wait()
-        if pope.returncode != 0:
-            raise RuntimeError('ffmpeg returned code {}'.format(pope.returncode))
-    if os.path.isfile(output):
+        run_ffmpeg(ffmpeg_args, 'image + audio', duration)
+    if finish_output(partial, output):
         out_size = os.path.getsize(output)
         print('output file size: {} KB'.format(int(out_size/1024)))
         if out_size > size_limit:
             print('WARNING: Output size exceeded target maximum {}. You should rerun with --bitrate_compensation to reduce output size.'.format(int(size_limit/1024)))
+    report_process_usage(job_state.process_usage, output, args.metrics)
     return output
 
 def extract_jpg(input_filename : str):
     output_filename = get_temp_filename('jpg')
     # -frames:v 1 -update 1
     ffmpeg_cmd = [ffmpeg_exe, '-hide_banner', '-i', input_filename, '-frames:v', '1', '-update', '1', output_filename ]
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
+    result = run_subprocess(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
     if result.returncode != 0 or not os.path.isfile(output_filename):
         print(' '.join(ffmpeg_cmd))
         print(result.stderr)
         raise RuntimeError('Error exporting jpg. ffmpeg return code: {}'.format(result.returncode))
-    files_to_clean.append(output_filename)
+    job_state.files_to_clean.append(output_filename)
     return output_filename  
 
 def extract_audio(input_filename : str):
-    result = subprocess.run([ffprobe_exe,"-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", input_filename], stdout=subprocess.PIPE, text=True)
+    result = run_subprocess([ffprobe_exe,"-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name", "-of", "default=noprint_wrappers=1:nokey=1", input_filename], stdout=subprocess.PIPE, text=True)
     if result.returncode != 0:
         print(result.stderr)
         raise RuntimeError('Error determining audio codec. ffprobe return code: {}'.format(result.returncode))
@@ -1752,12 +3999,12 @@ def extract_audio(input_filename : str):
         raise RuntimeError(f'Unsupported audio codec "{acodec}"')
     output_filename = get_temp_filename(output_ext)
     ffmpeg_cmd = [ffmpeg_exe, '-hide_banner', '-i', input_filename, '-vn', '-c:a', 'copy', output_filename ]
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
+    result = run_subprocess(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, encoding='utf-8', errors='ignore')
     if result.returncode != 0 or not os.path.isfile(output_filename):
         print(' '.join(ffmpeg_cmd))
         print(result.stderr)
         raise RuntimeError('Error extracting audio. ffmpeg return code: {}'.format(result.returncode))
-    files_to_clean.append(output_filename)
+    job_state.files_to_clean.append(output_filename)
     return output_filename
 
 # Figures out which input is video and which is audio. Returns the tuple (video, audio), which may be None if video or audio couldn't be found.
@@ -1778,7 +4025,9 @@ def get_video_audio_inputs(args : list):
             raise RuntimeError(f"Unsupported mime type '{type}/{encoding}' for input file '{filename}'")
     return video, audio
 
+@traced
 def audio_replace(video_input, audio_input, args):
+    args = copy.copy(args) # The board, codec and rates picked here are for this job only
     if args.duration is not None or args.start != '0.0' or args.end is not None:
         print('Warning: start, end, and duration are not used in audio replace mode. Parameters will be ignored.')
     if str(args.board) == 'other':
@@ -1790,9 +4039,9 @@ def audio_replace(video_input, audio_input, args):
         print("Warning: --concat and --cut are not supported in audio replace mode. Parameters will be ignored.")
     # Create a temp file that has no sound
     video_out_no_sound = get_temp_filename(os.path.splitext(video_input)[-1].replace('.',''))
-    files_to_clean.append(video_out_no_sound)
+    job_state.files_to_clean.append(video_out_no_sound)
     ffmpeg_cmd1 = [ffmpeg_exe, '-hide_banner', '-i', video_input, '-c:v', 'copy', '-an', video_out_no_sound]
-    result = subprocess.run(ffmpeg_cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    result = run_subprocess(ffmpeg_cmd1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     if result.returncode != 0 or not os.path.isfile(video_out_no_sound):
         print(' '.join(ffmpeg_cmd1))
         print(result.stderr)
@@ -1821,254 +4070,849 @@ def audio_replace(video_input, audio_input, args):
     audio_bitrate = '{}k'.format(audio_kbps)
     print(audio_bitrate)
     # Note that '-t' is to limit duration to the video length in case audio is longer
-    ffmpeg_args.extend(['-b:a', audio_bitrate, '-t', str(vduration.total_seconds()), output_filename])
+    partial = get_partial_filename(output_filename)
+    ffmpeg_args.extend(['-b:a', audio_bitrate, '-t', str(vduration.total_seconds()), partial])
     print(' '.join(ffmpeg_args))
     if not args.dry_run:
-        # Use popen so we can pend on completion
-        pope = subprocess.Popen(ffmpeg_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
-        for line in iter(pope.stderr.readline, ""):
-            if 'frame=' in line:
-                print('\r' + line.strip(), end='')
-            else:
-                print(line, end='')
-        pope.stderr.close()
-        pope.wait()
-        if pope.returncode != 0:
-            raise RuntimeError('ffmpeg returned code {}'.format(pope.returncode))
-    if os.path.isfile(output_filename):
+        run_ffmpeg(ffmpeg_args, 'audio replace', vduration)
+    if finish_output(partial, output_filename):
         out_size = os.path.getsize(output_filename)
         print('output file size: {} KB'.format(int(out_size/1024)))
         size_limit = get_size_limit(args)
         if out_size > size_limit:
             print('WARNING: Output size exceeded target maximum {}. Note that this mode does not re-encode video. Try a different video/audio candidate.'.format(int(size_limit/1024)))
+    report_process_usage(job_state.process_usage, output_filename, args.metrics)
     return output_filename
 
-do_cleanup = True
-def cleanup():
-    if do_cleanup:
+# --serve mode. Jobs are command lines submitted over HTTP, which a pool of worker threads runs through main().
+# Probe results and the analysis cache stay in memory between jobs, and each job's output is captured in an event log that clients can poll or stream.
+active_server = None # The running --serve server, so that the signal handler can shut it down
+
+class ServeJob:
+    def __init__(self, job_id : str, argv : list):
+        self.id = job_id
+        self.argv = argv
+        self.status = 'queued' # queued, running, done or failed
+        self.result = None # Output file name
+        self.error = None
+        self.events = []
+        self.condition = threading.Condition(threading.RLock())
+
+    def emit(self, event : dict):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def set_status(self, status : str):
+        with self.condition: # Status and its event change together, so that event streams never see a finished job with events still missing
+            self.status = status
+            self.emit({'type': 'status', 'status': status})
+
+    def summary(self):
+        return {'id': self.id, 'args': self.argv, 'status': self.status, 'result': self.result, 'error': self.error}
+
+# Collects what a job prints and turns it into log events, one per line. ffmpeg progress lines ending in a carriage return count as lines too.
+class ServeJobOutput:
+    def __init__(self, job : ServeJob):
+        self.job = job
+        self.buffer = ''
+
+    def write(self, text : str):
+        self.buffer += text
+        lines = re.split(r'[\r\n]', self.buffer)
+        self.buffer = lines.pop()
+        for line in lines:
+            if line.strip() != '':
+                self.job.emit({'type': 'log', 'text': line})
+        return len(text)
+
+    def flush(self):
+        if self.buffer.strip() != '':
+            self.job.emit({'type': 'log', 'text': self.buffer})
+        self.buffer = ''
+
+# Stand-in for sys.stdout that sends prints from a job's worker thread to that job's event log, and everything else to the terminal
+class StdoutRouter:
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text : str):
+        target = job_state.output if job_state.output is not None else self.stdout
+        return target.write(text)
+
+    def flush(self):
+        target = job_state.output if job_state.output is not None else self.stdout
+        target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+# The serve_rejected_options that a submitted job's arguments use, parsed the way main parses them so that abbreviations (--ytdlp) are caught too.
+# Raises ValueError if the arguments don't parse.
+def get_rejected_serve_options(argv : list):
+    try:
+        args, _ = build_argument_parser(exit_on_error=False).parse_known_args(argv)
+    except argparse.ArgumentError as e:
+        raise ValueError(str(e))
+    except SystemExit:
+        raise ValueError('Invalid arguments')
+    rejected = []
+    for name in serve_rejected_options:
+        value = getattr(args, name)
+        if value is not None and value is not False and not (name == 'progress_json' and value == '-'): # Progress JSON on stdout goes to the job's events
+            rejected.append('--' + name)
+    return rejected
+
+def run_serve_job(job : ServeJob, workers : int):
+    job_state.reset()
+    job_state.interactive = False
+    job_state.concurrent_encodes = workers
+    job_state.output = ServeJobOutput(job)
+    job_state.progress_listener = job.emit # Progress events become job events instead of terminal output
+    job.set_status('running')
+    with running_job():
+        try:
+            job.result = main(job.argv)
+            job.emit({'type': 'result', 'output': job.result})
+            job.set_status('done')
+        except BaseException as e: # Includes SystemExit, which must not take the worker thread down with it
+            job.error = str(e) if not isinstance(e, SystemExit) else 'Job exited with code {}'.format(e.code)
+            print(traceback.format_exc())
+            job.emit({'type': 'error', 'error': job.error})
+            job.set_status('failed')
+        finally:
+            cleanup()
+            job_state.output.flush()
+            job_state.output = None
+
+def serve_worker(jobs : queue.Queue, workers : int):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        run_serve_job(job, workers)
+
+class ServeRequestHandler(http.server.BaseHTTPRequestHandler):
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix' # Unix socket clients have no address
+
+    def send_json(self, code : int, value):
+        body = (json.dumps(value) + '\n').encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_job(self, job_id : str):
+        with self.server.jobs_lock:
+            return self.server.jobs.get(job_id)
+
+    # Clients on HOST:PORT must send the server's token as "Authorization: Bearer <token>". The unix socket is only open to its owner, so it needs none.
+    def check_token(self):
+        if self.server.token is None:
+            return True
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() == 'bearer' and secrets.compare_digest(token.strip().encode(), self.server.token.encode()):
+            return True
+        self.send_json(401, {'error': 'Missing or wrong token'})
+        return False
+
+    # Submit a job. The body is a JSON object with the command-line arguments under "args", either as a list or as a single string.
+    # Only application/json is accepted, which web pages can't send to another origin without a preflight.
+    def do_POST(self):
+        if not self.check_token():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': 'Content-Type must be application/json'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            argv = request.get('args', []) if isinstance(request, dict) else request
+            if isinstance(argv, str):
+                argv = shlex.split(argv)
+            if not isinstance(argv, list) or not all(isinstance(x, str) for x in argv):
+                raise ValueError('"args" must be a list of strings or a string')
+            rejected = get_rejected_serve_options(argv)
+            if len(rejected) > 0:
+                raise ValueError('{} cannot be used by a submitted job'.format(', '.join(rejected)))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        with self.server.jobs_lock:
+            self.server.job_count += 1
+            job = ServeJob(str(self.server.job_count), argv)
+            self.server.jobs[job.id] = job
+        job.emit({'type': 'status', 'status': job.status})
+        self.server.job_queue.put(job)
+        self.send_json(201, job.summary())
+
+    def do_GET(self):
+        if not self.check_token():
+            return
+        parts = [x for x in self.path.split('?')[0].split('/') if x != '']
+        if parts == ['jobs']:
+            with self.server.jobs_lock:
+                jobs = list(self.server.jobs.values())
+            self.send_json(200, [x.summary() for x in jobs])
+            return
+        job = self.get_job(parts[1]) if len(parts) >= 2 and parts[0] == 'jobs' else None
+        if job is None or len(parts) > 3 or (len(parts) == 3 and parts[2] != 'events'):
+            self.send_json(404, {'error': 'Not found'})
+            return
+        if len(parts) == 2:
+            self.send_json(200, job.summary())
+            return
+        # Stream the job's events as newline-delimited JSON until the job finishes
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        sent = 0
+        while True:
+            with job.condition:
+                while sent == len(job.events) and job.status not in ('done', 'failed'):
+                    job.condition.wait()
+                events = job.events[sent:]
+                finished = job.status in ('done', 'failed')
+            try:
+                for event in events:
+                    self.wfile.write((json.dumps(event) + '\n').encode())
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                return # Client went away, the job keeps running
+            sent += len(events)
+            if finished and sent == len(job.events):
+                return
+
+class ServeHTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+class ServeUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+# Run the job server until interrupted. address is HOST:PORT (HOST defaults to localhost) or unix:/path/to/socket.
+def serve(address : str, workers : int):
+    global active_server
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise RuntimeError('{} exists and is not a socket'.format(socket_path))
+            os.remove(socket_path) # Stale socket from a previous run
+        umask = os.umask(0o077) # Only the owner can connect
+        try:
+            server = ServeUnixServer(socket_path, ServeRequestHandler)
+        finally:
+            os.umask(umask)
+        server.token = None
+    else:
+        socket_path = None
+        host, _, port = address.rpartition(':')
+        server = ServeHTTPServer((host if host != '' else '127.0.0.1', int(port)), ServeRequestHandler)
+        server.token = serve_token or secrets.token_urlsafe(24)
+    server.jobs = dict()
+    server.jobs_lock = threading.Lock()
+    server.job_count = 0
+    server.job_queue = queue.Queue()
+    sys.stdout = StdoutRouter(sys.stdout)
+    threads = [threading.Thread(target=serve_worker, args=(server.job_queue, max(1, workers)), daemon=True) for x in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    active_server = server
+    print('Serving on {} with {} worker(s)'.format(address, len(threads)))
+    if server.token is not None and serve_token is None:
+        print('Token: {}'.format(server.token))
+    try:
+        server.serve_forever()
+    finally:
+        active_server = None
+        server.server_close()
+        for thread in threads:
+            server.job_queue.put(None) # Let idle workers exit. Running jobs are interrupted along with their ffmpeg processes.
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+        cleanup_running_jobs() # The worker threads are daemons, and the jobs still running when the process exits don't get to clean up
+        sys.stdout = sys.stdout.stdout
+        print('Server stopped.')
+
+active_watch = None # threading.Event that stops the running --watch loop, so that the signal handler can end it
+
+# The files a --watch directory had converted, with their size and modification time at the time, so that a restart doesn't convert them again.
+# Outputs written into the directory are listed too, so that they aren't mistaken for new inputs.
+class WatchIndex:
+    def __init__(self, directory : str):
+        self.filename = os.path.join(watch_index_dir, hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16] + '.json')
+        self.lock = threading.Lock()
+        self.entries = dict() # File name -> {'size', 'mtime', 'status', 'output'}. status is done, failed or output.
+        if os.path.isfile(self.filename):
+            try:
+                with open(self.filename, 'r') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print('Warning: Could not read watch index: {}'.format(e))
+
+    # True if the file was handled as it is now. A file that changed since is converted again.
+    def contains(self, name : str, size : int, mtime : int):
+        with self.lock:
+            entry = self.entries.get(name)
+            return entry is not None and entry['size'] == size and entry['mtime'] == mtime
+
+    def add(self, name : str, size : int, mtime : int, status : str, output = None):
+        with self.lock:
+            self.entries[name] = {'size': size, 'mtime': mtime, 'status': status, 'output': output}
+            try:
+                os.makedirs(watch_index_dir, exist_ok=True)
+                with open(self.filename + '.tmp', 'w') as f:
+                    json.dump(self.entries, f)
+                os.replace(self.filename + '.tmp', self.filename)
+            except Exception as e:
+                print('Warning: Could not write watch index: {}'.format(e))
+
+# Prints of a --watch job, one line at a time and prefixed with the input's name, so that jobs running at the same time can be told apart
+class WatchJobOutput:
+    lock = threading.Lock()
+
+    def __init__(self, stdout, name : str):
+        self.stdout = stdout
+        self.prefix = '[{}] '.format(name)
+        self.buffer = ''
+
+    def write(self, text : str):
+        self.buffer += text
+        lines = re.split(r'[\r\n]', self.buffer)
+        self.buffer = lines.pop()
+        with WatchJobOutput.lock:
+            for line in lines:
+                if line.strip() != '':
+                    self.stdout.write(self.prefix + line + '\n')
+            self.stdout.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer.strip() != '':
+            with WatchJobOutput.lock:
+                self.stdout.write(self.prefix + self.buffer + '\n')
+                self.stdout.flush()
+        self.buffer = ''
+
+# Files in a watched directory that are inputs: media files that aren't hidden (partial outputs), outputs of this script (_1_name) or its temp files
+def is_watch_input(entry : os.DirEntry):
+    name = entry.name
+    if name.startswith('.') or re.match(r'_\d+_', name) or re.match(r'temp(\.\d+)?\.', name):
+        return False
+    return os.path.splitext(name)[1].lower() in watch_extensions and entry.is_file()
+
+# The command line without --watch and --workers. This is the argument profile every watched file is converted with.
+def get_watch_profile(argv : list):
+    profile = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ['--watch', '--workers']:
+            skip = True
+        elif not (arg.startswith('--watch=') or arg.startswith('--workers=')):
+            profile.append(arg)
+    return profile
+
+# Convert new and changed media files in a directory as they show up, until interrupted.
+# The directory is polled, and a file is queued once it stops changing. workers files are converted at the same time.
+def watch(directory : str, workers : int, profile : list):
+    global active_watch
+    if not os.path.isdir(directory):
+        raise RuntimeError("Watch directory '{}' not found".format(directory))
+    index = WatchIndex(directory)
+    tasks = queue.Queue()
+    active = set() # Names of the files queued or being converted
+    active_lock = threading.Lock()
+    stop = threading.Event()
+
+    def convert(name : str, size : int, mtime : int):
+        job_state.reset()
+        job_state.interactive = False
+        job_state.concurrent_encodes = max(1, workers)
+        job_state.output = WatchJobOutput(sys.stdout.stdout, name)
+        job_state.progress_listener = lambda event: None # Progress lines of several jobs would only garble each other
+        output = None
+        with running_job():
+            try:
+                output = main(profile + [os.path.join(directory, name)])
+            except BaseException: # Includes SystemExit, which must not take the worker thread down with it
+                print(traceback.format_exc())
+            finally:
+                cleanup()
+                job_state.output.flush()
+                job_state.output = None
+        if stop.is_set() and output is None:
+            return # Interrupted, convert it again next time
+        index.add(name, size, mtime, 'done' if output is not None else 'failed', output)
+        for filename in (output if isinstance(output, list) else [output]): # --split makes several
+            if filename is not None and os.path.isfile(filename) and os.path.samefile(os.path.dirname(os.path.abspath(filename)), directory):
+                stat = os.stat(filename)
+                index.add(os.path.basename(filename), stat.st_size, stat.st_mtime_ns, 'output')
+
+    def worker():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if not stop.is_set():
+                convert(*task)
+            with active_lock:
+                active.discard(task[0])
+
+    sys.stdout = StdoutRouter(sys.stdout)
+    threads = [threading.Thread(target=worker, daemon=True) for x in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    active_watch = stop
+    print('Watching "{}" with {} worker(s)'.format(directory, len(threads)))
+    pending = dict() # Name -> (size, mtime, when it was first seen like that)
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            seen = set()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not is_watch_input(entry):
+                        continue
+                    stat = entry.stat()
+                    seen.add(entry.name)
+                    with active_lock:
+                        if stat.st_size == 0 or entry.name in active or index.contains(entry.name, stat.st_size, stat.st_mtime_ns):
+                            continue
+                        previous = pending.get(entry.name)
+                        if previous is None or previous[:2] != (stat.st_size, stat.st_mtime_ns):
+                            pending[entry.name] = (stat.st_size, stat.st_mtime_ns, now) # New or still changing
+                        elif now - previous[2] >= watch_settle_time:
+                            del pending[entry.name]
+                            active.add(entry.name)
+                            print('Queued "{}"'.format(entry.name))
+                            tasks.put((entry.name, stat.st_size, stat.st_mtime_ns))
+            for name in list(pending.keys()):
+                if name not in seen: # Deleted or renamed before it settled
+                    del pending[name]
+            stop.wait(watch_poll_interval)
+    finally:
+        active_watch = None
+        stop.set()
+        for thread in threads:
+            tasks.put(None) # Queued files are skipped, running jobs are interrupted along with their ffmpeg processes
+        for thread in threads:
+            thread.join()
+        sys.stdout = sys.stdout.stdout
+        print('Stopped watching.')
+
+# The (threads, tile columns) settings --calibrate tries for a codec at an output width. tile columns is None for x264.
+def get_calibration_settings(codec : str, width : int, cores : int):
+    if codec == 'libx264':
+        return [(x, None) for x in sorted(set([2 ** x for x in range(int(math.log2(cores)) + 1)] + [cores]))]
+    settings = []
+    for tile_columns in range(get_max_tile_columns(width) + 1):
+        for threads in sorted(set(min(cores, 2 ** tile_columns * x) for x in [1, 2, 4])):
+            settings.append((threads, tile_columns))
+    return settings
+
+# --calibrate: encode a synthetic clip at each of calibration_heights with every setting from get_calibration_settings, with the encoder
+# settings of a real second pass, and store the fastest setting per codec and height as this machine's thread profile (see get_thread_args)
+@traced
+def calibrate():
+    cores = os.cpu_count() or 2
+    frames = int(calibration_seconds * 30)
+    profile = dict()
+    for codec, codec_args in [('libvpx-vp9', ['-deadline', 'good', '-row-mt', '1']), ('libx264', ['-preset', 'slower'])]:
+        profile[codec] = dict()
+        for height in calibration_heights:
+            width = int(round(height * 16 / 9 / 2) * 2)
+            best = None
+            for threads, tile_columns in get_calibration_settings(codec, width, cores):
+                cmd = [ffmpeg_exe, '-hide_banner', '-v', 'error', '-f', 'lavfi', '-t', str(calibration_seconds), '-i', 'testsrc2=size={}x{}:rate=30'.format(width, height),
+                       '-c:v', codec] + codec_args + ['-threads', str(threads)]
+                if tile_columns is not None:
+                    cmd.extend(['-tile-columns', str(tile_columns)])
+                cmd.extend(['-b:v', '{}k'.format(height * 2), '-an', '-f', 'null', null_output])
+                started = time.perf_counter()
+                result = run_subprocess(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, encoding='utf-8', errors='ignore')
+                if result.returncode != 0:
+                    print(result.stderr)
+                    raise RuntimeError('ffmpeg returned code {}'.format(result.returncode))
+                fps = frames / max(time.perf_counter() - started, 1e-6)
+                print('{} {}x{}: threads {}{}: {:.1f} fps'.format(codec, width, height, threads, ', tile columns {}'.format(tile_columns) if tile_columns is not None else '', fps))
+                if best is None or fps > best['fps']:
+                    best = {'threads': threads, 'tile_columns': tile_columns, 'fps': round(fps, 2)}
+            print('{} {}x{}: using threads {}{}'.format(codec, width, height, best['threads'], ', tile columns {}'.format(best['tile_columns']) if best['tile_columns'] is not None else ''))
+            profile[codec][str(height)] = best
+    profiles = dict()
+    if os.path.isfile(thread_profile_file):
+        try:
+            with open(thread_profile_file, 'r') as f:
+                profiles = json.load(f)
+        except Exception as e:
+            print('Warning: Could not read thread profile: {}'.format(e))
+    profiles[get_machine_id()] = profile
+    os.makedirs(os.path.dirname(thread_profile_file), exist_ok=True)
+    with open(thread_profile_file + '.tmp', 'w') as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(thread_profile_file + '.tmp', thread_profile_file)
+    print('Thread profile for {} written to "{}"'.format(get_machine_id(), thread_profile_file))
+    return profile
+
+# Delete the temp files of the current job, or of the job whose job_state.__dict__ is state.
+# Another thread can be cleaning up the same job, so files that are already gone are skipped.
+def cleanup(state = None):
+    state = state if state is not None else job_state.__dict__
+    files_to_clean = list(state['files_to_clean'])
+    if state['do_cleanup']:
         for filename in files_to_clean:
             if os.path.isfile(filename):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(filename)
+    with temp_filename_lock:
+        reserved_temp_filenames.difference_update(files_to_clean) # Either gone or kept on disk, where get_temp_filename sees them
+    for filename in list(state['reserved_outputs']): # Placeholders of outputs that were never finished
+        if os.path.isfile(filename) and os.path.getsize(filename) == 0:
+            with contextlib.suppress(FileNotFoundError):
                 os.remove(filename)
+    state['reserved_outputs'] = []
+
+# Register the calling worker thread's job for cleanup_running_jobs while the block runs
+@contextlib.contextmanager
+def running_job():
+    with running_job_states_lock:
+        running_job_states[threading.get_ident()] = job_state.__dict__
+    try:
+        yield
+    finally:
+        with running_job_states_lock:
+            running_job_states.pop(threading.get_ident(), None)
+
+# Clean up after the --serve and --watch jobs that are running on worker threads
+def cleanup_running_jobs():
+    with running_job_states_lock:
+        states = list(running_job_states.values())
+    for state in states:
+        cleanup(state)
 
 def signal_handler(sig, frame):
+    if active_server is not None:
+        threading.Thread(target=active_server.shutdown).start() # shutdown() blocks until serve_forever() returns, which is running on this thread
+    if active_watch is not None:
+        active_watch.set()
     cleanup()
+    cleanup_running_jobs()
 
-if __name__ == '__main__':
+def build_argument_parser(exit_on_error = True):
+    parser = argparse.ArgumentParser(
+        prog='4chan Webm Converter',
+        exit_on_error=exit_on_error,
+        description='Attempts to fit video clips into the 4chan size limit',
+        epilog='Default behavior is to process the entire video. Specify --start and either --end or --duration to make a clip. Note that input name can be specified either with -i or by just throwing it in as a misc. argument')
+    parser.add_argument('-i', '--input', type=str, help='Input file to process')
+    parser.add_argument('-o', '--output', type=str, help='Output File name (default output is named after the input prepended with "_1_")')
+    parser.add_argument('-s', '--start', type=str, default='0.0', help='Start timestamp, i.e. 0:30:5.125')
+    parser.add_argument('-e', '--end', type=str, help='End timestamp, i.e. 0:35:0.000')
+    parser.add_argument('-d', '--duration', type=str, help='Clip duration (maximum {} seconds in wsg mode, {} for gif, {} seconds otherwise), i.e. 1:15.000'.format(max_duration[0], max_duration[1], max_duration[2]))
+    parser.add_argument('-b', '--bitrate_compensation', default=0, type=float, help='Fixed value to subtract from target bitrate (kbps). Use if your output size is overshooting')
+    parser.add_argument('-n', '--normalize', action='store_true', help='Enable 2-pass audio normalization.')
+    parser.add_argument('-r', '--resolution', type=int, help="Manual resolution override. Maximum resolution, i.e. 1280. Applied vertically and horzontally, aspect ratio is preserved.")
+    parser.add_argument('-a', '--audio_filter', type=str, help="Audio filter arguments. This string is passed directly to the -af chain.")
+    parser.add_argument('-v', '--video_filter', type=str, help="Video filter arguments. This string is passed directly to the -vf chain.")
+    parser.add_argument('-c', '--concat', '--clip', dest='concat', type=str, help='Segments to concatenate (everything BUT these are cut), separated by ";", i.e. "5:00-5:15;5:45-5:52.4"')
+    parser.add_argument('-x', '--cut', type=str, help='Segments to cut (opposite of concatenate), separated by ";", i.e. "5:00-5:15;5:45-5:52.4"')
+    parser.add_argument('-k', '--keep_temp_files', action='store_true', help="Keep temporary files generated during size calculation etc.")
+    parser.add_argument('-g', '--group_of_pictures', type=float, help="Set ffmpeg's group-of-pictures interval (-g) directly.")
+    parser.add_argument('-y', '--yes', action='store_true', help="Automatically overwrite a file if it already exists.")
+    parser.add_argument('--audio_index', type=int, help="Audio track index to select (use --list_audio if you don't know the index)")
+    parser.add_argument('--audio_lang', type=str, help="Select audio track by language, must be an exact match with what is listed in the file (use --list_audio if you don't know the language)")
+    parser.add_argument('--audio_rate', type=int, choices=audio_bitrate_table, help='Manual audio bit-rate override (kbps)')
+    parser.add_argument('--audio_replace', action='store_true', help="Special mode that replaces the audio of a clip with other audio without modifying the video.")
+    parser.add_argument('--auto_crop', action='store_true', help="Automatic crop using cropdetect.")
+    parser.add_argument('--auto_subs', action='store_true', help="Automatically burn-in the first embedded subtitles, if they exist")
+    parser.add_argument('--bframes', type=int, default=-1, help="Number of B-frames to use in video encoding (passed as the -bf option).")
+    parser.add_argument('--blackframe', action='store_true', help="Skip initial black frames using a first pass with blackframe filter.")
+    parser.add_argument('--board', '--mode', dest='board', type=BoardMode, default='wsg', choices=list(BoardMode), help='Webm convert mode. wsg=6MB with sound, gif=4MB with sound, other=4MB no sound')
+    parser.add_argument('--boards', type=str, help='Comma separated list of boards to make the clip for in one run, i.e. wsg,gif,other. Outputs are named after the board.')
+    parser.add_argument('--bypass_resolution_table', action='store_true', help='Do not snap to the nearest standard resolution and use raw calculated instead.')
+    parser.add_argument('--cache_quota', type=float, help='Size limit of the result cache in {}, in MiB. The least recently used results are removed first. Default is {}.'.format(result_cache_dir, result_cache_quota))
+    parser.add_argument('--calibrate', action='store_true', help='Measure how fast libvpx-vp9 and libx264 encode on this machine with each thread and tile column setting, and use the fastest from then on. The profile is stored in {}.'.format(thread_profile_file))
+    parser.add_argument('--caption', type=str, help='Caption text to add. Caption is rendered on top with a white background in "gif caption" meme format.')
+    parser.add_argument('--cc', action='store_true', help='Create a lossless Carbon Copy as h264+opus mkv.')
+    parser.add_argument('--codec', type=str, default='libvpx-vp9', choices=video_codecs, help='Video codec to use. Default is libvpx-vp9.')
+    parser.add_argument('--codecs', type=str, help='Comma separated list of codecs to make the clip with in one run, i.e. libvpx-vp9,libx264 (webm and mp4 also work). Combines with --boards.')
+    parser.add_argument('--cpu_used', type=int, choices=range(0, 9), metavar='{0-8}', help='The -cpu-used argument passed to ffmpeg for libvpx-vp9. Higher is faster at the expense of quality. --fast uses 5.')
+    parser.add_argument('--crop', type=str, help="Crop the video. This string is passed directly to ffmpeg's 'crop' filter. See ffmpeg documentation for details.")
+    parser.add_argument('--decimate', type=DecimateMode, default='auto', choices=list(DecimateMode), help='Drop duplicate frames with mpdecimate. auto = sample the clip and decimate if at least {:.0f}%% of frames are duplicates. Default is auto.'.format(decimate_threshold * 100))
+    parser.add_argument('--deadline', type=str, default='good', choices=['good', 'best', 'realtime'], help='The -deadline argument passed to ffmpeg. Default is "good". "best" is higher quality but slower. See libvpx-vp9 documentation for details.')
+    parser.add_argument('--download', type=str, help="Download the video using yt-dlp.")
+    parser.add_argument('--download_full', action='store_true', help="Download the full video before processing (otherwise only the clip bounded by --start and --end/--duration is downloaded).")
+    parser.add_argument('--ytdlp_args', type=str, help="Custom arguments to pass through to yt-dlp")
+    parser.add_argument('--dry_run', action='store_true', help='Make all the size calculations without encoding the webm. ffmpeg commands and bitrate calculations will be printed.')
+    parser.add_argument('--fast', action='store_true', help='Render fast at the expense of quality. Not recommended except for testing.')
+    parser.add_argument('--first_second_every_minute', action='store_true', help='Take 1 second from every minute of the input.')
+    parser.add_argument('--font', type=str, help="Font to use for captions.")
+    parser.add_argument('--fps', type=float, help='Manual fps override.')
+    parser.add_argument('--fps_calc', type=FpsCalcMode, default='motion', choices=list(FpsCalcMode), help='How to calculate target fps. motion = weigh sampled motion against the available bits per pixel, table = use time-based lookup table. Default is motion.')
+    parser.add_argument('--hdr', action='store_true', help="Process HDR input to the standard colorspace.")
+    parser.add_argument('--list_audio', action='store_true', help="List audio tracks and quit. Use if you don't know which --audio_index or --audio_lang to specify.")
+    parser.add_argument('--list_subs', action='store_true', help="List embedded subtitles and quit. Use if you don't know which --sub_index or --sub_lang to specify.")
+    parser.add_argument('--metrics', type=str, help='Append the resource usage (CPU time, peak memory, bytes read and written) of every ffmpeg/ffprobe/yt-dlp process to this JSON lines file')
+    parser.add_argument('--mono', action='store_true', help="Do mono mixdown. Equivalent to --mixdown mono")
+    parser.add_argument('--mp4', action='store_true', help="Make .mp4 instead of .webm (shortcut for --codec libx264)")
+    parser.add_argument('--music_mode', action='store_true', help="Prioritize audio quality over visual quality.")
+    parser.add_argument('--mixdown', type=MixdownMode, default='auto', choices=list(MixdownMode), help='Sound mixdown mode. Default = auto')
+    parser.add_argument('--no_analysis_cache', action='store_true', help='Do not read or write cached analysis results.')
+    parser.add_argument('--no_audio', action='store_true', help='Drop audio if it exists')
+    parser.add_argument('--no_cache', '--no-cache', dest='no_cache', action='store_true', help='Do not use the result and download caches, always download and encode.')
+    parser.add_argument('--no_duration_check', action='store_true', help='Disable max duration check')
+    parser.add_argument('--no_dynaudnorm', action='store_true', help='Disable dynamic audio normalization when downmixing.')
+    parser.add_argument('--no_resize', action='store_true', help='Disable resolution resizing (may cause file size overshoot)')
+    parser.add_argument('--no_mixdown', action='store_true', help='Disable automatic audio mixdown. Equivalent to --mixdown same_as_source.')
+    parser.add_argument('--no_mt', action='store_true', help='Disable row based multithreading (the "-row-mt 1" switch)')
+    parser.add_argument('--pix_fmt', type=str, default='yuv420p', help='Pixel format (defaults to 8-bit yuv420). Specify "same_as_souce" to omit the pix_fmt arg from ffmpeg.')
+    parser.add_argument('--progress_json', '--progress-json', dest='progress_json', type=str, nargs='?', const='-', help='Write ffmpeg progress as JSON lines to this file, or to stdout if no file is given (replaces the progress line)')
+    parser.add_argument('--race', action='store_true', help='Encode with several encoders at the same time (see --race_encoders) and keep the best looking output (by SSIM) that fits. Once one encoder keeps winning on the same kind of content, it is used without a race, unless --no_analysis_cache is given.')
+    parser.add_argument('--race_budget', type=float, help='With --race, stop the encodes still running once this many seconds have passed and an output fits, and keep the best one so far')
+    parser.add_argument('--race_encoders', type=str, help='Comma separated list of encoders for --race, from {} (default: {})'.format(', '.join(race_candidates), ','.join(race_default)))
+    parser.add_argument('--resize_mode', type=ResizeMode, default='logarithmic', choices=list(ResizeMode), help='How to calculate target resolution. table = use time-based lookup table, complexity = trial encode sampled windows to measure the content. Default is logarithmic.')
+    parser.add_argument('--resume', action='store_true', help='Keep the cut/concat render, audio measurement and pass 1 log of the job in {}. If the job is interrupted, rerunning it with the same parameters skips the stages that finished.'.format(resume_jobs_dir))
+    parser.add_argument('--scene_keyframes', action='store_true', help='Detect scene cuts with scdet and place keyframes there, stretching the keyframe interval everywhere else.')
+    parser.add_argument('--search', action='store_true', help='Encode short samples at the neighboring resolutions and frame rates, and use the one with the best SSIM score.')
+    parser.add_argument('--serve', type=str, help='Run as a daemon that accepts jobs over HTTP instead of converting a file. Listens on HOST:PORT, or on a unix socket with unix:/path/to/socket')
+    parser.add_argument('--size', '--limit', dest='size', type=float, help='Target file size limit, in MiB. Default is 6 if board is wsg, and 4 otherwise.')
+    parser.add_argument('--split', action='store_true', help='Convert a clip that is too long for the board into consecutive parts that each fit, cut at silences or scene cuts where possible.')
+    parser.add_argument('--stage', action='store_true', help='Copy the clip (stream copy, with a few seconds of padding) from the input to local disk once, and read the copy in every stage instead of the input. For inputs on network shares or slow disks.')
+    parser.add_argument('--stage_dir', type=str, help='Directory for the --stage copy (default: the system temp directory, {}). A tmpfs such as /dev/shm keeps it off the disk.'.format(tempfile.gettempdir()))
+    parser.add_argument('--static_image', action='store_true', help="Treat video as a static image and use image+audio combine mode.")
+    parser.add_argument('--stereo', action='store_true', help="Do stereo mixdown. Equivalent to --mixdown stereo")
+    parser.add_argument('--stream', action='store_true', help='With --download, analyze the video for --scene_keyframes, --decimate, motion-based fps and --trim_silence while it is still downloading.')
+    parser.add_argument('--sub_index', type=int, help="Subtitle index to burn-in (use --list_subs if you don't know the index)")
+    parser.add_argument('--sub_lang', type=str, help="Subtitle language to burn-in, must be an exact match with what is listed in the file (use --list_subs if you don't know the language)")
+    parser.add_argument('--sub_file', type=str, help='Filename of subtitles to burn-in (use --sub_index or --sub_lang for embedded subs)')
+    parser.add_argument('--trace', type=str, help='Write a timing trace of every stage and ffmpeg/ffprobe/yt-dlp call to this file, in Chrome trace format (open it in Perfetto)')
+    parser.add_argument('--trim_silence', type=SilenceTrimMode, choices=list(SilenceTrimMode), help="Skip silence using a first pass with silencedetect filter. Skip silence at the start, end, or cut all detected silence.")
+    parser.add_argument('--use_fallback', action='store_true', help="If yt-dlp doesn't report the file it downloaded (older versions) and the file it predicted isn't there, use a file with the same name and another extension instead of stopping. yt-dlp sometimes falls back to an inferior video type.")
+    parser.add_argument('--watch', type=str, help='Watch a directory and convert media files as they show up, with the other arguments on the command line. Runs until interrupted.')
+    parser.add_argument('--workers', type=int, help='Number of jobs that --serve or --watch runs at the same time (default: 1), or parts and targets that --split, --boards and --codecs encode at the same time (default: {}), or encoders that --race runs at the same time (default: all)'.format(encode_workers))
+    return parser
+
+# Run one job from command-line arguments (sys.argv if argv is None). Returns the output file name (a list of them with --split), or None if nothing was rendered.
+def main(argv = None):
+    parser = build_argument_parser()
+    args, unknown_args = parser.parse_known_args(argv)
+    if help in args:
+        parser.print_help()
+    if args.serve is not None: # Daemon mode, jobs are submitted over the socket
+        if not job_state.interactive:
+            raise RuntimeError('--serve cannot be used by a submitted job')
+        serve(args.serve, args.workers or 1)
+        return None
+    if args.calibrate: # Measure the thread and tile settings of this machine
+        calibrate()
+        return None
+    if args.watch is not None: # Convert files dropped into a directory
+        if not job_state.interactive:
+            raise RuntimeError('--watch cannot be used by a submitted job')
+        watch(args.watch, args.workers or 1, get_watch_profile(argv if argv is not None else sys.argv[1:]))
+        return None
+    if args.keep_temp_files:
+        job_state.do_cleanup = False
+    if args.no_analysis_cache:
+        job_state.use_analysis_cache = False
+    job_state.progress_json = args.progress_json
+    if args.trace is None:
+        return run_job(parser, args, unknown_args)
+    job_state.trace = TraceRecorder()
     try:
-        signal.signal(signal.SIGINT, signal_handler)
-        parser = argparse.ArgumentParser(
-            prog='4chan Webm Converter',
-            description='Attempts to fit video clips into the 4chan size limit',
-            epilog='Default behavior is to process the entire video. Specify --start and either --end or --duration to make a clip. Note that input name can be specified either with -i or by just throwing it in as a misc. argument')
-        parser.add_argument('-i', '--input', type=str, help='Input file to process')
-        parser.add_argument('-o', '--output', type=str, help='Output File name (default output is named after the input prepended with "_1_")')
-        parser.add_argument('-s', '--start', type=str, default='0.0', help='Start timestamp, i.e. 0:30:5.125')
-        parser.add_argument('-e', '--end', type=str, help='End timestamp, i.e. 0:35:0.000')
-        parser.add_argument('-d', '--duration', type=str, help='Clip duration (maximum {} seconds in wsg mode, {} for gif, {} seconds otherwise), i.e. 1:15.000'.format(max_duration[0], max_duration[1], max_duration[2]))
-        parser.add_argument('-b', '--bitrate_compensation', default=0, type=float, help='Fixed value to subtract from target bitrate (kbps). Use if your output size is overshooting')
-        parser.add_argument('-n', '--normalize', action='store_true', help='Enable 2-pass audio normalization.')
-        parser.add_argument('-r', '--resolution', type=int, help="Manual resolution override. Maximum resolution, i.e. 1280. Applied vertically and horzontally, aspect ratio is preserved.")
-        parser.add_argument('-a', '--audio_filter', type=str, help="Audio filter arguments. This string is passed directly to the -af chain.")
-        parser.add_argument('-v', '--video_filter', type=str, help="Video filter arguments. This string is passed directly to the -vf chain.")
-        parser.add_argument('-c', '--concat', '--clip', dest='concat', type=str, help='Segments to concatenate (everything BUT these are cut), separated by ";", i.e. "5:00-5:15;5:45-5:52.4"')
-        parser.add_argument('-x', '--cut', type=str, help='Segments to cut (opposite of concatenate), separated by ";", i.e. "5:00-5:15;5:45-5:52.4"')
-        parser.add_argument('-k', '--keep_temp_files', action='store_true', help="Keep temporary files generated during size calculation etc.")
-        parser.add_argument('-g', '--group_of_pictures', type=float, help="Set ffmpeg's group-of-pictures interval (-g) directly.")
-        parser.add_argument('-y', '--yes', action='store_true', help="Automatically overwrite a file if it already exists.")
-        parser.add_argument('--audio_index', type=int, help="Audio track index to select (use --list_audio if you don't know the index)")
-        parser.add_argument('--audio_lang', type=str, help="Select audio track by language, must be an exact match with what is listed in the file (use --list_audio if you don't know the language)")
-        parser.add_argument('--audio_rate', type=int, choices=audio_bitrate_table, help='Manual audio bit-rate override (kbps)')
-        parser.add_argument('--audio_replace', action='store_true', help="Special mode that replaces the audio of a clip with other audio without modifying the video.")
-        parser.add_argument('--auto_crop', action='store_true', help="Automatic crop using cropdetect.")
-        parser.add_argument('--auto_subs', action='store_true', help="Automatically burn-in the first embedded subtitles, if they exist")
-        parser.add_argument('--bframes', type=int, default=-1, help="Number of B-frames to use in video encoding (passed as the -bf option).")
-        parser.add_argument('--blackframe', action='store_true', help="Skip initial black frames using a first pass with blackframe filter.")
-        parser.add_argument('--board', '--mode', dest='board', type=BoardMode, default='wsg', choices=list(BoardMode), help='Webm convert mode. wsg=6MB with sound, gif=4MB with sound, other=4MB no sound')
-        parser.add_argument('--bypass_resolution_table', action='store_true', help='Do not snap to the nearest standard resolution and use raw calculated instead.')
-        parser.add_argument('--caption', type=str, help='Caption text to add. Caption is rendered on top with a white background in "gif caption" meme format.')
-        parser.add_argument('--cc', action='store_true', help='Create a lossless Carbon Copy as h264+opus mkv.')
-        parser.add_argument('--codec', type=str, default='libvpx-vp9', choices=['libvpx-vp9','libx264', 'vp9_vaapi', 'h264_nvenc'], help='Video codec to use. Default is libvpx-vp9.')
-        parser.add_argument('--crop', type=str, help="Crop the video. This string is passed directly to ffmpeg's 'crop' filter. See ffmpeg documentation for details.")
-        parser.add_argument('--deadline', type=str, default='good', choices=['good', 'best', 'realtime'], help='The -deadline argument passed to ffmpeg. Default is "good". "best" is higher quality but slower. See libvpx-vp9 documentation for details.')
-        parser.add_argument('--download', type=str, help="Download the video using yt-dlp.")
-        parser.add_argument('--download_full', action='store_true', help="Download the full video before processing (otherwise only the clip bounded by --start and --end/--duration is downloaded).")
-        parser.add_argument('--ytdlp_args', type=str, help="Custom arguments to pass through to yt-dlp")
-        parser.add_argument('--dry_run', action='store_true', help='Make all the size calculations without encoding the webm. ffmpeg commands and bitrate calculations will be printed.')
-        parser.add_argument('--fast', action='store_true', help='Render fast at the expense of quality. Not recommended except for testing.')
-        parser.add_argument('--first_second_every_minute', action='store_true', help='Take 1 second from every minute of the input.')
-        parser.add_argument('--font', type=str, help="Font to use for captions.")
-        parser.add_argument('--fps', type=float, help='Manual fps override.')
-        parser.add_argument('--hdr', action='store_true', help="Process HDR input to the standard colorspace.")
-        parser.add_argument('--list_audio', action='store_true', help="List audio tracks and quit. Use if you don't know which --audio_index or --audio_lang to specify.")
-        parser.add_argument('--list_subs', action='store_true', help="List embedded subtitles and quit. Use if you don't know which --sub_index or --sub_lang to specify.")
-        parser.add_argument('--mono', action='store_true', help="Do mono mixdown. Equivalent to --mixdown mono")
-        parser.add_argument('--mp4', action='store_true', help="Make .mp4 instead of .webm (shortcut for --codec libx264)")
-        parser.add_argument('--music_mode', action='store_true', help="Prioritize audio quality over visual quality.")
-        parser.add_argument('--mixdown', type=MixdownMode, default='auto', choices=list(MixdownMode), help='Sound mixdown mode. Default = auto')
-        parser.add_argument('--no_audio', action='store_true', help='Drop audio if it exists')
-        parser.add_argument('--no_duration_check', action='store_true', help='Disable max duration check')
-        parser.add_argument('--no_dynaudnorm', action='store_true', help='Disable dynamic audio normalization when downmixing.')
-        parser.add_argument('--no_resize', action='store_true', help='Disable resolution resizing (may cause file size overshoot)')
-        parser.add_argument('--no_mixdown', action='store_true', help='Disable automatic audio mixdown. Equivalent to --mixdown same_as_source.')
-        parser.add_argument('--no_mt', action='store_true', help='Disable row based multithreading (the "-row-mt 1" switch)')
-        parser.add_argument('--pix_fmt', type=str, default='yuv420p', help='Pixel format (defaults to 8-bit yuv420). Specify "same_as_souce" to omit the pix_fmt arg from ffmpeg.')
-        parser.add_argument('--resize_mode', type=ResizeMode, default='logarithmic', choices=list(ResizeMode), help='How to calculate target resolution. table = use time-based lookup table. Default is logarithmic.')
-        parser.add_argument('--size', '--limit', dest='size', type=float, help='Target file size limit, in MiB. Default is 6 if board is wsg, and 4 otherwise.')
-        parser.add_argument('--static_image', action='store_true', help="Treat video as a static image and use image+audio combine mode.")
-        parser.add_argument('--stereo', action='store_true', help="Do stereo mixdown. Equivalent to --mixdown stereo")
-        parser.add_argument('--sub_index', type=int, help="Subtitle index to burn-in (use --list_subs if you don't know the index)")
-        parser.add_argument('--sub_lang', type=str, help="Subtitle language to burn-in, must be an exact match with what is listed in the file (use --list_subs if you don't know the language)")
-        parser.add_argument('--sub_file', type=str, help='Filename of subtitles to burn-in (use --sub_index or --sub_lang for embedded subs)')
-        parser.add_argument('--trim_silence', type=SilenceTrimMode, choices=list(SilenceTrimMode), help="Skip silence using a first pass with silencedetect filter. Skip silence at the start, end, or cut all detected silence.")
-        parser.add_argument('--use_fallback', action='store_true', help='When downloading from URL, automatically use similar video file names')
-        args, unknown_args = parser.parse_known_args()
-        if help in args:
-            parser.print_help()
-        if args.keep_temp_files:
-            do_cleanup = False
-        if args.mp4 and args.codec != 'h264_nvenc': # Use this shortcut flag to override the --codec option
-            args.codec = 'libx264'
-        if args.stereo: # Determine aliases for mixdown mode
-            args.mixdown = MixdownMode.stereo
-        if args.mono:
-            args.mixdown = MixdownMode.mono
-        if args.no_mixdown:
-            args.mixdown = MixdownMode.same_as_source
-        input_filename = None
-        if args.size is not None and args.size > 6.0:
-            print("Warning: Manual size limit is larger than 4chan's supported size of 6MiB!")
-        if args.audio_replace:
-            if len(unknown_args) == 2 and os.path.isfile(unknown_args[0]) and os.path.isfile(unknown_args[1]):
-                print('Using audio replace mode.')
-                video_input, audio_input = get_video_audio_inputs(unknown_args)
-                if video_input is None:
-                    raise RuntimeError("Couldn't identify video source from input files.")
-                if audio_input is None:
-                    raise RuntimeError("Couldn't identify audio source from input files.")
-                result = audio_replace(video_input, audio_input, args)
-                print('output file: "{}"'.format(result))
-                cleanup()
-                exit(0)
-        if args.input is not None: # Input was explicitly specified
-            input_filename = args.input
-        elif len(unknown_args) > 0: # Input was specified as an unknown argument, attempt smart context parsing
-            if len(unknown_args) == 2 and os.path.isfile(unknown_args[0]) and os.path.isfile(unknown_args[1]): # Try to detect music + static image assembly mode
-                print("2 input files specified. Using image + audio combine mode.")
-                image_input, audio_input = get_image_audio_inputs(unknown_args)
-                if image_input is None:
-                    raise RuntimeError("Couldn't identify image source from input files.")
-                if audio_input is None:
-                    raise RuntimeError("Couldn't identify audio source from input files.")
-                result = image_audio_combine(image_input, audio_input, args)
-                print('output file: "{}"'.format(result))
-                cleanup()
-                exit(0)
-            else:
-                timestamp_args = []
-                for arg in unknown_args:
-                    if os.path.isfile(arg):
-                        input_filename = arg
-                    elif is_timestamp(arg):
-                        timestamp_args.append(arg)
-                    elif is_segment(arg):
-                        args.concat = arg
-                        print('Treating {} as a --concat segment'.format(arg))
-                    elif is_url(arg):
-                        args.download = arg
-                    else:
-                        print("Unable to parse argument: '{}'".format(arg))
-                        print('Please command-line flags to specify complex arguments')
-                        exit(0)
-            if len(timestamp_args) > 0:
-                if args.concat is not None:
-                    print('Unable to parse arguments. Concat segments cannot be used in conjuction with other unspecified timestamps.')
-                    exit(0)
-                if args.start != '0.0' or args.end is not None or args.duration is not None:
-                    print('Unable to parse arguments. Unspecified timestamps cannot be used in conjuction with --start, --end, or --duration.')
-                    exit(0)
-                if len(timestamp_args) == 1: # One timestamp is treated as a duration
-                    args.duration = timestamp_args[0]
-                elif len(timestamp_args) == 2: # Two timestamps imply a start and end
-                    parsed_ts_args = {x:parsetime(x) for x in timestamp_args} # Create dict where values are parsed timestamps
-                    args.start = min(parsed_ts_args, key=parsed_ts_args.get) # Assume min value is start time
-                    print('Treating {} as a --start time.'.format(args.start))
-                    args.end = max(parsed_ts_args, key=parsed_ts_args.get) # Assume max value is end time
-                    print('Treating {} as an --end time.'.format(args.end))
-                else:
-                    print('Argument parsing failed. Too many timestamps specified.')
-                    exit(0)
+        with trace_span('job', 'job', args=' '.join(argv if argv is not None else sys.argv[1:])):
+            return run_job(parser, args, unknown_args)
+    finally:
+        job_state.trace.write(args.trace)
+        print('Trace written to "{}"'.format(args.trace))
+        job_state.trace = None
+
+# Apply the shortcut flags to the options they stand for
+def resolve_option_aliases(args):
+    if args.mp4 and args.codec != 'h264_nvenc': # Use this shortcut flag to override the --codec option
+        args.codec = 'libx264'
+    if args.stereo: # Determine aliases for mixdown mode
+        args.mixdown = MixdownMode.stereo
+    if args.mono:
+        args.mixdown = MixdownMode.mono
+    if args.no_mixdown:
+        args.mixdown = MixdownMode.same_as_source
+
+# Turn the --start, --end and --duration strings into the clip's start and duration. Returns (start, duration, full_video).
+def get_clip_window(input_filename, start : str, end, duration):
+    start_time = parsetime(start)
+    print('start time:', start_time)
+    full_video = False # Special flag for encoding the full video, which will skip -ss
+    # Prefer a direct duration if specified
+    if duration is not None:
+        clip_duration = parsetime(duration)
+    # If an end timestamp is specified, convert that to a relative duration using start time
+    elif end is not None:
+        end_time = parsetime(end)
+        if end_time.total_seconds() < start_time.total_seconds():
+            raise ValueError("Error: End time must be greater than start time")
+        clip_duration = end_time - start_time
+    # If neither was specified, use the video itself
+    else:
+        clip_duration = get_video_duration(input_filename, start_time.total_seconds())
+        if start_time.total_seconds() == 0:
+            full_video = True
+    print('duration:', clip_duration)
+    return start_time, clip_duration, full_video
+
+# Run one job from parsed command-line arguments
+def run_job(parser, args, unknown_args):
+    resolve_option_aliases(args)
+    input_filename = None
+    if args.size is not None and args.size > 6.0:
+        print("Warning: Manual size limit is larger than 4chan's supported size of 6MiB!")
+    if args.audio_replace:
+        if len(unknown_args) == 2 and os.path.isfile(unknown_args[0]) and os.path.isfile(unknown_args[1]):
+            print('Using audio replace mode.')
+            video_input, audio_input = get_video_audio_inputs(unknown_args)
+            if video_input is None:
+                raise RuntimeError("Couldn't identify video source from input files.")
+            if audio_input is None:
+                raise RuntimeError("Couldn't identify audio source from input files.")
+            result = audio_replace(video_input, audio_input, args)
+            print('output file: "{}"'.format(result))
+            cleanup()
+            return result
+    if args.input is not None: # Input was explicitly specified
+        input_filename = args.input
+    elif len(unknown_args) > 0: # Input was specified as an unknown argument, attempt smart context parsing
+        if len(unknown_args) == 2 and os.path.isfile(unknown_args[0]) and os.path.isfile(unknown_args[1]): # Try to detect music + static image assembly mode
+            print("2 input files specified. Using image + audio combine mode.")
+            image_input, audio_input = get_image_audio_inputs(unknown_args)
+            if image_input is None:
+                raise RuntimeError("Couldn't identify image source from input files.")
+            if audio_input is None:
+                raise RuntimeError("Couldn't identify audio source from input files.")
+            result = image_audio_combine(image_input, audio_input, args)
+            print('output file: "{}"'.format(result))
+            cleanup()
+            return result
         else:
-            parser.print_help() # Can't identify the input file
-            exit(0)
-        if args.download is not None:
-            input_filename = download_video(args.download, args)
-            if input_filename is None:
-                print('Unable to download video.')
-                exit(0)
+            timestamp_args = []
+            for arg in unknown_args:
+                if os.path.isfile(arg):
+                    input_filename = arg
+                elif is_timestamp(arg):
+                    timestamp_args.append(arg)
+                elif is_segment(arg):
+                    args.concat = arg
+                    print('Treating {} as a --concat segment'.format(arg))
+                elif is_url(arg):
+                    args.download = arg
+                else:
+                    print("Unable to parse argument: '{}'".format(arg))
+                    print('Please command-line flags to specify complex arguments')
+                    return None
+        if len(timestamp_args) > 0:
+            if args.concat is not None:
+                print('Unable to parse arguments. Concat segments cannot be used in conjuction with other unspecified timestamps.')
+                return None
+            if args.start != '0.0' or args.end is not None or args.duration is not None:
+                print('Unable to parse arguments. Unspecified timestamps cannot be used in conjuction with --start, --end, or --duration.')
+                return None
+            if len(timestamp_args) == 1: # One timestamp is treated as a duration
+                args.duration = timestamp_args[0]
+            elif len(timestamp_args) == 2: # Two timestamps imply a start and end
+                parsed_ts_args = {x:parsetime(x) for x in timestamp_args} # Create dict where values are parsed timestamps
+                args.start = min(parsed_ts_args, key=parsed_ts_args.get) # Assume min value is start time
+                print('Treating {} as a --start time.'.format(args.start))
+                args.end = max(parsed_ts_args, key=parsed_ts_args.get) # Assume max value is end time
+                print('Treating {} as an --end time.'.format(args.end))
+            else:
+                print('Argument parsing failed. Too many timestamps specified.')
+                return None
+    else:
+        parser.print_help() # Can't identify the input file
+        return None
+    if args.download is not None:
+        input_filename, args = download_video(args.download, args) # Downloading a section moves the clip window, which comes back in a copy of args
         if input_filename is None:
-            print('No input filename found.')
-            parser.print_help()
-            exit(0)
-        if os.path.isfile(input_filename):
-            # List available subtitles and quit
-            if args.list_subs:
-                subs = list_subtitles(input_filename)
-                for idx, lang in subs.items():
-                    print('{},{}'.format(idx, lang))
-                exit(0)
-            if args.list_audio:
-                tracks = list_audio(input_filename)
-                for idx, lang in tracks.items():
-                    layout, no_audio = get_audio_layout(input_filename, idx) # Also list layout
-                    print('{},{},{}'.format(idx, lang,layout))
-                exit(0)
-            if args.caption is not None:
-                mime, subtype = mimetypes.guess_type(input_filename)[0].split('/')
-                if subtype == 'gif':
-                    print('Running in gif caption mode.')
-                    result = gif_caption(input_filename, args)
-                    print('output file: "{}"'.format(result))
-                    cleanup()
-                    exit(0)
-            if args.static_image:
-                print('Extracting static image from video...')
-                image_input = extract_jpg(input_filename)
-                print('Extracting audio...')
-                audio_input = extract_audio(input_filename)
-                print("Using image + audio combine mode.")
-                if args.output is None:
-                    args.output = get_output_filename(input_filename, args, '.webm')
-                    print(args.output)
-                result = image_audio_combine(image_input, audio_input, args)
+            print('Unable to download video.')
+            return None
+    if input_filename is None:
+        print('No input filename found.')
+        parser.print_help()
+        return None
+    if os.path.isfile(input_filename):
+        # List available subtitles and quit
+        if args.list_subs:
+            subs = list_subtitles(input_filename)
+            for idx, lang in subs.items():
+                print('{},{}'.format(idx, lang))
+            return None
+        if args.list_audio:
+            tracks = list_audio(input_filename)
+            for idx, lang in tracks.items():
+                layout, no_audio = get_audio_layout(input_filename, idx) # Also list layout
+                print('{},{},{}'.format(idx, lang,layout))
+            return None
+        if args.caption is not None:
+            mime, subtype = mimetypes.guess_type(input_filename)[0].split('/')
+            if subtype == 'gif':
+                print('Running in gif caption mode.')
+                result = gif_caption(input_filename, args)
                 print('output file: "{}"'.format(result))
                 cleanup()
-                exit(0)
-            start_time = parsetime(args.start)
-            print('start time:', start_time)
-            # Attempt to find the duration of the clip
-            duration = datetime.timedelta(milliseconds=0)
-            full_video = False # Special flag for encoding the full video, which will skip -ss
-            # Prefer a direct duration if specified
-            if args.duration is not None:
-                duration = parsetime(args.duration)
-            # If an end timestamp is specified, convert that to a relative duration using start time
-            elif args.end is not None:
-                end = parsetime(args.end)
-                if end.total_seconds() < start_time.total_seconds():
-                    raise ValueError("Error: End time must be greater than start time")
-                duration = end - start_time
-            # If neither was specified, use the video itself
-            else:
-                duration = get_video_duration(input_filename, start_time.total_seconds())
-                if start_time.total_seconds() == 0:
-                    full_video = True
-            print('duration:', duration)
-            result = process_video(input_filename, start_time, duration, args, full_video)
+                return result
+        if args.static_image:
+            print('Extracting static image from video...')
+            image_input = extract_jpg(input_filename)
+            print('Extracting audio...')
+            audio_input = extract_audio(input_filename)
+            print("Using image + audio combine mode.")
+            if args.output is None:
+                args.output = get_output_filename(input_filename, args, '.webm')
+                print(args.output)
+            result = image_audio_combine(image_input, audio_input, args)
             print('output file: "{}"'.format(result))
-            cleanup()   
-        else:
-            print('Input file not found: "' + input_filename + '"')
+            cleanup()
+            return result
+        start_time, duration, full_video = get_clip_window(input_filename, args.start, args.end, args.duration)
+        if args.race:
+            result = race_video(input_filename, start_time, duration, args, full_video)
+            print('output file: "{}"'.format(result))
+            cleanup()
+            return result
+        if args.boards is not None or args.codecs is not None:
+            result = encode_targets(input_filename, start_time, duration, args, full_video)
+            for output in result:
+                print('output file: "{}"'.format(output))
+            cleanup()
+            return result
+        if args.split:
+            result = split_video(input_filename, start_time, duration, args, full_video)
+            for output in result:
+                print('output file: "{}"'.format(output))
+            cleanup()
+            return result
+        result = process_video(input_filename, start_time, duration, args, full_video)
+        print('output file: "{}"'.format(result))
+        cleanup()
+        return result
+    else:
+        print('Input file not found: "' + input_filename + '"')
+        return None
+
+if __name__ == '__main__':
+    try:
+        signal.signal(signal.SIGINT, signal_handler)
+        main()
     except argparse.ArgumentError as e:
         print(e)
     except Exception:
-        print(traceback.format_exc())
\ No newline at end of file
+        print(traceback.format_exc())
+    finally:
+        cleanup() # Temp files and output placeholders of a job that failed